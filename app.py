@@ -1,3 +1,4 @@
+import json
 import os
 import random
 import sqlite3
@@ -5,22 +6,32 @@ import threading
 import time
 from typing import List
 
-from flask import Flask, render_template, request, redirect, make_response, session, jsonify, send_file
+from flask import Flask, render_template, request, redirect, make_response, session, jsonify, send_file, g
 from datetime import datetime, timedelta, timezone
 import jwt
 from functools import wraps
+from itertools import groupby
+from operator import itemgetter
 from dotenv import load_dotenv
 
 import markdown_fyresmith
-from db import Access
+from cache import RenderCache, TTLCache, content_version
+from db import (DB, INSTRUMENT_QUERIES, Access, QueryStats, create_tables, current_query_stats,
+                get_title_changes, get_title_generation, set_page_categories)
 from mailer import send_email, send_message
 import logging
 from backup import backup_db
+from leases import LeaseManager
+from render_worker import RenderWorker, body_version
+from search import search_pages
+from revisions import get_history, get_revision, prepare_revision, record_missing_revisions, record_revision
 
 load_dotenv()
 
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY')
+app.jinja_options = dict(app.jinja_options, bytecode_cache=markdown_fyresmith.template_bytecode_cache)
+app.add_template_filter(markdown_fyresmith.format_date, 'format_date')
 
 time_check = datetime.now()
 
@@ -35,6 +46,12 @@ logging.basicConfig(
 
 log = logging.getLogger("app")
 
+# Every worker process runs these on start, so they share one write lock: a second worker waits for the first, then
+# finds nothing left to do
+with Access.transaction():
+    create_tables()
+    record_missing_revisions()
+
 # Backup Threading Logic
 is_backup_thread_active = any(thread.name == "backup_db" and thread.is_alive() for thread in threading.enumerate())
 
@@ -45,13 +62,21 @@ if not is_backup_thread_active and os.getenv('SCHEDULE_BACKUP') == 'TRUE':
     backup_thread.start()
 
 # Inter-Thread Data Structures
-lock = threading.Lock()
-last_update_times = {}
-pages_being_edited = {}
+render_cache = RenderCache()
+section_cache = RenderCache()
+preview_drafts = RenderCache()
+user_cache = TTLCache()
+title_matcher = None
+title_matcher_generation = None
+title_matcher_lock = threading.Lock()
+
+# Locks each page to one editor at a time, across every worker process
+page_leases = LeaseManager()
+page_leases.start()
 
-# Constants
-MAX_RETRIES = 3
-RETRY_DELAY_SECONDS = 1
+# Renders pages in the background after they are written, so views can serve the stored HTML
+render_worker = RenderWorker(lambda: get_title_matcher(), section_cache)
+render_worker.start()
 
 
 def generate_token(user: List[str]) -> str:
@@ -77,6 +102,55 @@ def generate_token(user: List[str]) -> str:
     return token
 
 
+def decode_token(token: str) -> dict or None:
+    """
+    Reads the user from a token.
+
+    :param token: The JWT from the token cookie.
+    :type token: str
+
+    :return: The user, or None if the token is invalid or has expired.
+    :rtype: dict or None
+    """
+    try:
+        data = jwt.decode(token, app.secret_key, algorithms=['HS256'])
+
+        return {
+            'email': data['email'],
+            'role': data['role'],
+            'first_name': data['first_name'],
+            'last_name': data['last_name']
+        }
+
+    except jwt.ExpiredSignatureError:
+        log.warning('Token has expired. Redirecting to sign-in page.')
+    except jwt.InvalidTokenError:
+        log.warning('Invalid token. Redirecting to sign-in page.')
+
+    return None
+
+
+def get_token_user():
+    """
+    Reads the signed-in user from the request's token cookie.
+
+    :return: The user, or None and a redirect to the sign-in page if the token is missing or invalid.
+    :rtype: tuple
+    """
+    token = request.cookies.get('token')
+
+    if not token:
+        log.warning('Token is missing. Redirecting to sign-in page.')
+        return None, redirect('/sign-in', code=302)
+
+    user = decode_token(token)
+
+    if user is None:
+        return None, redirect('/sign-in', code=302)
+
+    return user, None
+
+
 def token_required(f):
     """
     Decorator function to enforce token authentication for a given route.
@@ -90,32 +164,60 @@ def token_required(f):
 
     @wraps(f)
     def decorated(*args, **kwargs):
-        token = request.cookies.get('token')
+        user, response = get_token_user()
 
-        if not token:
-            log.warning('Token is missing. Redirecting to sign-in page.')
-            return redirect('/sign-in', code=302)
+        if user is None:
+            return response
 
-        try:
-            data = jwt.decode(token, app.secret_key, algorithms=['HS256'])
+        return f(user, *args, **kwargs)
 
-            user = {
-                'email': data['email'],
-                'role': data['role'],
-                'first_name': data['first_name'],
-                'last_name': data['last_name']
-            }
+    return decorated
 
-        except jwt.ExpiredSignatureError:
-            log.warning('Token has expired. Redirecting to sign-in page.')
-            return redirect('/sign-in', code=302)
-        except jwt.InvalidTokenError:
-            log.warning('Invalid token. Redirecting to sign-in page.')
-            return redirect('/sign-in', code=302)
 
-        return f(user, *args, **kwargs)
+@app.before_request
+def start_query_stats():
+    """
+    Starts totalling the request's database queries in g.query_stats, if DB_INSTRUMENT_QUERIES is set.
 
-    return decorated
+    :return: None
+    """
+    if INSTRUMENT_QUERIES:
+        g.query_stats = QueryStats()
+        current_query_stats.set(g.query_stats)
+
+
+@app.after_request
+def report_query_stats(response):
+    """
+    Logs the totals of the request's database queries and adds them to the response as a Server-Timing header.
+
+    :param response: The response to the request.
+    :type response: flask.Response
+
+    :return: The response.
+    :rtype: flask.Response
+    """
+    stats = g.pop('query_stats', None)
+
+    if stats is not None:
+        current_query_stats.set(None)
+        response.headers['Server-Timing'] = stats.server_timing()
+        log.info(f'{request.method} {request.path}: {stats.summary()}')
+
+    return response
+
+
+@app.teardown_appcontext
+def release_db_connection(exception=None):
+    """
+    Returns the request's database connection to the pool once the request is finished.
+
+    :param exception: The exception that ended the request, if any.
+    :type exception: Optional[BaseException]
+
+    :return: None
+    """
+    DB.get_instance().release_connection()
 
 
 def parse_date(date_str: str) -> datetime:
@@ -133,28 +235,52 @@ def parse_date(date_str: str) -> datetime:
     return date_object
 
 
-def get_page_list() -> List[str]:
+def get_page_list(limit=None) -> List[str]:
     """
-    Retrieves a list of recent pages based on their titles and dates.
+    Retrieves a list of page titles, most recently edited first.
+
+    :param limit: The maximum number of titles to retrieve. If None, retrieves every title.
+    :type limit: Optional[int]
 
     :return: A list of recent page titles.
     :rtype: list
     """
-    # create an Access instance for the 'pages' collection
     access = Access('pages')
 
-    # select 'title' and 'date' fields from the 'pages' collection
-    select = access.select(['title', 'date'])
+    select = access.select(['title'], order_by='updated_at DESC, title DESC', limit=limit)
+
+    return [row[0] for row in select]
+
 
-    # sort the list of tuples based on both date and time in descending order
-    sorted_tuples = sorted(select, key=lambda item: (datetime.strptime(item[1], "%b %d, %Y - %I:%M %p"), item),
-                           reverse=True)
+def get_title_matcher() -> markdown_fyresmith.TitleMatcher:
+    """
+    Retrieves the matcher over every page title used for auto-linking. It is loaded once, then brought up to date
+    with the pages created, renamed or deleted since, including by other worker processes, by replaying only those
+    changes.
+
+    :return: The shared title matcher.
+    :rtype: markdown_fyresmith.TitleMatcher
+    """
+    global title_matcher, title_matcher_generation
+
+    generation = get_title_generation()
 
-    # extract page titles from the sorted tuples
-    page_list = [subtuple[0] for subtuple in sorted_tuples]
+    if title_matcher is None or title_matcher_generation != generation:
+        with title_matcher_lock:
+            if title_matcher is None:
+                # Changes made while the titles are read are replayed next time, which leaves the same titles
+                title_matcher = markdown_fyresmith.TitleMatcher(get_page_list())
+                title_matcher_generation = generation
+                log.info(f'Loaded {len(title_matcher)} page titles for auto-linking.')
+            elif title_matcher_generation < generation:
+                for title_matcher_generation, old_title, new_title in get_title_changes(title_matcher_generation):
+                    if old_title is not None:
+                        title_matcher.discard(old_title)
 
-    # return the list of recent page titles
-    return page_list
+                    if new_title is not None:
+                        title_matcher.add(new_title)
+
+    return title_matcher
 
 
 def generate_random_code() -> str:
@@ -172,16 +298,31 @@ def generate_random_code() -> str:
 
 
 def get_user_info(email: str) -> list or None:
+    """
+    Retrieves a user's details by email, serving recent lookups from the user cache.
+
+    :param email: The email of the user.
+    :type email: str
+
+    :return: The user's email, first name, last name and role, or None if no user has that email.
+    :rtype: list or None
+    """
+    user = user_cache.get(email)
+
+    if user is not None:
+        return user
+
     access = Access('users')
 
-    users = access.select(['email', 'firstName', 'lastName', 'role'])
+    users = access.select(['email', 'firstName', 'lastName', 'role'], where={'email': email})
 
-    for user in users:
-        if email == user[0]:
-            log.info('User updated.')
-            return user
+    if not users:
+        return None
 
-    return None
+    user_cache.put(email, users[0])
+    log.info('User updated.')
+
+    return users[0]
 
 
 def authenticate_user(email: str, password: str) -> list or None:
@@ -198,87 +339,35 @@ def authenticate_user(email: str, password: str) -> list or None:
     """
     access = Access('users')
 
-    users = access.select(['email', 'password', 'firstName', 'lastName', 'role'])
+    users = access.select(['email', 'password', 'firstName', 'lastName', 'role'], where={'email': email})
 
-    for user in users:
-        if email == user[0] and password == user[1]:
+    for user in users or []:
+        if password == user[1]:
             log.info('User updated.')
             return user
 
     return None
 
 
-def get_page_categories() -> list:
-    """
-    Retrieves unique categories from the 'pages' collection.
-
-    :return: A list of unique categories.
-    :rtype: list
-    """
-    retries = 0
-
-    while retries < MAX_RETRIES:
-        try:
-            access = Access('pages')
-
-            select = access.select(['category'])
-
-            categories = []
-
-            for item_list in select:
-                category = item_list[0]
-
-                if ',' in category:
-                    string = category.split(',')
-                else:
-                    string = [category]
-
-                for item in string:
-                    if item.strip() not in categories:
-                        # if not, add it to the list of categories
-                        categories.append(item.strip())
-
-            return categories
-
-        except sqlite3.Error as e:
-            log.error(f'Error getting categories: {e}')
-
-            retries += 1
-
-            if retries < MAX_RETRIES:
-                log.info(f'Retrying category retrieval after {RETRY_DELAY_SECONDS} seconds...')
-                time.sleep(RETRY_DELAY_SECONDS)
-            else:
-                log.error(f'Maximum number of retries reached. Category retrieval failed.')
-                return []  # Handle the error or log as needed
-
-
 def get_organized_pages():
     """
-    Retrieves pages organized by categories from the 'pages' collection.
+    Retrieves pages organized by categories from the 'category_pages' view.
+
+    Pages are read in a single query ordered by category, so each category's pages are consecutive and are grouped as
+    they are read. A page is only filed under the categories it lists exactly, so "Art" does not match "Martial Arts".
 
-    :return: A dictionary of pages organized by categories.
+    :return: A dictionary of pages organized by categories, with '' for uncategorized pages.
     :rtype: dict
     """
-    # obtain a list of unique categories using the get_categories function
-    categories = get_page_categories()
+    access = Access('category_pages')
 
-    # initialize a dictionary where each category is a key mapped to an empty list
-    pages = {key: [] for key in categories}
+    select = access.select(['category', 'title'], order_by='category, title')
 
-    # create an Access instance for the 'pages' collection
-    access = Access('pages')
-
-    select = access.select(['title', 'category'])
+    pages = {}
 
-    for page in select:
-        for category in categories:
-            if category in page[1] and category != '':
-                pages[category].append(page[0])
-            elif category == '' and page[1] == '':
-                pages[category].append(page[0])
+    for category, rows in groupby(select or [], key=itemgetter(0)):
+        pages[category] = [row[1] for row in rows]
 
-    # return the dictionary of pages organized by categories
     return pages
 
 
@@ -290,38 +379,6 @@ def render_home_with_modal(title='', message=''):
     return redirect(f'/?title={title}&message={message}')
 
 
-def unlock_page_if_inactive(page: str):
-    """
-    Unlocks a page if this server has not received a ping from an editor in twenty seconds.
-
-    :param page: The name of the page to be checked as a string
-    :return: nothing
-    """
-
-    if page not in pages_being_edited.keys():
-        return
-
-    current_time = time.time()
-    last_update_time = last_update_times.get(page, 0)
-
-    if current_time - last_update_time >= 20:
-        log.info(f'Page: {page} unlocked due to inactivity.')
-        del pages_being_edited[page]
-
-
-def lock_page(page, email):
-    """
-    Locks a page for a user to edit.
-
-    :param page: Name of the page to be locked.
-    :param email: User's email address.
-    :return: None.
-    """
-
-    pages_being_edited[page] = email
-    last_update_times[page] = time.time()
-
-
 # @app.route('/sendemail', methods=['POST'])
 # def send_email():
 #     global time_check
@@ -347,13 +404,25 @@ def lock_page(page, email):
 @app.route('/active-editor', methods=['POST'])
 @token_required
 def active_editor(user: dict):
+    """
+    Handles the 'active-editor' route, which an open editor calls every few seconds to keep its lease on the page.
+
+    Editors only poll on a WSGI server. On an ASGI server, asgi.py serves presence connections instead, which hold
+    the lease without a request every few seconds (see presence.py).
+
+    :param user: The authenticated user obtained from the token.
+    :type user: dict
+
+    :return: Whether the editor holds the page's lease.
+    :rtype: Response
+    """
     try:
         page = request.json.get('page')
 
-        log.info(f"Pinged by editor: '{user['email']}' for page: '{page}'")
+        log.debug(f"Pinged by editor: '{user['email']}' for page: '{page}'")
 
-        pages_being_edited[page] = user['email']
-        last_update_times[page] = time.time()
+        if not page_leases.acquire(page, user['email']):
+            return jsonify({'status': 'locked', 'message': 'The page is being edited by someone else.'}), 409
 
         return jsonify({'status': 'success'}), 200
 
@@ -377,8 +446,20 @@ def return_to_page(user: dict):
     content = request.form.get('editorContent')
     page = request.form.get('page')
 
-    access = Access('pages')
-    access.update(['markdown'], [content], f'title = "{page}"')
+    revision = prepare_revision(page, content)
+
+    try:
+        with Access.transaction():
+            access = Access('pages')
+            access.update(['markdown'], [content], where={'title': page})
+            record_revision(page, content, user['first_name'], revision)
+    except sqlite3.Error as e:
+        log.error(f'Error saving page {page}: {e}')
+        return render_page_with_modal(page, title='Save Failed!',
+                                      message='Your changes could not be saved. Please try again.')
+
+    render_cache.invalidate(page)
+    render_worker.submit(page)
 
     log.info('Updated page.')
 
@@ -402,14 +483,37 @@ def save_file(user: dict):
     title = request.form.get('title')
     page = request.form.get('page')
 
-    if pages_being_edited[page] == user['email']:
-        access = Access('pages')
-        access.update(['markdown', 'title', 'category'], [content, title, category], f'title = "{page}"')
+    if page_leases.holder(page) == user['email']:
+        revision = prepare_revision(page, content)
+
+        try:
+            with Access.transaction():
+                access = Access('pages')
+
+                if title != page and access.select(['title'], where={'title': title}):
+                    log.warning('Attempt to update page name to an existing title.')
+                    return render_page_with_modal(page, title='Page Exists!', message='That page already exists!')
+
+                access.update(['markdown', 'title', 'category'], [content, title, category], where={'title': page})
+                set_page_categories(title, category)
+                record_revision(title, content, user['first_name'], revision)
+        except sqlite3.Error as e:
+            log.error(f'Error saving page {page}: {e}')
+            return render_page_with_modal(page, title='Save Failed!',
+                                          message='Your changes could not be saved. Please try again.')
+
+        render_cache.invalidate(page)
+        render_cache.invalidate(title)
+
+        # Sections are only reused under the title they were rendered for
+        if title != page:
+            section_cache.invalidate(page)
+
+        render_worker.submit(title)
 
         log.info('File was saved.')
 
-        del pages_being_edited[page]
-        pages_being_edited[title.strip()] = user['email']
+        page_leases.move(page, title.strip(), user['email'])
 
         return redirect(f'/editor?page={page}', code=302)
     else:
@@ -418,6 +522,67 @@ def save_file(user: dict):
                                               'you are not currently editing the document!')
 
 
+@app.route('/preview', methods=['POST'])
+@token_required
+def preview(user: dict):
+    """
+    Handles the 'preview' route for rendering the editor's unsaved Markdown. Nothing is written to the database.
+
+    The editor sends the lines that changed since its last preview, which replace lines start to end (exclusive) of
+    that preview. Only the sections affected by the change are rendered again. The response lists every section of
+    the new preview in order, with HTML only for the sections that were not part of the last preview.
+
+    :param user: The authenticated user obtained from the token.
+    :type user: dict
+
+    :return: The preview's version and sections, or a reset status if the editor's last preview is not known.
+    :rtype: Response
+    """
+    if user['role'] != 'admin' and user['role'] != 'editor':
+        return jsonify({'status': 'denied'}), 403
+
+    data = request.get_json(silent=True) or {}
+
+    page = data.get('page')
+    base = data.get('base')
+    start = data.get('start', 0)
+    end = data.get('end', 0)
+    lines = data.get('lines')
+
+    if not isinstance(page, str) or not isinstance(lines, list) or not all(isinstance(line, str) for line in lines):
+        return jsonify({'status': 'error', 'message': 'Invalid preview request.'}), 400
+
+    draft_key = (page, user['email'])
+    draft = preview_drafts.get(draft_key)
+
+    if base is None:
+        previous_lines = []
+        sent = set()
+    elif draft is not None and draft[0] == base:
+        previous_lines = draft[1].split('\n')
+        sent = set(draft[2])
+    else:
+        # The draft was evicted or belongs to another tab, so the editor has to send its whole text
+        return jsonify({'status': 'reset'}), 200
+
+    if not isinstance(start, int) or not isinstance(end, int) or not 0 <= start <= end <= len(previous_lines):
+        return jsonify({'status': 'error', 'message': 'Invalid line range.'}), 400
+
+    markdown_string = '\n'.join(previous_lines[:start] + lines + previous_lines[end:])
+    version = content_version(markdown_string)
+
+    sections = markdown_fyresmith.render_each_section(markdown_string, page, get_title_matcher(), section_cache)
+
+    preview_drafts.put(draft_key, (version, markdown_string, tuple(section[0] for section in sections)))
+
+    return jsonify({
+        'status': 'success',
+        'version': version,
+        'sections': [[section_version, None if section_version in sent else html, separator]
+                     for section_version, html, _, separator, _ in sections],
+    }), 200
+
+
 @app.route('/create-page', methods=['GET', 'POST'])
 @token_required
 def create_page(user: dict):
@@ -438,21 +603,31 @@ def create_page(user: dict):
 
         access = Access('pages')
 
-        select = access.select(['title'], f'title = "{page_title}"')
-
-        if len(select) != 0:
-            log.warning(f'User {user["email"]} attempted to create a page with an existing title.')
-            return render_template('create-page.html', message='That page already exists!')
-        elif '&' in page_title:
+        if '&' in page_title:
             log.warning(f'User {user["email"]} attempted to create a page with an illegal character ("&").')
             return render_template('create-page.html', message='You cannot create a title with the character "&"!')
-        else:
-            access.insert(['title', 'markdown', 'date', 'editor', 'category'],
-                          [page_title, markdown_fyresmith.DEFAULT_MARKDOWN,
-                           datetime.now().strftime('%b %d, %Y - %I:%M %p'),
-                           user['first_name'], ''])
 
-            return redirect(f'/editor?page={page_title}', code=302)
+        try:
+            with Access.transaction():
+                # Checked under the write lock, so two requests creating the same page cannot both pass
+                if access.select(['title'], where={'title': page_title}):
+                    log.warning(f'User {user["email"]} attempted to create a page with an existing title.')
+                    return render_template('create-page.html', message='That page already exists!')
+
+                access.insert(['title', 'markdown', 'date', 'updated_at', 'editor', 'category'],
+                              [page_title, markdown_fyresmith.DEFAULT_MARKDOWN,
+                               datetime.now().strftime('%b %d, %Y - %I:%M %p'), int(time.time()),
+                               user['first_name'], ''])
+                set_page_categories(page_title, '')
+                record_revision(page_title, markdown_fyresmith.DEFAULT_MARKDOWN, user['first_name'])
+        except sqlite3.Error as e:
+            log.error(f'Error creating page {page_title}: {e}')
+            return render_template('create-page.html', message='The page could not be created. Please try again.')
+
+        render_cache.invalidate(page_title)
+        render_worker.submit(page_title)
+
+        return redirect(f'/editor?page={page_title}', code=302)
     else:
         log.debug('Rendering the "create-page.html" template for GET request.')
         return render_template('create-page.html', message='')
@@ -476,8 +651,6 @@ def delete_page(user: dict):
 
     page = request.args.get('page')
 
-    unlock_page_if_inactive(page)
-
     if request.method == 'POST':
         page_title = request.form.get('pageTitle')
 
@@ -487,12 +660,14 @@ def delete_page(user: dict):
         # Check again if the user is an admin.
         if user['role'] == 'admin':
             access = Access('pages')
-            access.delete(f'title = "{page_title}"')
+            access.delete(where={'title': page_title})
+            render_cache.invalidate(page_title)
+            section_cache.invalidate(page_title)
             return render_home_with_modal(title='Success!', message=f'Page: {page} was successfully deleted!')
         else:
             return render_home_with_modal(title='Access Denied!', message='You do not have the permissions to delete a page!')
     else:
-        if page in pages_being_edited.keys() and pages_being_edited[page] != user['email']:
+        if page_leases.held_by_other(page, user['email']):
             log.info(f'{user["email"]} attempted to access deletion page for page: {page} but was denied access.')
 
             return render_page_with_modal(page, title='Page Locked!',
@@ -515,7 +690,7 @@ def update_page_name(user: dict):
     :param user: The authenticated user obtained from the token.
     :type user: dict
 
-    :return: Redirects to the editor page with the updated title if successful, otherwise returns None.
+    :return: Redirects to the editor page with the updated title if successful, otherwise back to the page.
     :rtype: Response or None
     """
     if user['role'] != 'admin' and user['role'] != 'editor':
@@ -524,25 +699,26 @@ def update_page_name(user: dict):
     new_page = request.form.get('new_page')
     page = request.form.get('page')
 
-    unlock_page_if_inactive(page)
-
-    if page in pages_being_edited.keys() and pages_being_edited[page] != user['email']:
+    if page_leases.held_by_other(page, user['email']):
         return render_page_with_modal(page, title='Access Denied!',
                                       message='Your update request was denied because you are not currently editing '
                                               'the document!')
     else:
         access = Access('pages')
 
-        select = access.select(['title'], f'title = "{new_page}"')
+        select = access.select(['title'], where={'title': new_page})
 
         if len(select) != 0:
             log.warning('Attempt to update page name to an existing title.')
-            return None
+            return render_page_with_modal(page, title='Page Exists!', message='That page already exists!')
         else:
-            del pages_being_edited[page]
-            pages_being_edited[new_page.strip()] = user['email']
+            page_leases.move(page, new_page.strip(), user['email'])
 
-            access.update(['title'], [new_page.strip()], f'title = "{page}"')
+            access.update(['title'], [new_page.strip()], where={'title': page})
+            render_cache.invalidate(page)
+            render_cache.invalidate(new_page.strip())
+            section_cache.invalidate(page)
+            render_worker.submit(new_page.strip())
             log.info(f'Page title updated: {page} -> {new_page}')
             return redirect(f'/editor?page={new_page}', code=302)
 
@@ -565,21 +741,28 @@ def update_page_category(user: dict):
     category = request.form.get('new_category')
     page = request.form.get('page')
 
-    unlock_page_if_inactive(page)
-
-    if page in pages_being_edited.keys() and pages_being_edited[page] != user['email']:
+    if page_leases.held_by_other(page, user['email']):
         return render_page_with_modal(page, title='Access Denied!',
                                       message='Your update request was denied because you are not currently editing '
                                               'the document!')
     else:
         access = Access('pages')
 
-        select = access.select(['category'], f'title = "{page}"')
+        select = access.select(['category'], where={'title': page})
         if len(select) == 0:
             log.warning(f'Attempt to update category for non-existing page: {page}')
             return None
         else:
-            access.update(['category'], [category.strip()], f'title = "{page}"')
+            try:
+                with Access.transaction():
+                    access.update(['category'], [category.strip()], where={'title': page})
+                    set_page_categories(page, category)
+            except sqlite3.Error as e:
+                log.error(f'Error updating the category of page {page}: {e}')
+                return render_page_with_modal(page, title='Update Failed!',
+                                              message='The category could not be updated. Please try again.')
+
+            render_cache.invalidate(page)
             log.info(f'Category updated for page: {page} -> {category}')
             return redirect(f'/editor?page={page}', code=302)
 
@@ -602,9 +785,7 @@ def editor(user: dict):
         return render_page_with_modal(page, title='Access Denied!', message='You do not have the permissions to '
                                                                             'access the editor for this page!')
 
-    unlock_page_if_inactive(page)
-
-    if page in pages_being_edited.keys() and pages_being_edited[page] != user['email']:
+    if not page_leases.acquire(page, user['email']):
         log.info(f'{user["email"]} attempted to access editor for page: {page} but was denied access.')
 
         return render_page_with_modal(page, 'Page Locked!',
@@ -613,10 +794,19 @@ def editor(user: dict):
     else:
         access = Access('pages')
 
-        select = access.select(['markdown', 'category'], f'title = "{page}"')
+        try:
+            with Access.transaction():
+                select = access.select(['markdown', 'category'], where={'title': page})
+
+                access.update(['editor', 'date', 'updated_at'],
+                              [user['first_name'], datetime.now().strftime('%b %d, %Y - %I:%M %p'), int(time.time())],
+                              where={'title': page})
+        except sqlite3.Error as e:
+            log.error(f'Error opening the editor for page {page}: {e}')
+            page_leases.release(page, user['email'])
 
-        access.update(['editor', 'date'], [user['first_name'], datetime.now().strftime('%b %d, %Y - %I:%M %p')],
-                      f'title = "{page}"')
+            return render_page_with_modal(page, title='Editor Unavailable!',
+                                          message='The editor could not be opened. Please try again.')
 
         page_markdown = ''
         category = ''
@@ -627,8 +817,6 @@ def editor(user: dict):
 
         log.info(f'Editor accessed for page: {page}')
 
-        lock_page(page, user['email'])
-
         return render_template('editor.html', page_content=page_markdown, page=page,
                                category=category, first_name=user['first_name'])
 
@@ -655,28 +843,76 @@ def get_page(user: dict):
     if message is None:
         message = ''
 
-    page_list = get_page_list()
+    access = Access('pages')
 
-    # log.info(page_list)
-    # log.info(page)
+    data = access.select(['markdown', 'updated_at', 'editor'], where={'title': page})
 
-    if page not in page_list:
+    if not data:
         return render_template('404.html')
 
-    access = Access('pages')
+    md = data[0][0]
+    date = data[0][1]
+    editor = data[0][2]
 
-    data = access.select(['markdown', 'date', 'editor'], f'title = "{page}"')
+    matcher = get_title_matcher()
 
-    md = data[0][0]
-    date = data[0][1] if data else ''
-    editor = data[0][2] if data else ''
+    # Only the body is cached; the chrome around it is rendered by the page template on every request.
+    version = body_version(page, md, matcher)
+    key = (page, version)
+
+    rendered = render_cache.get(key)
+
+    if rendered is None:
+        # Storing a render does not refresh the in-memory snapshot, so it is read from the database file
+        stored = access.select(['rendered_html', 'rendered_toc', 'content_hash'], where={'title': page}, snapshot=False)
+
+        if stored and stored[0][2] == version:
+            rendered = (stored[0][0], [tuple(entry) for entry in json.loads(stored[0][1])])
+
+    if rendered is None:
+        # The stored render is missing or stale, so render inline and let the worker store the result
+        rendered = markdown_fyresmith.render_sections(md, page, matcher, section_cache)[:2]
+        render_worker.submit(page, version, rendered)
 
-    html = markdown_fyresmith.to_html(md, date, editor, page, page_list, user['role'])
+    render_cache.put(key, rendered)
 
-    return render_template('page.html', md=html, title=title,
+    body, table_of_contents = rendered
+    recent_pages = [recent_page for recent_page in get_page_list(16) if recent_page != page][:15]
+
+    return render_template('page.html', body=body, table_of_contents=table_of_contents, page=page, date=date,
+                           editor=editor, recent_pages=recent_pages, role=user['role'], title=title,
                            message=message, first_name=user['first_name'])
 
 
+@app.route('/history', methods=['GET'])
+@token_required
+def page_history(user: dict):
+    """
+    Handles the 'history' route for listing a page's revisions, or retrieving one revision's markdown.
+
+    :param user: The authenticated user obtained from the token.
+    :type user: dict
+
+    :return: The page's revisions, newest first, or the markdown of the revision given by the 'revision' argument.
+    :rtype: Response
+    """
+    if user['role'] != 'admin' and user['role'] != 'editor':
+        return jsonify({'status': 'denied'}), 403
+
+    page = request.args.get('page')
+    number = request.args.get('revision', type=int)
+
+    if number is None:
+        return jsonify({'page': page, 'revisions': get_history(page)})
+
+    markdown = get_revision(page, number)
+
+    if markdown is None:
+        return jsonify({'status': 'not found'}), 404
+
+    return jsonify({'page': page, 'revision': number, 'markdown': markdown})
+
+
 @app.route('/download-db', methods=['GET'])
 @token_required
 def download_db(user: dict):
@@ -687,6 +923,8 @@ def download_db(user: dict):
     db_file_path = 'data/data.db'
 
     if os.path.exists(db_file_path):
+        DB.get_instance().checkpoint()
+
         return send_file(db_file_path, as_attachment=True)
     else:
         return 'File not found', 404
@@ -730,6 +968,27 @@ def main(user: dict):
                            message=message, first_name=user['first_name'], role=user['role'])
 
 
+@app.route('/search', methods=['GET'])
+@token_required
+def search(user: dict):
+    """
+    Handles the 'search' route for searching page titles and content.
+
+    :param user: The authenticated user obtained from the token.
+    :type user: dict
+
+    :return: Renders 'search.html' template with a page of ranked results.
+    :rtype: flask.templating.TemplatedResponse
+    """
+    query = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+
+    results, has_next = search_pages(query, page)
+
+    return render_template('search.html', query=query, results=results, page=max(page, 1), has_next=has_next,
+                           first_name=user['first_name'])
+
+
 @app.route('/code', methods=['GET', 'POST'])
 def code_input():
     """
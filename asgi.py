@@ -0,0 +1,44 @@
+"""
+ASGI entry point, for serving the wiki with an ASGI server such as uvicorn:
+uvicorn asgi:asgi_app
+"""
+import inspect
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import SyncToAsync
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+
+from app import app, decode_token, page_leases
+from presence import PresenceHub, presence_asgi
+
+# Number of requests the Flask app serves at once. Each thread keeps its Markdown engine and database connection
+# between requests, so the pool is also what bounds them
+ASGI_THREADS = int(os.getenv('ASGI_THREADS') or 8)
+
+# Keeps the leases of open editors and pushes lock changes to the pages' open presence connections
+presence_hub = PresenceHub(page_leases)
+presence_hub.start()
+
+# Tells the templates to open presence connections, which only this entry point serves, rather than poll
+app.config['PRESENCE_STREAM'] = True
+
+wsgi_executor = ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix='wsgi')
+
+
+class PooledWsgiToAsgiInstance(WsgiToAsgiInstance):
+    # WsgiToAsgi runs every request on one shared thread, which would leave one slow request, such as signing in,
+    # holding up every other request to the process. Requests are run on the shared pool instead
+    run_wsgi_app = SyncToAsync(inspect.unwrap(WsgiToAsgiInstance.run_wsgi_app), thread_sensitive=False,
+                               executor=wsgi_executor)
+
+
+class PooledWsgiToAsgi(WsgiToAsgi):
+    async def __call__(self, scope, receive, send):
+        await PooledWsgiToAsgiInstance(self.wsgi_application, self.duplicate_header_limit)(scope, receive, send)
+
+
+wiki_asgi = PooledWsgiToAsgi(app)
+
+# Presence connections are served on the event loop, and every other request by the Flask app on the pool
+asgi_app = presence_asgi(wiki_asgi, presence_hub, decode_token)
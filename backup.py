@@ -8,6 +8,8 @@ from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
 
+from db import DB
+
 LOCAL_BACKUP_FOLDER = 'backups'
 LOCAL_DATA_FOLDER = 'data'
 DB_PATH = f'{LOCAL_DATA_FOLDER}/data.db'
@@ -46,6 +48,9 @@ def backup_db():
     # Create new filename with timestamp
     new_file_name = f'{file_name}_{timestamp}{file_extension}'
 
+    # Move committed changes out of the write-ahead log, so the uploaded file is complete
+    DB.get_instance().checkpoint()
+
     # Set file metadata and content
     file_metadata = {'name': new_file_name, 'parents': [BACKUP_FOLDER_ID]}
     media = MediaFileUpload(DB_PATH, resumable=True)
@@ -59,6 +64,9 @@ def backup_db():
 
     log.info(f'File {file_name} uploaded to Google Drive with timestamped filename: {new_file_name} (ID: {file["id"]})')
 
+    # Backups run on their own threads, which would otherwise keep their connection open
+    DB.get_instance().release_connection()
+
 
 def download_latest_backup():
     # Load credentials from the JSON file
@@ -0,0 +1,95 @@
+"""
+Load test for the ASGI entry point: sends page views to the app while admins back up the database, with the Drive
+upload replaced by a fixed delay, and reports how long the page views take. The same load is sent to the Flask app
+wrapped in a plain WsgiToAsgi, which runs every request on one shared thread, and to asgi.asgi_app, which runs them on
+a pool of ASGI_THREADS threads.
+
+Run from the repository root, with the same environment as the app:
+python benchmarks/asgi.py [page_views] [backups] [upload_ms]
+"""
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from asgiref.wsgi import WsgiToAsgi
+
+import app as wiki
+import asgi
+from db import Access
+
+
+async def request(asgi_app, path: str, query: str, token: str) -> float:
+    """
+    Sends one GET request through the ASGI interface and returns how long the response took, in seconds.
+    """
+    scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+             'path': path, 'raw_path': path.encode('utf-8'), 'query_string': query.encode('utf-8'), 'root_path': '',
+             'headers': [(b'host', b'localhost'), (b'cookie', f'token={token}'.encode('utf-8'))],
+             'server': ('localhost', 80), 'client': ('127.0.0.1', 1234)}
+    requested = asyncio.Event()
+    done = asyncio.Event()
+    status = []
+
+    async def receive():
+        if not requested.is_set():
+            requested.set()
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        await done.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            status.append(message['status'])
+        elif not message.get('more_body'):
+            done.set()
+
+    start = time.perf_counter()
+    await asgi_app(scope, receive, send)
+
+    assert status[0] in (200, 302), status
+
+    return time.perf_counter() - start
+
+
+async def run(asgi_app, page_views: int, backups: int, token: str, titles: list) -> tuple:
+    """
+    Sends the page views while the backups run, and returns the page views' times and how long everything took.
+    """
+    start = time.perf_counter()
+    slow = [asyncio.ensure_future(request(asgi_app, '/backup-db', '', token)) for _ in range(backups)]
+
+    # Page views arrive while the backups are running
+    await asyncio.sleep(0.01)
+    fast = await asyncio.gather(*(request(asgi_app, '/page', f'page={titles[i % len(titles)]}', token)
+                                  for i in range(page_views)))
+    await asyncio.gather(*slow)
+
+    return sorted(fast), time.perf_counter() - start
+
+
+def main(page_views: int = 50, backups: int = 4, upload_ms: int = 200):
+    # Stands in for the Google Drive upload, which releases the GIL while it waits on the network
+    wiki.backup_db = lambda: time.sleep(upload_ms / 1000)
+
+    token = wiki.generate_token(['admin@example.com', 'Admin', '', 'admin'])
+    titles = [row[0] for row in Access('pages').select(['title'])]
+
+    print(f'{page_views} page views, {backups} backups of {upload_ms} ms each')
+
+    for name, asgi_app in [('WsgiToAsgi, one shared thread', WsgiToAsgi(wiki.app)),
+                           ('asgi_app, a pool of threads', asgi.asgi_app)]:
+        # Warms up the render cache, so that only the warm-up pays for rendering
+        asyncio.run(run(asgi_app, page_views, 0, token, titles))
+        fast, total = asyncio.run(run(asgi_app, page_views, backups, token, titles))
+
+        print(f'{name:<32} page views {statistics.median(fast) * 1000:8.1f} ms median, '
+              f'{fast[-1] * 1000:8.1f} ms max, all requests done in {total * 1000:.0f} ms')
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:4]))
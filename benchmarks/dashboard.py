@@ -0,0 +1,85 @@
+"""
+Compares building the dashboard from comma-separated category strings with the single page_categories query.
+
+Run from the repository root, with the same environment as the app:
+python benchmarks/dashboard.py [pages] [categories]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+from db import DB, Access, create_tables
+
+
+def legacy_organized_pages():
+    """
+    The dashboard query before page_categories: a list scan per category, then a substring test per page and category.
+    """
+    categories = []
+
+    for (category,) in Access('pages').select(['category']):
+        for item in category.split(','):
+            if item.strip() not in categories:
+                categories.append(item.strip())
+
+    pages = {key: [] for key in categories}
+
+    for title, category in Access('pages').select(['title', 'category']):
+        for item in categories:
+            if item in category and item != '':
+                pages[item].append(title)
+            elif item == '' and category == '':
+                pages[item].append(title)
+
+    return pages
+
+
+def populate(page_count: int, category_count: int):
+    names = [f'Category {i}' for i in range(category_count)]
+    rng = random.Random(0)
+    rows = []
+
+    for i in range(page_count):
+        # One page in ten is uncategorized, the rest list up to three categories
+        listed = rng.sample(names, rng.randint(1, 3)) if i % 10 else []
+        rows.append((f'Page {i}', '', 'Jan 01, 2024 - 12:00 PM', 0, 'Benchmark', ', '.join(listed)))
+
+    connection = DB.get_instance().get_connection()
+    connection.executemany('INSERT INTO pages (title, markdown, date, updated_at, editor, category) '
+                           'VALUES (?, ?, ?, ?, ?, ?)', rows)
+    connection.commit()
+
+
+def main(page_count: int = 100_000, category_count: int = 2_000):
+    with tempfile.TemporaryDirectory() as folder:
+        db.DB_PATH = os.path.join(folder, 'data.db')
+
+        # Importing the app creates the tables, so the pages are inserted before page_categories is backfilled
+        from app import get_organized_pages
+
+        populate(page_count, category_count)
+
+        start = time.perf_counter()
+        create_tables()
+        print(f'{"backfill page_categories":<28} {time.perf_counter() - start:8.3f} s')
+
+        start = time.perf_counter()
+        organized = get_organized_pages()
+        print(f'{"page_categories query":<28} {time.perf_counter() - start:8.3f} s '
+              f'({len(organized)} categories, {sum(map(len, organized.values()))} entries)')
+
+        start = time.perf_counter()
+        legacy = legacy_organized_pages()
+        print(f'{"comma-separated scan":<28} {time.perf_counter() - start:8.3f} s '
+              f'({len(legacy)} categories, {sum(map(len, legacy.values()))} entries)')
+
+        DB.get_instance().release_connection()
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
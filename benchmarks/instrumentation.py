@@ -0,0 +1,84 @@
+"""
+Measures the overhead of query instrumentation on Access reads, disabled and enabled, against the bare methods.
+
+Run from the repository root, with the same environment as the app:
+python benchmarks/instrumentation.py [pages] [lookups]
+"""
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+from db import DB, Access, QueryStats, create_tables, current_query_stats
+
+
+def populate(page_count: int):
+    rows = [(f'Page {i}', 'Page text', 'Jan 01, 2024 - 12:00 PM', i, 'Benchmark', '') for i in range(page_count)]
+
+    connection = DB.get_instance().get_connection()
+    connection.executemany('INSERT INTO pages (title, markdown, date, updated_at, editor, category) '
+                           'VALUES (?, ?, ?, ?, ?, ?)', rows)
+    connection.commit()
+
+
+def measure(name: str, lookup, titles: list, rounds: int = 5) -> float:
+    # The best of several rounds, since the differences measured are smaller than the noise between rounds
+    timings = []
+
+    for _ in range(rounds):
+        start = time.perf_counter()
+
+        for title in titles:
+            lookup(title)
+
+        timings.append((time.perf_counter() - start) / len(titles) * 1_000_000)
+
+    print(f'{name:<40} {min(timings):8.3f} us/query (median round {statistics.median(timings):8.3f})')
+
+    return min(timings)
+
+
+def main(page_count: int = 10_000, lookup_count: int = 20_000):
+    rng = random.Random(0)
+    titles = [f'Page {rng.randrange(page_count)}' for _ in range(lookup_count)]
+
+    with tempfile.TemporaryDirectory() as folder:
+        db.DB_PATH = os.path.join(folder, 'data.db')
+        create_tables()
+        populate(page_count)
+
+        pages = Access('pages')
+        bare_select = Access.select.__wrapped__
+        bare_exists = Access.exists.__wrapped__
+
+        for method, bare, lookup in [
+            ('select', lambda title: bare_select(pages, ['markdown'], where={'title': title}),
+             lambda title: pages.select(['markdown'], where={'title': title})),
+            ('exists', lambda title: bare_exists(pages, 'title', title), lambda title: pages.exists('title', title)),
+        ]:
+            db.INSTRUMENT_QUERIES = False
+            base = measure(f'{method}: not instrumented', bare, titles)
+            disabled = measure(f'{method}: instrumentation disabled', lookup, titles)
+
+            # Connections trace their statements only if instrumentation was enabled when they were opened
+            db.INSTRUMENT_QUERIES = True
+            DB.get_instance().release_connection()
+            DB.get_instance().idle_connections.clear()
+            current_query_stats.set(QueryStats())
+            enabled = measure(f'{method}: instrumentation enabled', lookup, titles)
+            stats = current_query_stats.get()
+            current_query_stats.set(None)
+
+            print(f'{method + ": overhead":<40} {disabled - base:+8.3f} us disabled, {enabled - base:+8.3f} us enabled '
+                  f'({stats.queries} queries recorded, {len(stats.fingerprints)} fingerprints)')
+
+        DB.get_instance().release_connection()
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,109 @@
+"""
+Races several processes for edit leases on a few pages, checking that no page is ever granted to two holders at once,
+and measures how long acquiring, renewing and releasing take under that contention.
+
+Run from the repository root, with the same environment as the app:
+python benchmarks/leases.py [processes] [pages] [seconds]
+"""
+import multiprocessing
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+from db import DB, create_tables
+from leases import LeaseManager
+
+
+def race(path: str, worker: int, page_count: int, seconds: float, results):
+    db.DB_PATH = path
+    leases = LeaseManager(ttl=60)
+    rng = random.Random(worker)
+    holder = f'editor{worker}@example.com'
+
+    # The times each lease was held, from just after it was granted to just before it was released
+    held = []
+    timings = {'acquire': [], 'renew': [], 'release': []}
+    refused = 0
+    # Renewals and releases of leases that someone else had taken over
+    lost = 0
+    end = time.time() + seconds
+
+    while time.time() < end:
+        page = f'Page {rng.randrange(page_count)}'
+
+        start = time.perf_counter()
+        acquired = leases.acquire(page, holder)
+        timings['acquire'].append(time.perf_counter() - start)
+
+        if not acquired:
+            refused += 1
+            continue
+
+        granted = time.time()
+
+        for _ in range(rng.randint(0, 3)):
+            start = time.perf_counter()
+            lost += not leases.renew(page, holder)
+            timings['renew'].append(time.perf_counter() - start)
+
+        released = time.time()
+        start = time.perf_counter()
+        lost += not leases.release(page, holder)
+        timings['release'].append(time.perf_counter() - start)
+
+        held.append((page, granted, released))
+
+    DB.get_instance().release_connection()
+    results.put((held, timings, refused, lost))
+
+
+def main(process_count: int = 8, page_count: int = 4, seconds: float = 5):
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'data.db')
+        db.DB_PATH = path
+        create_tables()
+        DB.get_instance().release_connection()
+
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=race, args=(path, worker, page_count, seconds, results))
+                     for worker in range(process_count)]
+
+        for process in processes:
+            process.start()
+
+        outcomes = [results.get() for _ in processes]
+
+        for process in processes:
+            process.join()
+
+    # Sorted by page and grant time, each lease must be granted after every earlier lease on its page was released
+    overlaps = 0
+    released = {}
+
+    for page, granted, until in sorted(lease for outcome in outcomes for lease in outcome[0]):
+        overlaps += granted < released.get(page, 0)
+        released[page] = max(released.get(page, 0), until)
+
+    held = sum(len(outcome[0]) for outcome in outcomes)
+    refused = sum(outcome[2] for outcome in outcomes)
+    lost = sum(outcome[3] for outcome in outcomes)
+
+    print(f'{process_count} processes, {page_count} pages, {seconds} s: {held} leases granted, '
+          f'{refused} refused, {overlaps} granted while already held, {lost} renewals or releases of lost leases')
+
+    for name in ['acquire', 'renew', 'release']:
+        timings = sorted(timing * 1000 for outcome in outcomes for timing in outcome[1][name])
+        print(f'{name:<10} {len(timings) / seconds:10.0f} /s {statistics.median(timings):8.3f} ms median, '
+              f'{timings[int(len(timings) * 0.99) - 1]:8.3f} ms p99')
+
+    assert overlaps == 0 and lost == 0
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:4]))
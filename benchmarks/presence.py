@@ -0,0 +1,189 @@
+"""
+Load test for presence connections: opens a presence stream for each simulated editor, each on its own page, and a
+second stream watching each page, all served by presence_asgi on one event loop. Reports the memory and CPU time
+idle connections cost, the database work done while they are idle compared with the five-second pings editors make
+on WSGI servers, and how long lock changes take to reach the pages' watchers.
+
+Run from the repository root, with the same environment as the app:
+python benchmarks/presence.py [editors] [idle_seconds]
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+import presence
+from db import DB, AccessAsync, create_tables
+from leases import LeaseManager
+from presence import PresenceHub, presence_asgi
+
+# How often the editor pings /active-editor on WSGI servers, which do not serve presence connections
+PING_SECONDS = 5
+
+
+class Client:
+    """
+    A simulated browser holding one presence stream open, recording when each lock event arrives.
+    """
+
+    def __init__(self, asgi_app, page: str, email: str, editing: bool):
+        self.asgi_app = asgi_app
+        self.page = page
+        self.email = email
+        self.editing = editing
+        self.events = []
+        self.disconnected = asyncio.Event()
+        self.changed = asyncio.Event()
+
+    async def receive(self):
+        await self.disconnected.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(self, message):
+        for event in message.get('body', b'').decode('utf-8').split('\n\n'):
+            if event.startswith('event: lock'):
+                self.events.append((time.perf_counter(), json.loads(event.split('data: ', 1)[1])))
+                self.changed.set()
+
+    async def run(self):
+        query = f'page={self.page}&edit={int(self.editing)}'.encode('utf-8')
+        scope = {'type': 'http', 'path': '/presence', 'query_string': query,
+                 'headers': [(b'cookie', f'token={self.email}'.encode('utf-8'))]}
+
+        await self.asgi_app(scope, self.receive, self.send)
+
+    async def wait_for(self, locked: bool) -> float:
+        while not self.events or self.events[-1][1]['locked'] != locked:
+            self.changed.clear()
+            await self.changed.wait()
+
+        return self.events[-1][0]
+
+
+def authenticate(token: str) -> dict:
+    return {'email': token, 'role': 'editor', 'first_name': 'Editor', 'last_name': ''}
+
+
+async def not_found(scope, receive, send):
+    await send({'type': 'http.response.start', 'status': 404, 'headers': []})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+class CountingLeaseManager(LeaseManager):
+    """
+    Counts the statements the hub runs against page_leases.
+    """
+
+    statements = 0
+
+    def execute(self, query, params):
+        CountingLeaseManager.statements += 1
+        return super().execute(query, params)
+
+    def renew_many(self, leases):
+        CountingLeaseManager.statements += 1
+        return super().renew_many(leases)
+
+    def holders(self, pages):
+        CountingLeaseManager.statements += 1
+        return super().holders(pages)
+
+
+async def run(editor_count: int, idle_seconds: float, path: str):
+    leases = CountingLeaseManager(ttl=6)
+    hub = PresenceHub(leases, interval=0.5)
+    hub.start()
+    asgi_app = presence_asgi(not_found, hub, authenticate)
+
+    editors = [Client(asgi_app, f'Page {i}', f'editor{i}@example.com', True) for i in range(editor_count)]
+    watchers = [Client(asgi_app, f'Page {i}', f'watcher{i}@example.com', False) for i in range(editor_count)]
+
+    tracemalloc.start()
+    memory = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    tasks = [asyncio.ensure_future(client.run()) for client in editors + watchers]
+
+    await asyncio.gather(*(client.wait_for(True) for client in editors + watchers))
+
+    print(f'{"open connections":<40} {len(tasks):10d} in {time.perf_counter() - start:.2f} s')
+    print(f'{"memory per connection":<40} {(tracemalloc.get_traced_memory()[0] - memory) / len(tasks) / 1024:10.1f} KiB')
+    tracemalloc.stop()
+
+    assert all(client.events[-1][1]['mine'] for client in editors)
+    assert not any(client.events[-1][1]['mine'] for client in watchers)
+
+    # Idle: nothing changes, so only the hub's renewals and lease reads touch the database
+    statements = CountingLeaseManager.statements
+    cpu = time.process_time()
+    await asyncio.sleep(idle_seconds)
+    cpu = time.process_time() - cpu
+    statements = CountingLeaseManager.statements - statements
+
+    print(f'{"idle CPU time":<40} {cpu / idle_seconds * 100:10.2f} % of a core '
+          f'({cpu / idle_seconds / len(tasks) * 1_000_000:.2f} us/s per connection)')
+    print(f'{"idle lease statements":<40} {statements / idle_seconds:10.2f} /s')
+
+    # The same editors pinging every PING_SECONDS, as on a WSGI server: one lease write per editor per ping
+    sample = editors[:200]
+    start = time.perf_counter()
+
+    for client in sample:
+        await AccessAsync.run(leases.acquire, client.page, client.email)
+
+    ping = (time.perf_counter() - start) / len(sample)
+    print(f'{"five-second pings, for comparison":<40} {editor_count / PING_SECONDS:10.2f} /s, '
+          f'{ping * editor_count / PING_SECONDS * 100:.1f} % of one database thread')
+
+    # Editors closing the editor: their watchers are told once the grace period runs out
+    closing = list(range(0, editor_count, 10))
+    start = time.perf_counter()
+
+    for i in closing:
+        editors[i].disconnected.set()
+
+    arrivals = await asyncio.gather(*(watchers[i].wait_for(False) for i in closing))
+    latencies = sorted(arrival - start for arrival in arrivals)
+    print(f'{"editor closed -> watchers unlocked":<40} {statistics.median(latencies) * 1000:10.1f} ms median, '
+          f'{latencies[-1] * 1000:.1f} ms max (grace {presence.PRESENCE_GRACE_SECONDS} s)')
+
+    # Another process's editor taking the freed pages: its watchers here are told by the hub's next refresh
+    other_process = sqlite3.connect(path)
+    start = time.perf_counter()
+    other_process.executemany('INSERT OR REPLACE INTO page_leases (page, holder, expires_at) VALUES (?, ?, ?)',
+                              [(f'Page {i}', 'other@example.com', time.time() + 60) for i in closing])
+    other_process.commit()
+    other_process.close()
+
+    arrivals = await asyncio.gather(*(watchers[i].wait_for(True) for i in closing))
+    latencies = sorted(arrival - start for arrival in arrivals)
+    print(f'{"other process locked -> watchers told":<40} {statistics.median(latencies) * 1000:10.1f} ms median, '
+          f'{latencies[-1] * 1000:.1f} ms max (interval {hub.interval} s)')
+
+    for client in editors + watchers:
+        client.disconnected.set()
+
+    await asyncio.gather(*tasks)
+    assert hub.connections() == 0
+
+
+def main(editor_count: int = 1000, idle_seconds: float = 10):
+    with tempfile.TemporaryDirectory() as folder:
+        db.DB_PATH = os.path.join(folder, 'data.db')
+        create_tables()
+
+        presence.PRESENCE_GRACE_SECONDS = 0.5
+        asyncio.run(run(editor_count, idle_seconds, db.DB_PATH))
+
+        DB.get_instance().release_connection()
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
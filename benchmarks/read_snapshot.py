@@ -0,0 +1,89 @@
+"""
+Compares read latency from the database file with reads from the in-memory snapshot, on a generated wiki.
+
+Run from the repository root, with the same environment as the app:
+python benchmarks/read_snapshot.py [pages] [lookups]
+"""
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+import markdown_fyresmith
+from db import DB, Access, create_tables
+from leases import LeaseManager
+
+
+def populate(page_count: int):
+    rows = [(f'Page {i}', markdown_fyresmith.DEFAULT_MARKDOWN, 'Jan 01, 2024 - 12:00 PM', i, 'Benchmark', '')
+            for i in range(page_count)]
+
+    connection = DB.get_instance().get_connection()
+    connection.executemany('INSERT INTO pages (title, markdown, date, updated_at, editor, category) '
+                           'VALUES (?, ?, ?, ?, ?, ?)', rows)
+    connection.commit()
+
+
+def measure(name: str, lookup, count: int):
+    timings = []
+
+    for i in range(count):
+        start = time.perf_counter()
+        lookup(i)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    timings.sort()
+    print(f'{name:<36} {statistics.median(timings):8.4f} ms median, {timings[int(len(timings) * 0.95) - 1]:8.4f} ms p95')
+
+
+def main(page_count: int = 20_000, lookup_count: int = 5_000):
+    rng = random.Random(0)
+    titles = [f'Page {rng.randrange(page_count)}' for _ in range(lookup_count)]
+
+    with tempfile.TemporaryDirectory() as folder:
+        db.DB_PATH = os.path.join(folder, 'data.db')
+        create_tables()
+        populate(page_count)
+
+        pages = Access('pages')
+
+        for mode, snapshot in [('file', False), ('snapshot', True)]:
+            db.READ_SNAPSHOT = snapshot
+            DB.get_instance().release_connection()
+
+            # The first read loads the snapshot, so it is not counted
+            start = time.perf_counter()
+            pages.exists('title', titles[0])
+            print(f'{mode + ": first read":<36} {(time.perf_counter() - start) * 1000:8.4f} ms')
+
+            measure(f'{mode}: page by title', lambda i: pages.select(['markdown'], where={'title': titles[i]}),
+                    lookup_count)
+            measure(f'{mode}: page exists', lambda i: pages.exists('title', titles[i]), lookup_count)
+            measure(f'{mode}: 50 newest pages', lambda i: pages.select(['title'], order_by='updated_at DESC', limit=50),
+                    lookup_count // 10)
+
+        # Writes to tables that are not read from the snapshot, such as page leases, never refresh it
+        leases = LeaseManager()
+        measure('snapshot: lease write, then read',
+                lambda i: (leases.acquire(titles[i], 'benchmark@example.com'), pages.exists('title', titles[i])),
+                lookup_count // 10)
+
+        # A page write is cheap, but the next read refreshes the snapshot, so its cost grows with the database
+        start = time.perf_counter()
+        pages.update(['editor'], ['Benchmark 2'], where={'title': titles[0]})
+        print(f'{"snapshot: page write":<36} {(time.perf_counter() - start) * 1000:8.4f} ms')
+
+        start = time.perf_counter()
+        assert pages.select(['editor'], where={'title': titles[0]}) == [('Benchmark 2',)]
+        print(f'{"snapshot: refreshing read":<36} {(time.perf_counter() - start) * 1000:8.4f} ms')
+
+        DB.get_instance().release_connection()
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,37 @@
+"""
+Measures the per-request Markdown setup cost removed by reusing thread-local engines.
+
+Run from the repository root:
+python benchmarks/render_engine.py [iterations]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import markdown_fyresmith
+
+
+def main(iterations: int = 200):
+    source = markdown_fyresmith.DEFAULT_MARKDOWN
+
+    def construct():
+        markdown_fyresmith.create_engine()
+
+    def fresh():
+        markdown_fyresmith.create_engine().convert(source)
+
+    def pooled():
+        markdown_fyresmith.get_engine().convert(source)
+
+    pooled()
+
+    for name, func in (('engine construction only', construct), ('fresh engine + convert', fresh),
+                       ('pooled engine + convert', pooled)):
+        elapsed = timeit.timeit(func, number=iterations)
+        print(f'{name:<28} {elapsed / iterations * 1000:8.3f} ms/render')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
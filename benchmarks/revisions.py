@@ -0,0 +1,106 @@
+"""
+Compares the space used by revision history with full copies of every revision, on generated edit sequences.
+
+Run from the repository root, with the same environment as the app:
+python benchmarks/revisions.py [pages] [revisions_per_page]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+import markdown_fyresmith
+import revisions
+from db import DB, Access, create_tables
+
+WORDS = markdown_fyresmith.DEFAULT_MARKDOWN.split()
+
+
+def sentence(rng: random.Random) -> str:
+    return ' '.join(rng.choices(WORDS, k=rng.randint(8, 30))).capitalize() + '.'
+
+
+def edit(markdown: str, rng: random.Random) -> str:
+    """
+    Makes one save's worth of changes, weighted towards the small fixes and additions most saves contain.
+    """
+    lines = markdown.split('\n')
+    line = rng.randrange(len(lines))
+    kind = rng.choices(['fix', 'add', 'append', 'remove', 'rewrite'], [45, 20, 20, 10, 5])[0]
+
+    if kind == 'fix':
+        words = lines[line].split(' ')
+        words[rng.randrange(len(words))] = rng.choice(WORDS)
+        lines[line] = ' '.join(words)
+    elif kind == 'add':
+        lines.insert(line, sentence(rng))
+    elif kind == 'append':
+        lines.extend(['', f'## {rng.choice(WORDS).title()}', ''] + [sentence(rng) for _ in range(rng.randint(1, 4))])
+    elif kind == 'remove' and len(lines) > 1:
+        del lines[line]
+    else:
+        for i in range(line, min(line + 10, len(lines))):
+            lines[i] = sentence(rng)
+
+    return '\n'.join(lines)
+
+
+def main(page_count: int = 20, revision_count: int = 200):
+    rng = random.Random(0)
+
+    with tempfile.TemporaryDirectory() as folder:
+        db.DB_PATH = os.path.join(folder, 'data.db')
+        create_tables()
+
+        # The title, number and markdown of every recorded revision
+        history = []
+        start = time.perf_counter()
+
+        for i in range(page_count):
+            title = f'Page {i}'
+            markdown = markdown_fyresmith.DEFAULT_MARKDOWN
+
+            Access('pages').insert(['title', 'markdown', 'date', 'updated_at', 'editor', 'category'],
+                                   [title, markdown, '', 0, 'Benchmark', ''])
+
+            for _ in range(revision_count):
+                number = revisions.record_revision(title, markdown, 'Benchmark')
+
+                # Edits that change nothing, such as replacing a word with itself, are not recorded
+                if number is not None:
+                    history.append((title, number, markdown))
+
+                markdown = edit(markdown, rng)
+
+        print(f'{"record revisions":<34} {(time.perf_counter() - start) / len(history) * 1000:8.3f} ms/revision')
+
+        report = revisions.storage_report()
+        compressed = sum(len(zlib.compress(markdown.encode('utf-8'), 9)) for _, _, markdown in history)
+
+        print(f'{"revisions":<34} {report["revisions"]:8d}')
+        print(f'{"full copies":<34} {report["full_bytes"]:8d} bytes')
+        print(f'{"compressed full copies":<34} {compressed:8d} bytes '
+              f'({compressed / report["full_bytes"]:.1%})')
+        print(f'{"stored (snapshot every " + str(revisions.SNAPSHOT_INTERVAL) + ")":<34} '
+              f'{report["stored_bytes"]:8d} bytes ({report["stored_bytes"] / report["full_bytes"]:.1%})')
+
+        # The revision just before a snapshot applies the most deltas
+        longest = [revision for revision in history if revision[1] % revisions.SNAPSHOT_INTERVAL ==
+                   revisions.SNAPSHOT_INTERVAL - 1]
+        start = time.perf_counter()
+
+        for title, number, markdown in longest:
+            assert revisions.get_revision(title, number) == markdown
+
+        print(f'{"rebuild longest delta chain":<34} {(time.perf_counter() - start) / len(longest) * 1000:8.3f} ms')
+
+        DB.get_instance().release_connection()
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
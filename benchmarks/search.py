@@ -0,0 +1,89 @@
+"""
+Measures full-text search latency, including ranking and snippets, on a generated wiki.
+
+Run from the repository root, with the same environment as the app:
+python benchmarks/search.py [pages] [words_per_page]
+"""
+import itertools
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+from db import DB, create_tables
+from search import RANKED_MATCH_LIMIT, search_pages
+
+VOCABULARY_SIZE = 20_000
+
+
+def populate(page_count: int, words_per_page: int, vocabulary: list):
+    rng = random.Random(0)
+
+    # Word frequencies follow a Zipf-like curve, as in real text, so common words match a large share of pages
+    cum_weights = list(itertools.accumulate(1 / rank for rank in range(1, len(vocabulary) + 1)))
+    rows = []
+
+    for i in range(page_count):
+        words = rng.choices(vocabulary, cum_weights=cum_weights, k=words_per_page)
+        rows.append((f'Page {i} {words[0]}', ' '.join(words), 'Jan 01, 2024 - 12:00 PM', 0, 'Benchmark', ''))
+
+    connection = DB.get_instance().get_connection()
+    connection.executemany('INSERT INTO pages (title, markdown, date, updated_at, editor, category) '
+                           'VALUES (?, ?, ?, ?, ?, ?)', rows)
+    connection.commit()
+
+
+def main(page_count: int = 100_000, words_per_page: int = 150):
+    rng = random.Random(1)
+    vocabulary = [''.join(rng.choices('abcdefghijklmnopqrstuvwxyz', k=rng.randint(3, 9))) for _ in
+                  range(VOCABULARY_SIZE)]
+
+    with tempfile.TemporaryDirectory() as folder:
+        db.DB_PATH = os.path.join(folder, 'data.db')
+        create_tables()
+
+        start = time.perf_counter()
+        populate(page_count, words_per_page, vocabulary)
+        print(f'{"insert and index pages":<36} {time.perf_counter() - start:8.3f} s')
+
+        # Picks words by the number of pages they appear in, including the most pages a ranked query can match
+        connection = DB.get_instance().get_connection()
+        connection.execute('CREATE VIRTUAL TABLE temp.pages_fts_terms USING fts5vocab(main, pages_fts, \'row\')')
+
+        def word_in(pages: int) -> str:
+            return connection.execute('SELECT term FROM temp.pages_fts_terms WHERE doc <= ? ORDER BY doc DESC LIMIT 1',
+                                      (pages,)).fetchone()[0]
+
+        queries = {
+            'word in every page': word_in(page_count),
+            f'word in {RANKED_MATCH_LIMIT} pages (ranked)': word_in(RANKED_MATCH_LIMIT),
+            'word in 500 pages': word_in(500),
+            'word in 10 pages': word_in(10),
+            'two words': f'{word_in(page_count // 2)} {word_in(RANKED_MATCH_LIMIT)}',
+            'word in every page, page 5': word_in(page_count),
+        }
+
+        for name, text in queries.items():
+            page = 5 if name.endswith('page 5') else 1
+            results, _ = search_pages(text, page)
+            timings = []
+
+            for _ in range(20):
+                start = time.perf_counter()
+                search_pages(text, page)
+                timings.append((time.perf_counter() - start) * 1000)
+
+            timings.sort()
+            print(f'{name:<36} {statistics.median(timings):8.3f} ms median, '
+                  f'{timings[int(len(timings) * 0.95) - 1]:8.3f} ms p95, {len(results)} results')
+
+        DB.get_instance().release_connection()
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
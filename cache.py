@@ -0,0 +1,279 @@
+import hashlib
+import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+log = logging.getLogger("cache")
+
+DEFAULT_MAX_BYTES = int(os.getenv('RENDER_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+DEFAULT_MAX_ENTRIES = int(os.getenv('RENDER_CACHE_MAX_ENTRIES', 1024))
+DEFAULT_TTL_SECONDS = int(os.getenv('USER_CACHE_TTL_SECONDS', 300))
+
+
+def content_version(*parts) -> str:
+    """
+    Computes a stable version string for the given page content.
+
+    :param parts: The values that the rendered output depends on.
+    :type parts: Union[str, list, tuple, None]
+
+    :return: A hex digest identifying this exact combination of values.
+    :rtype: str
+    """
+    digest = hashlib.sha1()
+
+    for part in parts:
+        if isinstance(part, (list, tuple)):
+            part = '\x1f'.join(str(item) for item in part)
+
+        digest.update(str(part).encode('utf-8'))
+        digest.update(b'\x1e')
+
+    return digest.hexdigest()
+
+
+def approximate_size(value) -> int:
+    """
+    Approximates the memory used by a value, including the strings nested in tuples and lists.
+
+    :param value: The value to measure.
+    :type value: Union[str, int, tuple, list]
+
+    :return: The approximate size, in bytes.
+    :rtype: int
+    """
+    size = sys.getsizeof(value)
+
+    if isinstance(value, (tuple, list)):
+        size += sum(approximate_size(item) for item in value)
+
+    return size
+
+
+class RenderCache:
+    """
+    Thread-safe LRU cache for rendered page HTML.
+
+    Entries are keyed by tuples whose first item is the page title, such as (title, version). The cache is bounded
+    both by entry count and by the approximate memory used by the cached values, evicting the least recently used
+    entries first.
+
+    Usage:
+    render_cache = RenderCache()
+    rendered = render_cache.get(key)
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES, max_entries: int = DEFAULT_MAX_ENTRIES):
+        """
+        Initializes a new instance of the RenderCache class.
+
+        :param max_bytes: The approximate memory cap for all cached values, in bytes.
+        :type max_bytes: int
+        :param max_entries: The maximum number of cached values.
+        :type max_entries: int
+        """
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+
+        self._entries = OrderedDict()
+        self._titles = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple):
+        """
+        Retrieves a cached value and marks it as recently used.
+
+        :param key: The key of the value, starting with the page title.
+        :type key: tuple
+
+        :return: The cached value, or None if it is not cached.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+            return entry[0]
+
+    def put(self, key: tuple, value):
+        """
+        Stores a value, evicting least recently used values until the cache fits its limits.
+
+        :param key: The key of the value, starting with the page title.
+        :type key: tuple
+        :param value: The rendered HTML to cache, as a string or a tuple or list of strings and nested tuples.
+        :type value: Union[str, tuple, list]
+
+        :return: None
+        """
+        size = approximate_size(value)
+
+        if size > self.max_bytes:
+            log.info(f'Rendered page "{key[0]}" is too large to cache ({size} bytes).')
+            return
+
+        with self._lock:
+            self._discard(key)
+
+            self._entries[key] = (value, size)
+            self._titles.setdefault(key[0], set()).add(key)
+            self._size += size
+
+            while self._size > self.max_bytes or len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._discard(oldest)
+
+    def invalidate(self, title: str):
+        """
+        Removes every cached value for a page, regardless of version.
+
+        :param title: The title of the page to invalidate.
+        :type title: str
+
+        :return: None
+        """
+        with self._lock:
+            for key in list(self._titles.get(title, ())):
+                self._discard(key)
+
+    def clear(self):
+        """
+        Removes every cached value.
+
+        :return: None
+        """
+        with self._lock:
+            self._entries.clear()
+            self._titles.clear()
+            self._size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self) -> int:
+        """
+        The approximate memory used by the cached values, in bytes.
+
+        :rtype: int
+        """
+        return self._size
+
+    def _discard(self, key: tuple):
+        entry = self._entries.pop(key, None)
+
+        if entry is None:
+            return
+
+        self._size -= entry[1]
+
+        keys = self._titles.get(key[0])
+        keys.discard(key)
+
+        if not keys:
+            del self._titles[key[0]]
+
+
+class TTLCache:
+    """
+    Thread-safe cache whose values expire a fixed time after they are stored.
+
+    The cache holds at most max_entries values, evicting the oldest first, so it stays small however many keys are
+    looked up.
+
+    Usage:
+    user_cache = TTLCache()
+    user = user_cache.get(email)
+    """
+
+    def __init__(self, ttl: float = DEFAULT_TTL_SECONDS, max_entries: int = DEFAULT_MAX_ENTRIES):
+        """
+        Initializes a new instance of the TTLCache class.
+
+        :param ttl: How long a value is served after it is stored, in seconds.
+        :type ttl: float
+        :param max_entries: The maximum number of cached values.
+        :type max_entries: int
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Retrieves a cached value, unless it has expired.
+
+        :param key: The key of the value.
+
+        :return: The cached value, or None if it is not cached or has expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None or entry[1] <= time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+
+            self.hits += 1
+
+            return entry[0]
+
+    def put(self, key, value):
+        """
+        Stores a value until it expires, evicting the oldest values if the cache is full.
+
+        :param key: The key of the value.
+        :param value: The value to cache.
+
+        :return: None
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """
+        Removes a cached value before it expires.
+
+        :param key: The key of the value.
+
+        :return: None
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        Removes every cached value.
+
+        :return: None
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,8 +1,20 @@
+import asyncio
+import contextvars
+import functools
+import hashlib
+import inspect
 import os
+import re
 import sqlite3
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
 from sqlite3 import Error
-from typing import List
+from typing import Iterator, List, Optional
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -18,12 +30,288 @@ logging.basicConfig(
 
 log = logging.getLogger("database")
 
+DB_PATH = 'data/data.db'
+
+# Maximum number of idle connections kept open for reuse
+POOL_SIZE = int(os.getenv('DB_POOL_SIZE') or 8)
+
+# How long a connection waits for another connection's lock before failing, in milliseconds
+BUSY_TIMEOUT_MS = int(os.getenv('DB_BUSY_TIMEOUT_MS') or 5000)
+
+# Number of prepared statements each connection keeps for reuse
+STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE') or 128)
+
+# Number of rows each Access.iterate batch fetches from SQLite
+FETCH_BATCH_SIZE = int(os.getenv('DB_FETCH_BATCH_SIZE') or 256)
+
+# Number of threads running AccessAsync calls, each with its own connection
+ASYNC_WORKERS = int(os.getenv('DB_ASYNC_WORKERS') or 4)
+
+# If TRUE, Access.select and Access.exists read from an in-memory copy of the database instead of the file
+READ_SNAPSHOT = os.getenv('DB_READ_SNAPSHOT') == 'TRUE'
+
+# How often the in-memory copy is checked for changes and refreshed, in seconds, or 0 to check before every read
+SNAPSHOT_REFRESH_SECONDS = float(os.getenv('DB_SNAPSHOT_REFRESH_SECONDS') or 0)
+
+# The tables that Access.select and Access.exists read from the in-memory copy, whose writes cause it to be refreshed
+SNAPSHOT_TABLES = ('users', 'pages', 'page_categories', 'page_revisions')
+
+# The columns of pages written by the render worker after every save. Writing them does not cause a refresh, so they
+# are read from the database file instead
+RENDER_COLUMNS = ('rendered_html', 'rendered_toc', 'content_hash')
+
+# If TRUE, every Access query is timed and its rows and SQL fingerprint are recorded, totalled for each request
+INSTRUMENT_QUERIES = os.getenv('DB_INSTRUMENT_QUERIES') == 'TRUE'
+
+# Instrumented queries taking at least this long are written to the slow query log, in milliseconds
+SLOW_QUERY_MS = float(os.getenv('DB_SLOW_QUERY_MS') or 100)
+
+# Replaced with ? in SQL fingerprints, so queries differing only in their values share a fingerprint. Parameters are
+# replaced too, since SQLite only fills in the values of statements short enough to trace in full
+FINGERPRINT_LITERALS = re.compile(r"'(?:[^']|'')*'|\bx'[0-9a-f]*'|\b\d+(?:\.\d+)?\b|:\w+", re.IGNORECASE)
+FINGERPRINT_SPACES = re.compile(r'\s+')
+
+# Statements that are not counted as the query itself, such as those run by DB.transaction and DB.commit
+UNTRACED_STATEMENTS = ('BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT', 'RELEASE', 'PRAGMA', '--')
+
+# Matches the statements the full-text search index runs on its own tables, such as 'main'.'pages_fts_config'
+SHADOW_TABLE_STATEMENT = re.compile(r"'main'\.'\w+'")
+
+slow_log = logging.getLogger("database.slow")
+
+if INSTRUMENT_QUERIES:
+    slow_handler = logging.FileHandler(os.getenv('ROOT_FOLDER') + 'logs/slow_queries.log')
+    slow_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    slow_log.addHandler(slow_handler)
+
+# The QueryStats of the request being handled, which instrumented queries add to
+current_query_stats: ContextVar[Optional['QueryStats']] = ContextVar('current_query_stats', default=None)
+
+# The first statements run by the instrumented call in progress, as reported by the connection's trace callback
+traced_statements: ContextVar[Optional[list]] = ContextVar('traced_statements', default=None)
+
+# Format of the display strings in the pages.date column, which predates pages.updated_at
+LEGACY_DATE_FORMAT = '%b %d, %Y - %I:%M %p'
+
+
+def fingerprint(statement: str) -> str:
+    """
+    Normalizes a SQL statement by replacing its values with ? and collapsing whitespace, so that every run of the same
+    query has the same fingerprint.
+
+    :param statement: The SQL statement, with or without its values filled in.
+    :type statement: str
+
+    :return: A short hash identifying the fingerprint, followed by the normalized SQL.
+    :rtype: str
+    """
+    normalized = FINGERPRINT_SPACES.sub(' ', FINGERPRINT_LITERALS.sub('?', statement)).strip()
+
+    return f'{hashlib.md5(normalized.encode("utf-8")).hexdigest()[:8]} {normalized}'
+
+
+def trace_statement(statement: str):
+    """
+    The trace callback of instrumented connections, which keeps the first two statements of the instrumented call in
+    progress for its fingerprint.
+
+    :param statement: The SQL statement SQLite is running, with its values filled in.
+    :type statement: str
+
+    :return: None
+    """
+    statements = traced_statements.get()
+
+    if statements is not None and len(statements) < 2 and not statement.startswith(UNTRACED_STATEMENTS) and \
+            not SHADOW_TABLE_STATEMENT.search(statement):
+        statements.append(statement)
+
+
+class QueryStats:
+    """
+    Totals of the instrumented queries made while handling one request, overall and for each SQL fingerprint.
+
+    Usage:
+    current_query_stats.set(QueryStats())
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.milliseconds = 0.0
+        self.rows = 0
+        self.connections_opened = 0
+        self.connection_milliseconds = 0.0
+
+        # The number of queries, total milliseconds and rows returned of each fingerprint
+        self.fingerprints = {}
+
+    def record(self, query_fingerprint: str, milliseconds: float, rows: int):
+        self.queries += 1
+        self.milliseconds += milliseconds
+        self.rows += rows
+
+        totals = self.fingerprints.setdefault(query_fingerprint, [0, 0.0, 0])
+        totals[0] += 1
+        totals[1] += milliseconds
+        totals[2] += rows
+
+    def record_connection(self, milliseconds: float):
+        self.connections_opened += 1
+        self.connection_milliseconds += milliseconds
+
+    def slowest(self, count: int = 3) -> List[tuple]:
+        """
+        Lists the fingerprints that took the most time in total.
+
+        :param count: The number of fingerprints to list.
+        :type count: int
+
+        :return: The fingerprint, number of queries, total milliseconds and rows of each, slowest first.
+        :rtype: List[tuple]
+        """
+        totals = sorted(self.fingerprints.items(), key=lambda item: item[1][1], reverse=True)
+
+        return [(query_fingerprint, *values) for query_fingerprint, values in totals[:count]]
+
+    def summary(self) -> str:
+        text = f'{self.queries} queries in {self.milliseconds:.2f} ms, {self.rows} rows'
+
+        if self.connections_opened:
+            text += (f', {self.connections_opened} connections opened in '
+                     f'{self.connection_milliseconds:.2f} ms')
+
+        if self.fingerprints:
+            query_fingerprint, queries, milliseconds, _ = self.slowest(1)[0]
+            text += f'; slowest {queries} x {milliseconds:.2f} ms: {query_fingerprint}'
+
+        return text
+
+    def server_timing(self) -> str:
+        """
+        Formats the totals as a Server-Timing header, which browser developer tools show alongside the request.
+
+        :return: The header value.
+        :rtype: str
+        """
+        return (f'db;dur={self.milliseconds:.2f};desc="{self.queries} queries", '
+                f'db-connect;dur={self.connection_milliseconds:.2f};desc="{self.connections_opened} opened"')
+
+
+def record_query(name: str, statements: list, milliseconds: float, rows: int):
+    """
+    Adds an instrumented call to the current request's QueryStats, and to the slow query log if it took at least
+    SLOW_QUERY_MS.
+
+    :param name: The name of the instrumented function, used as the fingerprint if it ran several different queries.
+    :type name: str
+    :param statements: The first statements the call ran.
+    :type statements: list
+    :param milliseconds: How long the call took.
+    :type milliseconds: float
+    :param rows: The number of rows the call returned.
+    :type rows: int
+
+    :return: None
+    """
+    fingerprints = {fingerprint(statement) for statement in statements}
+    query_fingerprint = fingerprints.pop() if len(fingerprints) == 1 else name
+
+    stats = current_query_stats.get()
+
+    if stats is not None:
+        stats.record(query_fingerprint, milliseconds, rows)
+
+    if milliseconds >= SLOW_QUERY_MS:
+        slow_log.warning(f'Slow query: {milliseconds:.2f} ms, {rows} rows, {name}: {query_fingerprint}')
+
+
+def instrumented(func):
+    """
+    Decorator that times each call of a database function and records its rows returned and SQL fingerprint with
+    record_query, if INSTRUMENT_QUERIES is set. Otherwise, it only adds a check of INSTRUMENT_QUERIES to each call.
+
+    Calls made by another instrumented call, such as the queries of create_tables, are counted as part of it. The
+    rows yielded by a generator are counted as it is consumed, and only the time spent producing them is timed.
+
+    :param func: The function to instrument.
+    :type func: Callable
+
+    :return: The instrumented function.
+    :rtype: Callable
+    """
+    name = func.__qualname__
+
+    def rows_returned(result) -> int:
+        if isinstance(result, list):
+            return len(result)
+
+        return int(result) if isinstance(result, bool) else 0
+
+    if inspect.isgeneratorfunction(func):
+        def instrumented_rows(rows: Iterator, statements: list) -> Iterator:
+            milliseconds = 0.0
+            count = 0
+
+            try:
+                while True:
+                    token = traced_statements.set(statements)
+                    start = time.perf_counter()
+
+                    try:
+                        row = next(rows)
+                    except StopIteration:
+                        break
+                    finally:
+                        milliseconds += (time.perf_counter() - start) * 1000
+                        traced_statements.reset(token)
+
+                    count += 1
+                    yield row
+            finally:
+                rows.close()
+                record_query(name, statements, milliseconds, count)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not INSTRUMENT_QUERIES or traced_statements.get() is not None:
+                return func(*args, **kwargs)
+
+            return instrumented_rows(func(*args, **kwargs), [])
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not INSTRUMENT_QUERIES or traced_statements.get() is not None:
+                return func(*args, **kwargs)
+
+            statements = []
+            token = traced_statements.set(statements)
+            start = time.perf_counter()
+
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                milliseconds = (time.perf_counter() - start) * 1000
+                traced_statements.reset(token)
+
+            record_query(name, statements, milliseconds, rows_returned(result))
+
+            return result
+
+    return wrapper
+
 
 class DB:
     """
-    Singleton class for managing a SQLite database connection.
+    Singleton class for managing SQLite database connections.
 
-    This class ensures that only one instance of the database connection is created.
+    Each thread uses its own connection, taken from a bounded pool of idle connections when one is available. A
+    thread keeps its connection until release_connection is called, such as at the end of a request, which returns it
+    to the pool, or closes it if the pool is already full. Cursors still open for Access.iterate are closed first, so
+    an unfinished iterator can never read through a connection another thread has taken from the pool.
+
+    If READ_SNAPSHOT is set, reads outside of transactions use get_read_connection instead, which reads from a copy of
+    the database in memory. Each refresh copies the file into a new in-memory database with the backup API, and
+    readers move to it once they finish with the previous one, so a refresh never blocks or is blocked by a reader.
 
     Usage:
     db_instance = DB.get_instance()
@@ -40,14 +328,22 @@ class DB:
         """
         if cls.__instance is None:
             cls.__instance = super(DB, cls).__new__(cls)
-            cls.__instance.connection = None
-
-            try:
-                # Attempt to connect to the SQLite database
-                cls.__instance.connection = sqlite3.connect(f'data/data.db')
-                log.info('Connection to SQLite DB successful')
-            except Error as e:
-                log.info(f'The error "{e}" occurred')
+            cls.__instance.local = threading.local()
+            cls.__instance.idle_connections = []
+            cls.__instance.lock = threading.Lock()
+
+            # Number of connections opened, and number of times an open connection was handed out again
+            cls.__instance.opened = 0
+            cls.__instance.reused = 0
+
+            # The current in-memory copy of the database, numbered by generation, and idle connections to it
+            cls.__instance.snapshot_lock = threading.Lock()
+            cls.__instance.snapshot_generation = 0
+            cls.__instance.snapshot_anchor = None
+            cls.__instance.snapshot_source = None
+            cls.__instance.snapshot_data_version = None
+            cls.__instance.snapshot_changes = None
+            cls.__instance.idle_read_connections = []
 
         return cls.__instance
 
@@ -69,6 +365,9 @@ class DB:
         """
         Static method to create a SQLite database connection.
 
+        Connections use write-ahead logging, so readers do not block the writer, and wait for locks held by other
+        connections instead of failing immediately.
+
         :param path: The path to the SQLite database file.
         :type path: str
 
@@ -78,37 +377,363 @@ class DB:
         connection = None
 
         try:
-            # Attempt to connect to the SQLite database
-            connection = sqlite3.connect(path)
-            log.info('Connection to SQLite DB successful')
+            # Pooled connections are handed between threads, but only ever used by one thread at a time
+            connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False,
+                                         cached_statements=STATEMENT_CACHE_SIZE)
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+            connection.execute('PRAGMA synchronous = NORMAL')
+            connection.execute('PRAGMA foreign_keys = ON')
+
+            if INSTRUMENT_QUERIES:
+                connection.set_trace_callback(trace_statement)
         except Error as e:
             log.info(f'The error "{e}" occurred')
 
         return connection
 
-    def get_connection(self, reset=True):
+    def get_connection(self):
         """
-        Retrieves the existing SQLite database connection or creates a new one if needed.
+        Retrieves the calling thread's SQLite database connection, reusing an idle one or opening one if needed.
+
+        :return: The SQLite database connection.
+        :rtype: sqlite3.Connection or None
+        """
+        connection = getattr(self.local, 'connection', None)
+
+        with self.lock:
+            if connection is None and self.idle_connections:
+                connection = self.idle_connections.pop()
+
+            if connection is not None:
+                self.reused += 1
+
+        if connection is None:
+            start = time.perf_counter()
+            connection = self.create_connection(DB_PATH)
+
+            if connection is None:
+                return None
+
+            milliseconds = (time.perf_counter() - start) * 1000
+
+            with self.lock:
+                self.opened += 1
+
+            log.info(f'Connection to SQLite DB successful in {milliseconds:.2f} ms '
+                     f'({self.opened} opened, {self.reused} reused)')
+
+            stats = current_query_stats.get()
+
+            if stats is not None:
+                stats.record_connection(milliseconds)
 
-        :param reset: If set to True, forces the creation of a new connection.
-        :type reset: bool or None
+        if getattr(self.local, 'connection', None) is not connection:
+            self.local.connection = connection
+            self.local.cursors = set()
+
+        return connection
+
+    @staticmethod
+    def snapshot_uri(generation: int) -> str:
+        return f'file:snapshot_{os.getpid()}_{generation}?mode=memory&cache=shared'
+
+    def snapshot_outdated(self) -> bool:
+        """
+        Checks whether a table read from the snapshot has changed since it was copied, including in other processes.
+        Must be called with the snapshot lock held.
+
+        The data version of the source connection, which never writes, changes with every commit to the database
+        file, and checking it does not read the file. Only when it has changed is the counter kept by the triggers
+        on those tables read, so writes to other tables, such as page leases, never cause a refresh.
+
+        :return: True if the snapshot needs to be refreshed, False otherwise.
+        :rtype: bool
+        """
+        data_version = self.snapshot_source.execute('PRAGMA data_version').fetchone()[0]
+
+        if data_version == self.snapshot_data_version:
+            return False
+
+        self.snapshot_data_version = data_version
+
+        return self.read_snapshot_changes() != self.snapshot_changes
+
+    def read_snapshot_changes(self) -> int:
+        select = self.snapshot_source.execute('SELECT value FROM counters WHERE name = \'changes\'').fetchone()
+
+        return select[0] if select else 0
+
+    def refresh_snapshot(self, if_outdated: bool = False):
+        """
+        Copies the database file into a new in-memory snapshot, which new reads use from then on.
+
+        :param if_outdated: Only refresh the snapshot if a table read from it has changed since it was copied.
+        :type if_outdated: bool
+
+        :return: None
+        """
+        with self.snapshot_lock:
+            start = time.perf_counter()
+
+            if self.snapshot_source is None:
+                self.snapshot_source = self.create_connection(DB_PATH)
+
+                if SNAPSHOT_REFRESH_SECONDS > 0:
+                    threading.Thread(target=self.refresh_snapshot_periodically, name='db_snapshot', daemon=True).start()
+            elif if_outdated and not self.snapshot_outdated():
+                return
+
+            generation = self.snapshot_generation + 1
+
+            # The in-memory database exists for as long as a connection to it is open, so the anchor keeps it alive.
+            # The versions are read before copying, so a commit made during the copy causes another refresh.
+            anchor = sqlite3.connect(self.snapshot_uri(generation), uri=True, check_same_thread=False)
+            self.snapshot_data_version = self.snapshot_source.execute('PRAGMA data_version').fetchone()[0]
+            self.snapshot_changes = self.read_snapshot_changes()
+            self.snapshot_source.backup(anchor)
+
+            previous, self.snapshot_anchor = self.snapshot_anchor, anchor
+            self.snapshot_generation = generation
+
+            if previous is not None:
+                previous.close()
+
+        log.info(f'Refreshed the in-memory database snapshot in {(time.perf_counter() - start) * 1000:.1f} ms.')
+
+    def refresh_snapshot_periodically(self):
+        """
+        Refreshes the snapshot every SNAPSHOT_REFRESH_SECONDS if a table read from it has changed, including changes
+        made by other processes.
+
+        :return: None
+        """
+        while True:
+            time.sleep(SNAPSHOT_REFRESH_SECONDS)
+
+            try:
+                self.refresh_snapshot(if_outdated=True)
+            except Error as e:
+                log.info(f'Error refreshing the in-memory database snapshot: {e}')
+
+    def recheck_snapshot(self):
+        """
+        Makes the calling thread's next read check whether the snapshot needs to be refreshed.
+
+        :return: None
+        """
+        self.local.snapshot_checked = False
+
+    def get_read_connection(self):
+        """
+        Retrieves a connection for reads. With READ_SNAPSHOT set, it reads from the current in-memory snapshot, unless
+        the calling thread is in a transaction, which must see its own uncommitted writes.
+
+        Unless the snapshot is refreshed periodically, it is first refreshed if a table read from it has changed since
+        it was copied. A thread checks once until it commits a write or releases its connection, so a request sees
+        its own writes but only pays for the check on its first read.
 
         :return: The SQLite database connection.
         :rtype: sqlite3.Connection or None
         """
-        if reset is not None or self.connection is None:
-            self.__instance.connection = None
-            self.__instance.connection = self.create_connection(f'data/data.db')
-            return self.__instance.connection
-        else:
-            return self.__instance.connection
+        connection = getattr(self.local, 'connection', None)
+
+        if not READ_SNAPSHOT or (connection is not None and connection.in_transaction):
+            return self.get_connection()
+
+        if not self.snapshot_generation:
+            self.refresh_snapshot()
+        elif SNAPSHOT_REFRESH_SECONDS <= 0 and not getattr(self.local, 'snapshot_checked', False):
+            self.refresh_snapshot(if_outdated=True)
+
+        self.local.snapshot_checked = True
+
+        generation = self.snapshot_generation
+        read_connection = getattr(self.local, 'read_connection', None)
+
+        if read_connection is not None and read_connection[0] == generation:
+            return read_connection[1]
+
+        if read_connection is not None:
+            read_connection[1].close()
+
+        with self.lock:
+            while self.idle_read_connections:
+                idle = self.idle_read_connections.pop()
+
+                if idle[0] == generation:
+                    read_connection = idle
+                    break
+
+                idle[1].close()
+            else:
+                read_connection = None
+
+        if read_connection is None:
+            # Connecting to a snapshot whose anchor has just been closed would create an empty database, so connect to
+            # the current one while no refresh can replace it
+            with self.snapshot_lock:
+                generation = self.snapshot_generation
+                read_connection = (generation, sqlite3.connect(self.snapshot_uri(generation), uri=True,
+                                                               check_same_thread=False,
+                                                               cached_statements=STATEMENT_CACHE_SIZE))
+
+            if INSTRUMENT_QUERIES:
+                read_connection[1].set_trace_callback(trace_statement)
+
+        self.local.read_connection = read_connection
+
+        return read_connection[1]
+
+    def open_cursor(self):
+        """
+        Opens a cursor on the calling thread's connection that is closed when the connection is released.
+
+        :return: The cursor.
+        :rtype: sqlite3.Cursor
+        """
+        cursor = self.get_connection().cursor()
+        self.local.cursors.add(cursor)
+
+        return cursor
+
+    def close_cursor(self, cursor):
+        """
+        Closes a cursor opened by open_cursor.
+
+        :param cursor: The cursor to close.
+        :type cursor: sqlite3.Cursor
+
+        :return: None
+        """
+        cursor.close()
+        getattr(self.local, 'cursors', set()).discard(cursor)
+
+    def release_connection(self):
+        """
+        Returns the calling thread's connection to the pool of idle connections, or closes it if the pool is full.
+
+        :return: None
+        """
+        self.recheck_snapshot()
+        read_connection = getattr(self.local, 'read_connection', None)
+
+        if read_connection is not None:
+            self.local.read_connection = None
+
+            with self.lock:
+                if read_connection[0] == self.snapshot_generation and len(self.idle_read_connections) < POOL_SIZE:
+                    self.idle_read_connections.append(read_connection)
+                    read_connection = None
+
+            if read_connection is not None:
+                read_connection[1].close()
+
+        connection = getattr(self.local, 'connection', None)
+
+        if connection is None:
+            return
+
+        self.local.connection = None
+
+        for cursor in self.local.cursors:
+            cursor.close()
+
+        self.local.cursors = set()
+        self.local.transaction_depth = 0
+
+        # Never hand uncommitted changes to the next thread
+        if connection.in_transaction:
+            connection.rollback()
+
+        with self.lock:
+            if len(self.idle_connections) < POOL_SIZE:
+                self.idle_connections.append(connection)
+                return
+
+        connection.close()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Groups every write made on the calling thread's connection inside the block into a single commit.
+
+        The transaction takes the write lock when it starts, so its reads and writes are not interleaved with another
+        connection's writes. If the block raises, every write in it is rolled back. A transaction started inside
+        another joins it, and its writes are committed or rolled back with the outermost one.
+
+        Usage:
+        with DB.get_instance().transaction():
+            Access('pages').update(...)
+
+        :return: A context manager yielding the connection.
+        :rtype: ContextManager[sqlite3.Connection]
+        """
+        connection = self.get_connection()
+        depth = getattr(self.local, 'transaction_depth', 0)
+
+        if depth == 0 and not connection.in_transaction:
+            connection.execute('BEGIN IMMEDIATE')
+
+        self.local.transaction_depth = depth + 1
+
+        try:
+            yield connection
+        except BaseException:
+            self.local.transaction_depth = depth
+
+            if depth == 0:
+                connection.rollback()
+
+            raise
+
+        self.local.transaction_depth = depth
+
+        if depth == 0:
+            connection.commit()
+            self.recheck_snapshot()
+
+    def in_transaction(self) -> bool:
+        """
+        Checks whether the calling thread is inside a block started by transaction.
+
+        :return: True if a transaction is open, False otherwise.
+        :rtype: bool
+        """
+        return getattr(self.local, 'transaction_depth', 0) > 0
+
+    def commit(self):
+        """
+        Commits the calling thread's writes, unless they are part of a transaction that has not finished yet.
+
+        :return: None
+        """
+        if getattr(self.local, 'transaction_depth', 0) == 0:
+            self.get_connection().commit()
+            self.recheck_snapshot()
+
+    def checkpoint(self):
+        """
+        Copies every change in the write-ahead log into the database file, so the file can be copied on its own.
+
+        :return: None
+        """
+        try:
+            self.get_connection().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        except Error as e:
+            log.info(f'Error checkpointing database: {e}')
 
 
-# TODO: Sanitize User Input
 class Access:
     """
     Class for handling basic CRUD operations on a SQLite database table.
 
+    Rows are filtered with a where dictionary of column names and values, such as where={'title': page}. The values
+    are bound as parameters, so the SQL text only depends on the columns and is reused from the statement cache.
+
+    A failed write is logged and ignored, except inside Access.transaction, where it is raised so that the
+    transaction rolls back every write made in it.
+
     Usage:
     access_instance = Access('table_name')
     """
@@ -122,6 +747,7 @@ class Access:
         """
         self.table = table
 
+    @instrumented
     def insert(self, columns, values):
         """
         Inserts a new row into the database table.
@@ -141,46 +767,198 @@ class Access:
 
         try:
             conn.execute(query, params)
-            conn.commit()
+            DB.get_instance().commit()
             log.info('Data inserted successfully!')
         except Exception as e:
             log.info(f'Error inserting data: {e}')
 
-    def select(self, columns=None, condition=None) -> List[list]:
+            if DB.get_instance().in_transaction():
+                raise
+
+    @instrumented
+    def bulk_insert(self, columns, rows):
         """
-        Retrieves data from the database table based on specified columns and conditions.
+        Inserts many rows into the database table with a single statement and a single commit.
 
-        :param columns: The list of column names to retrieve. If None, retrieves all columns.
-        :type columns: Optional[List[str]]
-        :param condition: The condition to filter rows. If None, retrieves all rows.
-        :type condition: Optional[str]
+        :param columns: The list of column names to insert data into.
+        :type columns: List[str]
+        :param rows: The values of each row, in the same order as the columns.
+        :type rows: Iterable[List[Union[str, int, float, None]]]
 
-        :return: A list of rows matching the query.
-        :rtype: List[list]
+        :return: None
         """
         conn = DB.get_instance().get_connection()
-        cursor = conn.cursor()
 
+        query = f'INSERT INTO {self.table} ({", ".join(columns)}) VALUES ({", ".join([":param_" + str(i) for i in range(len(columns))])})'
+
+        params = ({f'param_{i}': value for i, value in enumerate(values)} for values in rows)
+
+        try:
+            cursor = conn.executemany(query, params)
+            DB.get_instance().commit()
+            log.info(f'{cursor.rowcount} rows inserted successfully!')
+        except Exception as e:
+            log.info(f'Error inserting data: {e}')
+
+            if DB.get_instance().in_transaction():
+                raise
+
+    @staticmethod
+    def transaction():
+        """
+        Groups the writes made by every Access inside the block into a single commit. See DB.transaction.
+
+        Usage:
+        with Access.transaction():
+            Access('pages').update(...)
+            Access('page_categories').bulk_insert(...)
+
+        :return: A context manager yielding the connection.
+        :rtype: ContextManager[sqlite3.Connection]
+        """
+        return DB.get_instance().transaction()
+
+    @staticmethod
+    def where_clause(where=None, condition=None):
+        """
+        Builds a WHERE clause that matches every column in where to its value, using bound parameters.
+
+        :param where: The column names and the values they must equal.
+        :type where: Optional[Dict[str, Union[str, int, float, None]]]
+        :param condition: A raw SQL condition, combined with where. It must never contain user input.
+        :type condition: Optional[str]
+
+        :return: The clause, starting with ' WHERE ' or empty if there is nothing to filter by, and its parameters.
+        :rtype: tuple
+        """
+        conditions = []
+        params = {}
+
+        for i, (column, value) in enumerate((where or {}).items()):
+            conditions.append(f'{column} = :where_{i}')
+            params[f'where_{i}'] = value
+
+        if condition:
+            conditions.append(f'({condition})')
+
+        if not conditions:
+            return '', params
+
+        return ' WHERE ' + ' AND '.join(conditions), params
+
+    def select_query(self, columns=None, where=None, condition=None, order_by=None, limit=None) -> tuple:
+        """
+        Builds the SELECT statement used by select and iterate.
+
+        :return: The SQL text and its parameters.
+        :rtype: tuple
+        """
         if columns:
             columns_str = ', '.join(columns)
         else:
             columns_str = '*'
 
-        query = f'SELECT {columns_str} FROM {self.table}'
+        where_str, params = self.where_clause(where, condition)
 
-        if condition:
-            query += f' WHERE {condition}'
+        query = f'SELECT {columns_str} FROM {self.table}{where_str}'
+
+        if order_by:
+            query += f' ORDER BY {order_by}'
+
+        if limit is not None:
+            query += ' LIMIT :limit'
+            params['limit'] = limit
+
+        return query, params
+
+    @instrumented
+    def select(self, columns=None, where=None, condition=None, order_by=None, limit=None,
+               snapshot=True) -> List[list]:
+        """
+        Retrieves data from the database table based on specified columns and conditions.
+
+        :param columns: The list of column names to retrieve. If None, retrieves all columns.
+        :type columns: Optional[List[str]]
+        :param where: The column values to filter rows by. If None, retrieves all rows.
+        :type where: Optional[Dict[str, Union[str, int, float, None]]]
+        :param condition: A raw SQL condition to filter rows by. It must never contain user input.
+        :type condition: Optional[str]
+        :param order_by: A raw SQL ORDER BY expression, such as 'updated_at DESC'. It must never contain user input.
+        :type order_by: Optional[str]
+        :param limit: The maximum number of rows to retrieve. If None, retrieves every matching row.
+        :type limit: Optional[int]
+        :param snapshot: Whether the rows may be read from the in-memory snapshot. Set it to False to read columns
+            whose writes do not refresh the snapshot, such as RENDER_COLUMNS, from the database file.
+        :type snapshot: bool
+
+        :return: A list of rows matching the query.
+        :rtype: List[list]
+        """
+        conn = DB.get_instance().get_read_connection() if snapshot else DB.get_instance().get_connection()
+        cursor = conn.cursor()
+
+        query, params = self.select_query(columns, where, condition, order_by, limit)
 
         try:
-            cursor.execute(query)
-            conn.commit()
+            cursor.execute(query, params)
             rows = cursor.fetchall()
             return rows
 
         except sqlite3.Error as e:
             log.info(f'Error selecting data: {e}')
 
-    def update(self, update_columns, new_values, condition):
+    @instrumented
+    def iterate(self, columns=None, where=None, condition=None, order_by=None, limit=None,
+                batch_size=FETCH_BATCH_SIZE) -> Iterator[tuple]:
+        """
+        Yields the rows matching the query without loading them all into memory, fetching batch_size rows at a time.
+
+        The iterator reads through the calling thread's connection, so it must be used on that thread and finished
+        before the connection is released, such as within the request that created it. An iterator that is still
+        unfinished when the connection is released stops with sqlite3.ProgrammingError. Unlike select, errors are
+        raised rather than logged, so a caller never mistakes a failed read for the end of the rows.
+
+        :param columns: The list of column names to retrieve. If None, retrieves all columns.
+        :type columns: Optional[List[str]]
+        :param where: The column values to filter rows by. If None, retrieves all rows.
+        :type where: Optional[Dict[str, Union[str, int, float, None]]]
+        :param condition: A raw SQL condition to filter rows by. It must never contain user input.
+        :type condition: Optional[str]
+        :param order_by: A raw SQL ORDER BY expression, such as 'updated_at DESC'. It must never contain user input.
+        :type order_by: Optional[str]
+        :param limit: The maximum number of rows to retrieve. If None, retrieves every matching row.
+        :type limit: Optional[int]
+        :param batch_size: The number of rows to fetch from SQLite at a time.
+        :type batch_size: int
+
+        :return: An iterator over the rows matching the query.
+        :rtype: Iterator[tuple]
+        """
+        db = DB.get_instance()
+        cursor = db.open_cursor()
+
+        query, params = self.select_query(columns, where, condition, order_by, limit)
+
+        try:
+            cursor.execute(query, params)
+
+            while True:
+                rows = cursor.fetchmany(batch_size)
+
+                if not rows:
+                    break
+
+                yield from rows
+
+        except sqlite3.Error as e:
+            log.info(f'Error iterating over data: {e}')
+            raise
+
+        finally:
+            db.close_cursor(cursor)
+
+    @instrumented
+    def update(self, update_columns, new_values, where=None, condition=None):
         """
         Updates rows in the database table based on a specified condition.
 
@@ -188,8 +966,10 @@ class Access:
         :type update_columns: List[str]
         :param new_values: The list of new values corresponding to the update columns.
         :type new_values: List[Union[str, int, float, None]]
-        :param condition: The condition to filter rows for the update.
-        :type condition: str
+        :param where: The column values to filter rows by.
+        :type where: Optional[Dict[str, Union[str, int, float, None]]]
+        :param condition: A raw SQL condition to filter rows by. It must never contain user input.
+        :type condition: Optional[str]
 
         :return: None
         """
@@ -197,38 +977,89 @@ class Access:
 
         set_clause = ', '.join([f'{col} = :param_{i}' for i, col in enumerate(update_columns)])
 
-        query = f'UPDATE {self.table} SET {set_clause} WHERE {condition}'
+        where_str, params = self.where_clause(where, condition)
+
+        query = f'UPDATE {self.table} SET {set_clause}{where_str}'
 
-        params = {f'param_{i}': value for i, value in enumerate(new_values)}
+        params.update({f'param_{i}': value for i, value in enumerate(new_values)})
 
         try:
             conn.execute(query, params)
-            conn.commit()
+            DB.get_instance().commit()
             log.info('Data updated successfully!')
         except Exception as e:
             log.info(f'Error updating data: {e}')
 
-    def delete(self, condition):
+            if DB.get_instance().in_transaction():
+                raise
+
+    @instrumented
+    def bulk_update(self, update_columns, where_columns, rows):
+        """
+        Updates many rows in the database table with a single statement and a single commit.
+
+        :param update_columns: The list of column names to update.
+        :type update_columns: List[str]
+        :param where_columns: The list of column names that identify the row to update.
+        :type where_columns: List[str]
+        :param rows: The new values of each row followed by the values of its where columns, such as
+                     (markdown, title) for update_columns=['markdown'] and where_columns=['title'].
+        :type rows: Iterable[List[Union[str, int, float, None]]]
+
+        :return: None
+        """
+        conn = DB.get_instance().get_connection()
+
+        set_clause = ', '.join([f'{col} = :param_{i}' for i, col in enumerate(update_columns)])
+        where_str = ' AND '.join([f'{col} = :where_{i}' for i, col in enumerate(where_columns)])
+
+        query = f'UPDATE {self.table} SET {set_clause} WHERE {where_str}'
+
+        def params(values):
+            row = {f'param_{i}': value for i, value in enumerate(values[:len(update_columns)])}
+            row.update({f'where_{i}': value for i, value in enumerate(values[len(update_columns):])})
+            return row
+
+        try:
+            cursor = conn.executemany(query, (params(values) for values in rows))
+            DB.get_instance().commit()
+            log.info(f'{cursor.rowcount} rows updated successfully!')
+        except Exception as e:
+            log.info(f'Error updating data: {e}')
+
+            if DB.get_instance().in_transaction():
+                raise
+
+    @instrumented
+    def delete(self, where=None, condition=None):
         """
         Deletes rows from the database table based on a specified condition.
 
-        :param condition: The condition to filter rows for deletion.
-        :type condition: str
+        :param where: The column values to filter rows by.
+        :type where: Optional[Dict[str, Union[str, int, float, None]]]
+        :param condition: A raw SQL condition to filter rows by. It must never contain user input.
+        :type condition: Optional[str]
 
         :return: None
         """
         conn = DB.get_instance().get_connection()
         cursor = conn.cursor()
 
-        query = f'DELETE FROM {self.table} WHERE {condition}'
+        where_str, params = self.where_clause(where, condition)
+
+        query = f'DELETE FROM {self.table}{where_str}'
 
         try:
-            cursor.execute(query)
-            conn.commit()
+            cursor.execute(query, params)
+            DB.get_instance().commit()
 
         except sqlite3.Error as e:
             log.info(f'Error deleting data: {e}')
 
+            if DB.get_instance().in_transaction():
+                raise
+
+    @instrumented
     def exists(self, column: str, value: str):
         """
         Checks if a value exists in a specific column of the database table.
@@ -241,7 +1072,7 @@ class Access:
         :return: True if the value exists, False otherwise.
         :rtype: bool
         """
-        conn = DB.get_instance().get_connection()
+        conn = DB.get_instance().get_read_connection()
 
         query = f'SELECT COUNT(1) FROM {self.table} WHERE {column} = :param_value'
 
@@ -251,7 +1082,6 @@ class Access:
         try:
             cursor = conn.cursor()
             cursor.execute(query, params)
-            conn.commit()
 
             if cursor.fetchone()[0] == 1:
                 return True
@@ -262,19 +1092,298 @@ class Access:
             return False
 
 
+class AccessAsync:
+    """
+    Runs database work from async code, such as presence connections served on the event loop.
+
+    Every call is queued to a pool of DB_ASYNC_WORKERS database threads and awaited, so the event loop is never
+    blocked by SQLite. Each database thread keeps one connection for its whole life, so reads run side by side and
+    writes wait for each other's locks as they do from the synchronous Access class.
+
+    Usage:
+    rows = await AccessAsync.run(Access('pages').select, ['title'], where={'title': page})
+    """
+
+    executor = None
+    executor_lock = threading.Lock()
+
+    @classmethod
+    def get_executor(cls) -> ThreadPoolExecutor:
+        """
+        Retrieves the executor of the database threads, starting it on first use.
+
+        :return: The executor, which runs up to ASYNC_WORKERS calls at a time in the order they were queued.
+        :rtype: ThreadPoolExecutor
+        """
+        with cls.executor_lock:
+            if cls.executor is None:
+                cls.executor = ThreadPoolExecutor(max_workers=ASYNC_WORKERS, thread_name_prefix='db')
+
+            return cls.executor
+
+    @classmethod
+    async def run(cls, func, *args, **kwargs):
+        """
+        Runs a synchronous function on a database thread and awaits its result.
+
+        The whole function runs on one thread and its connection, so a function that makes several reads and writes
+        can use Access.transaction to keep them from interleaving with other calls' writes.
+
+        Usage:
+        await AccessAsync.run(set_page_categories, title, category)
+
+        :param func: The function to run. It can use the synchronous Access and DB APIs.
+        :type func: Callable
+
+        :return: The function's return value.
+        """
+        loop = asyncio.get_running_loop()
+
+        # Runs in a copy of the caller's context, so the queries are added to the caller's QueryStats
+        context = contextvars.copy_context()
+
+        return await loop.run_in_executor(cls.get_executor(), functools.partial(context.run, cls.call, func, *args,
+                                                                                **kwargs))
+
+    @staticmethod
+    def call(func, *args, **kwargs):
+        """
+        Runs a function on the calling database thread. Each call is a unit of work, like a request, so its first read
+        checks whether the snapshot needs to be refreshed.
+        """
+        DB.get_instance().recheck_snapshot()
+
+        return func(*args, **kwargs)
+
+
+def parse_legacy_date(date: str) -> int:
+    """
+    Converts an edit time stored as a display string, such as 'Mar 18, 2024 - 04:32 PM', to epoch seconds.
+
+    :param date: The display string, in local time.
+    :type date: str
+
+    :return: The edit time in seconds since the epoch, or 0 if the string cannot be parsed.
+    :rtype: int
+    """
+    try:
+        return int(datetime.strptime(date, LEGACY_DATE_FORMAT).timestamp())
+    except (TypeError, ValueError):
+        return 0
+
+
+def split_categories(category: str) -> List[str]:
+    """
+    Splits a page's comma-separated category string into its categories.
+
+    :param category: The category string, such as 'History, Art'.
+    :type category: str
+
+    :return: The distinct categories in the order they were listed, or [''] if the page is uncategorized.
+    :rtype: List[str]
+    """
+    categories = dict.fromkeys(item.strip() for item in (category or '').split(','))
+    categories.pop('', None)
+
+    return list(categories) or ['']
+
+
+def set_page_categories(title: str, category: str):
+    """
+    Replaces the rows of a page in the page_categories table with the categories in its category string.
+
+    :param title: The title of the page.
+    :type title: str
+    :param category: The category string of the page.
+    :type category: str
+
+    :return: None
+    """
+    with Access.transaction():
+        select = Access('pages').select(['page_id'], where={'title': title})
+
+        if not select:
+            return
+
+        access = Access('page_categories')
+        access.delete(where={'page_id': select[0][0]})
+        access.bulk_insert(['page_id', 'category'], [[select[0][0], item] for item in split_categories(category)])
+
+
+def get_title_generation() -> int:
+    """
+    Retrieves the title generation, which goes up whenever a page is created, renamed or deleted by any process.
+
+    :return: The generation of the latest title change, or 0 if there is none.
+    :rtype: int
+    """
+    select = Access('title_changes').select(['generation'], order_by='generation DESC', limit=1)
+
+    return select[0][0] if select else 0
+
+
+def get_title_changes(generation: int) -> List[list]:
+    """
+    Retrieves the title changes made after a generation, oldest first, so a copy of the titles loaded at that
+    generation can be brought up to date by replaying them.
+
+    :param generation: The generation the titles were last brought up to.
+    :type generation: int
+
+    :return: The generation, old title and new title of each change. The old title is None for a created page and the
+             new title is None for a deleted one.
+    :rtype: List[list]
+    """
+    return Access('title_changes').select(['generation', 'old_title', 'new_title'],
+                                          condition=f'generation > {int(generation)}', order_by='generation')
+
+
+@instrumented
 def create_tables():
     USER_TABLE: str = (
         'create table IF NOT EXISTS users (user_id INTEGER PRIMARY KEY AUTOINCREMENT, email TEXT not null, '
-        'password TEXT not null, firstName TEXT not null, lastName TEXT not null)')
+        'password TEXT not null, firstName TEXT not null, lastName TEXT not null, role TEXT NOT NULL DEFAULT \'viewer\')')
     PAGE_TABLE: str = (
         'create table IF NOT EXISTS pages (page_id INTEGER PRIMARY KEY AUTOINCREMENT, title TEXT not null UNIQUE, '
         'markdown TEXT not null, date DATE not null, editor TEXT not null, category TEXT not null)')
 
-    conn = DB.get_instance().get_connection()
+    # One row per category of each page, with uncategorized pages under '', kept in sync by set_page_categories
+    PAGE_CATEGORY_TABLE: str = (
+        'CREATE TABLE IF NOT EXISTS page_categories (page_id INTEGER NOT NULL REFERENCES pages (page_id) '
+        'ON DELETE CASCADE, category TEXT NOT NULL, PRIMARY KEY (category, page_id)) WITHOUT ROWID')
+    # Full-text index over page titles and markdown, read from the pages table and kept in sync by the triggers below
+    SEARCH_TABLE: str = (
+        'CREATE VIRTUAL TABLE IF NOT EXISTS pages_fts USING fts5(title, markdown, content=\'pages\', '
+        'content_rowid=\'page_id\', tokenize=\'porter unicode61 remove_diacritics 2\')')
+    SEARCH_TRIGGERS = [
+        'CREATE TRIGGER IF NOT EXISTS pages_fts_insert AFTER INSERT ON pages BEGIN '
+        'INSERT INTO pages_fts (rowid, title, markdown) VALUES (new.page_id, new.title, new.markdown); END',
+        'CREATE TRIGGER IF NOT EXISTS pages_fts_delete AFTER DELETE ON pages BEGIN '
+        'INSERT INTO pages_fts (pages_fts, rowid, title, markdown) '
+        'VALUES (\'delete\', old.page_id, old.title, old.markdown); END',
+        'CREATE TRIGGER IF NOT EXISTS pages_fts_update AFTER UPDATE OF title, markdown ON pages BEGIN '
+        'INSERT INTO pages_fts (pages_fts, rowid, title, markdown) '
+        'VALUES (\'delete\', old.page_id, old.title, old.markdown); '
+        'INSERT INTO pages_fts (rowid, title, markdown) VALUES (new.page_id, new.title, new.markdown); END',
+    ]
+    # Page history, stored as a full snapshot every few revisions and compressed deltas in between (see revisions.py)
+    REVISION_TABLE: str = (
+        'CREATE TABLE IF NOT EXISTS page_revisions (revision_id INTEGER PRIMARY KEY AUTOINCREMENT, '
+        'page_id INTEGER NOT NULL REFERENCES pages (page_id) ON DELETE CASCADE, number INTEGER NOT NULL, '
+        'created_at INTEGER NOT NULL, editor TEXT NOT NULL, kind TEXT NOT NULL, data BLOB NOT NULL, '
+        'UNIQUE (page_id, number))')
+    # Counters shared by every worker process, such as the count of changes read by the in-memory snapshot
+    COUNTER_TABLE: str = (
+        'CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL) WITHOUT ROWID')
+    # Every page created, renamed or deleted by any process, read by get_title_changes. Its generation is the title
+    # generation
+    TITLE_CHANGE_TABLE: str = (
+        'CREATE TABLE IF NOT EXISTS title_changes (generation INTEGER PRIMARY KEY AUTOINCREMENT, old_title TEXT, '
+        'new_title TEXT)')
+    TITLE_TRIGGERS = [
+        'CREATE TRIGGER IF NOT EXISTS pages_title_changes_insert AFTER INSERT ON pages BEGIN '
+        'INSERT INTO title_changes (old_title, new_title) VALUES (NULL, new.title); END',
+        'CREATE TRIGGER IF NOT EXISTS pages_title_changes_delete AFTER DELETE ON pages BEGIN '
+        'INSERT INTO title_changes (old_title, new_title) VALUES (old.title, NULL); END',
+        'CREATE TRIGGER IF NOT EXISTS pages_title_changes_update AFTER UPDATE OF title ON pages '
+        'WHEN old.title IS NOT new.title BEGIN '
+        'INSERT INTO title_changes (old_title, new_title) VALUES (old.title, new.title); END',
+    ]
+    # The user editing each page and when their lease on it expires, kept by the LeaseManager in leases.py
+    LEASE_TABLE: str = (
+        'CREATE TABLE IF NOT EXISTS page_leases (page TEXT PRIMARY KEY, holder TEXT NOT NULL, '
+        'expires_at REAL NOT NULL) WITHOUT ROWID')
+    CATEGORY_PAGE_VIEW: str = (
+        'CREATE VIEW IF NOT EXISTS category_pages AS SELECT page_categories.category, pages.title '
+        'FROM page_categories JOIN pages ON pages.page_id = page_categories.page_id')
+
+    # Columns added after the original schema, created on existing databases when missing
+    PAGE_COLUMNS = {
+        'rendered_html': 'TEXT',
+        'rendered_toc': 'TEXT',
+        'content_hash': 'TEXT',
+        'updated_at': 'INTEGER',
+    }
+
+    # Count the writes to the tables read from the in-memory snapshot, so it is only refreshed when they change. The
+    # render worker's writes to RENDER_COLUMNS are left out, so storing a render does not copy the database again
+    PAGE_READ_COLUMNS = ['title', 'markdown', 'date', 'editor', 'category'] + [
+        column for column in PAGE_COLUMNS if column not in RENDER_COLUMNS]
+    SNAPSHOT_EVENTS = {('pages', 'UPDATE'): f'UPDATE OF {", ".join(PAGE_READ_COLUMNS)}'}
+    SNAPSHOT_TRIGGERS = [
+        f'CREATE TRIGGER IF NOT EXISTS {table}_changes_{event.lower()} '
+        f'AFTER {SNAPSHOT_EVENTS.get((table, event), event)} ON {table} BEGIN '
+        f'UPDATE counters SET value = value + 1 WHERE name = \'changes\'; END'
+        for table in SNAPSHOT_TABLES for event in ('INSERT', 'UPDATE', 'DELETE')
+    ]
+
+    # Every worker process runs this on start, so the checks and the changes they lead to are made under the write
+    # lock: a second worker waits for the first to finish, then finds nothing left to add
+    with DB.get_instance().transaction() as conn:
+        c = conn.cursor()
+
+        c.execute(USER_TABLE)
+        c.execute(PAGE_TABLE)
+
+        existing_columns = [row[1] for row in c.execute('PRAGMA table_info(pages)')]
+
+        for column, column_type in PAGE_COLUMNS.items():
+            if column not in existing_columns:
+                c.execute(f'ALTER TABLE pages ADD COLUMN {column} {column_type}')
+                log.info(f'Added column "{column}" to the pages table.')
+
+        # Edit times used to only be stored as display strings, so fill in the sortable time from them
+        rows = c.execute('SELECT page_id, date FROM pages WHERE updated_at IS NULL').fetchall()
+
+        if rows:
+            c.executemany('UPDATE pages SET updated_at = ? WHERE page_id = ?',
+                          [(parse_legacy_date(date), page_id) for page_id, date in rows])
+            log.info(f'Filled in updated_at for {len(rows)} pages.')
+
+        # Covers recent page queries, which order by updated_at and then title
+        c.execute('CREATE INDEX IF NOT EXISTS pages_updated_at ON pages (updated_at, title)')
+
+        # Sign-in looks users up by email, which must identify a single account
+        try:
+            c.execute('CREATE UNIQUE INDEX IF NOT EXISTS users_email ON users (email)')
+        except sqlite3.IntegrityError:
+            log.error('Several users share an email, so users.email could not be made unique. Indexing it without the '
+                      'constraint until the duplicates are removed.')
+            c.execute('CREATE INDEX IF NOT EXISTS users_email_lookup ON users (email)')
+
+        c.execute(PAGE_CATEGORY_TABLE)
+        c.execute(CATEGORY_PAGE_VIEW)
+
+        # Finds the categories of a page when it is updated or deleted
+        c.execute('CREATE INDEX IF NOT EXISTS page_categories_page_id ON page_categories (page_id)')
+
+        # Categories used to only be stored as comma-separated strings, so fill in the pages that have no rows yet
+        rows = c.execute('SELECT page_id, category FROM pages WHERE page_id NOT IN '
+                         '(SELECT page_id FROM page_categories)').fetchall()
+
+        if rows:
+            c.executemany('INSERT INTO page_categories (page_id, category) VALUES (?, ?)',
+                          [(page_id, item) for page_id, category in rows for item in split_categories(category)])
+            log.info(f'Filled in page_categories for {len(rows)} pages.')
+
+        c.execute(REVISION_TABLE)
+        c.execute(LEASE_TABLE)
+        c.execute(COUNTER_TABLE)
+        c.execute('INSERT OR IGNORE INTO counters (name, value) VALUES (\'changes\', 0)')
+        c.execute(TITLE_CHANGE_TABLE)
+
+        for trigger in TITLE_TRIGGERS + SNAPSHOT_TRIGGERS:
+            c.execute(trigger)
+
+        search_index_exists = c.execute('SELECT 1 FROM sqlite_master WHERE name = \'pages_fts\'').fetchone()
 
-    c = conn.cursor()
+        c.execute(SEARCH_TABLE)
 
-    c.execute(USER_TABLE)
-    c.execute(PAGE_TABLE)
+        for trigger in SEARCH_TRIGGERS:
+            c.execute(trigger)
 
-    conn.commit()
+        if not search_index_exists:
+            # Matches in a title count ten times as much as matches in the markdown
+            c.execute('INSERT INTO pages_fts (pages_fts, rank) VALUES (\'rank\', \'bm25(10.0, 1.0)\')')
+            c.execute('INSERT INTO pages_fts (pages_fts) VALUES (\'rebuild\')')
+            log.info('Built the full-text search index.')
@@ -0,0 +1,226 @@
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from urllib.parse import quote
+
+import markdown_fyresmith
+from cache import content_version
+from db import DB, Access, create_tables
+
+log = logging.getLogger("export")
+
+# Records the version of every exported page, so later exports can skip the pages that have not changed
+MANIFEST_FILE = '.export-manifest.json'
+
+# Exported pages are rendered for readers, without the edit and delete links
+EXPORT_ROLE = 'viewer'
+
+PROGRESS_INTERVAL_SECONDS = 5
+
+# Shared by every page rendered in a worker process, set once by init_worker
+worker_matcher = None
+worker_recent_pages = []
+
+
+def page_file_name(title: str) -> str:
+    """
+    Builds the file name a page is exported to. A static server can map '/page?page=<title>' links to it.
+
+    :param title: The title of the page.
+    :type title: str
+
+    :return: The file name, with every character that is not safe in a path percent-encoded.
+    :rtype: str
+    """
+    return quote(title, safe=' ') + '.html'
+
+
+def write_atomic(path: str, text: str):
+    """
+    Writes a file so that readers only ever see its previous or its complete new contents.
+
+    :param path: The path of the file to write.
+    :type path: str
+    :param text: The contents of the file.
+    :type text: str
+
+    :return: None
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.', suffix='.tmp')
+
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
+            file.write(text)
+
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def read_manifest(folder: str) -> dict:
+    try:
+        with open(os.path.join(folder, MANIFEST_FILE), encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def get_recent_pages(connection) -> list:
+    """
+    Retrieves every page title, most recently edited first.
+
+    :param connection: The connection to read from.
+    :type connection: sqlite3.Connection
+
+    :return: The page titles.
+    :rtype: list
+    """
+    rows = connection.execute('SELECT title FROM pages ORDER BY updated_at DESC, title DESC')
+
+    return [row[0] for row in rows]
+
+
+def init_worker(titles: list):
+    global worker_matcher, worker_recent_pages
+
+    worker_matcher = markdown_fyresmith.TitleMatcher(titles)
+    worker_recent_pages = titles[:16]
+
+
+def export_page(folder: str, title: str, markdown: str, updated_at: int, editor: str) -> str:
+    """
+    Renders a page in a worker process and writes it to the export folder.
+
+    :return: The title of the exported page.
+    :rtype: str
+    """
+    html = markdown_fyresmith.to_html(markdown, updated_at, editor, title, worker_recent_pages, EXPORT_ROLE,
+                                      worker_matcher)
+
+    write_atomic(os.path.join(folder, page_file_name(title)), html)
+
+    return title
+
+
+def export_pages(folder: str, workers=None, full=False) -> dict:
+    """
+    Exports every page as static HTML, rendering pages in parallel across a pool of processes.
+
+    Pages are streamed from the database rather than loaded at once, and only as many are queued as the workers
+    can keep busy. Unless full is set, pages whose content and linked titles are unchanged since the last export
+    are skipped, so their recently edited sidebars are only refreshed by a full export.
+
+    :param folder: The folder to export to. It is created if it does not exist.
+    :type folder: str
+    :param workers: The number of worker processes. Defaults to the number of CPUs.
+    :type workers: Optional[int]
+    :param full: If True, exports every page even if it has not changed.
+    :type full: bool
+
+    :return: The number of pages that were exported, skipped as unchanged, failed and removed.
+    :rtype: dict
+    """
+    os.makedirs(folder, exist_ok=True)
+
+    create_tables()
+
+    connection = DB.get_instance().get_connection()
+    titles = get_recent_pages(connection)
+    matcher = markdown_fyresmith.TitleMatcher(titles)
+
+    previous = {} if full else read_manifest(folder)
+    manifest = {}
+    counts = {'exported': 0, 'skipped': 0, 'failed': 0, 'removed': 0}
+
+    start = time.perf_counter()
+    last_report = start
+
+    def report(final=False):
+        done = counts['exported'] + counts['skipped'] + counts['failed']
+        elapsed = time.perf_counter() - start
+        log.info(f'{"Exported" if final else "Exporting"} {done}/{len(titles)} pages: {counts["exported"]} written, '
+                 f'{counts["skipped"]} unchanged, {counts["failed"]} failed, {counts["removed"]} removed '
+                 f'({elapsed:.1f}s).')
+
+    workers = workers or os.cpu_count() or 1
+
+    # Enough queued pages to keep every worker busy, without reading the whole table into memory
+    max_pending = workers * 4
+    pending = {}
+
+    def collect():
+        nonlocal last_report
+
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+        for future in done:
+            title, version = pending.pop(future)
+
+            try:
+                future.result()
+            except Exception as e:
+                log.error(f'Error exporting page "{title}": {e}')
+                counts['failed'] += 1
+            else:
+                manifest[title] = version
+                counts['exported'] += 1
+
+        if time.perf_counter() - last_report >= PROGRESS_INTERVAL_SECONDS:
+            last_report = time.perf_counter()
+            report()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(titles,)) as executor:
+        try:
+            rows = Access('pages').iterate(['title', 'markdown', 'updated_at', 'editor'])
+
+            for title, markdown, updated_at, editor in rows:
+                version = content_version(title, markdown, updated_at, editor, matcher.version_for(markdown))
+
+                if previous.get(title) == version and os.path.exists(os.path.join(folder, page_file_name(title))):
+                    manifest[title] = version
+                    counts['skipped'] += 1
+                    continue
+
+                future = executor.submit(export_page, folder, title, markdown, updated_at, editor)
+                pending[future] = (title, version)
+
+                if len(pending) >= max_pending:
+                    collect()
+
+            while pending:
+                collect()
+        finally:
+            for title in set(previous) - set(titles):
+                try:
+                    os.remove(os.path.join(folder, page_file_name(title)))
+                    counts['removed'] += 1
+                except FileNotFoundError:
+                    pass
+
+            # Record what was exported even if the export was interrupted, so the next one can resume from it
+            write_atomic(os.path.join(folder, MANIFEST_FILE), json.dumps(manifest))
+
+    report(final=True)
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Exports every wiki page as static HTML.')
+    parser.add_argument('folder', help='The folder to export to.')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes. Defaults to the CPU count.')
+    parser.add_argument('--full', action='store_true', help='Export every page, including unchanged ones.')
+    args = parser.parse_args()
+
+    counts = export_pages(args.folder, args.workers, args.full)
+
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
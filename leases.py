@@ -0,0 +1,299 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+
+from db import DB, instrumented
+
+load_dotenv()
+
+log = logging.getLogger("leases")
+
+# How long a page stays locked to its editor after the editor's last renewal, in seconds
+LEASE_TTL_SECONDS = float(os.getenv('EDIT_LEASE_TTL_SECONDS') or 20)
+
+# How often expired leases are deleted from the page_leases table, in seconds
+LEASE_REAP_SECONDS = float(os.getenv('EDIT_LEASE_REAP_SECONDS') or 60)
+
+# Takes the lease if it is free, expired or already held by the same holder, all in one statement, so two processes
+# can never both be granted it
+ACQUIRE_QUERY = (
+    'INSERT INTO page_leases (page, holder, expires_at) VALUES (:page, :holder, :expires_at) '
+    'ON CONFLICT (page) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at '
+    'WHERE page_leases.holder = excluded.holder OR page_leases.expires_at <= :now')
+
+# Matches the leases in :leases, a JSON list of [page, holder] pairs
+LEASES_CONDITION = ('(page, holder) IN '
+                    '(SELECT json_extract(value, \'$[0]\'), json_extract(value, \'$[1]\') FROM json_each(:leases))')
+
+
+class LeaseManager(threading.Thread):
+    """
+    Grants each page to one editor at a time, shared by every process using the database.
+
+    A lease lasts LEASE_TTL_SECONDS after it was last acquired or renewed, so a page whose editor disappears without
+    releasing it is free again once the lease expires. Leases are stored in the page_leases table and every change
+    is a single statement, so acquiring, renewing and releasing are atomic across processes. Expired leases are
+    already ignored by every method, and the thread only deletes them so the table does not grow.
+
+    Usage:
+    page_leases = LeaseManager()
+    page_leases.start()
+    if page_leases.acquire('Page Title', 'editor@example.com'): ...
+    """
+
+    def __init__(self, ttl: float = LEASE_TTL_SECONDS, reap_interval: float = LEASE_REAP_SECONDS):
+        """
+        Initializes a new instance of the LeaseManager class.
+
+        :param ttl: How long a lease lasts after it was last acquired or renewed, in seconds.
+        :type ttl: float
+        :param reap_interval: How often expired leases are deleted, in seconds.
+        :type reap_interval: float
+        """
+        super().__init__(name='lease_reaper', daemon=True)
+
+        self.ttl = ttl
+        self.reap_interval = reap_interval
+
+        # Called with a page's title whenever this process acquires, releases or moves its lease
+        self.watchers: List[Callable[[str], None]] = []
+
+    def watch(self, watcher: Callable[[str], None]):
+        """
+        Registers a function to call with a page's title whenever this process acquires, releases or moves the
+        page's lease, such as to push the change to the page's viewers. Changes made by other processes are not
+        seen.
+
+        :param watcher: The function to call. It runs on the thread that changed the lease.
+        :type watcher: Callable[[str], None]
+
+        :return: None
+        """
+        self.watchers.append(watcher)
+
+    def changed(self, *pages: str):
+        for page in pages:
+            for watcher in self.watchers:
+                watcher(page)
+
+    @staticmethod
+    def execute(query: str, params: dict) -> int:
+        """
+        Runs a statement that changes the page_leases table and commits it.
+
+        :return: The number of leases changed.
+        :rtype: int
+        """
+        conn = DB.get_instance().get_connection()
+
+        try:
+            changed = conn.execute(query, params).rowcount
+            DB.get_instance().commit()
+        except sqlite3.Error as e:
+            log.info(f'Error changing page leases: {e}')
+            return 0
+
+        return changed
+
+    @instrumented
+    def acquire(self, page: str, holder: str) -> bool:
+        """
+        Grants a page to a holder if no one else holds an unexpired lease on it. A holder that already holds the
+        lease renews it.
+
+        :param page: The title of the page.
+        :type page: str
+        :param holder: The email address of the editor.
+        :type holder: str
+
+        :return: True if the holder now holds the lease, False if someone else does.
+        :rtype: bool
+        """
+        now = time.time()
+
+        acquired = self.execute(ACQUIRE_QUERY, {'page': page, 'holder': holder, 'expires_at': now + self.ttl,
+                                                'now': now}) == 1
+
+        if acquired:
+            self.changed(page)
+
+        return acquired
+
+    @instrumented
+    def renew(self, page: str, holder: str) -> bool:
+        """
+        Extends a holder's lease on a page by the lease's TTL.
+
+        :return: True if the lease was renewed, False if the holder no longer holds it.
+        :rtype: bool
+        """
+        return self.execute('UPDATE page_leases SET expires_at = :expires_at WHERE page = :page AND holder = :holder',
+                            {'page': page, 'holder': holder, 'expires_at': time.time() + self.ttl}) == 1
+
+    @instrumented
+    def renew_many(self, leases: Iterable[Tuple[str, str]]) -> Set[Tuple[str, str]]:
+        """
+        Extends many holders' leases with a single statement.
+
+        :param leases: The (page, holder) pairs to renew.
+        :type leases: Iterable[Tuple[str, str]]
+
+        :return: The (page, holder) pairs that were renewed. The others are no longer held by their holder.
+        :rtype: Set[Tuple[str, str]]
+        """
+        conn = DB.get_instance().get_connection()
+        params = {'leases': json.dumps(list(leases)), 'expires_at': time.time() + self.ttl}
+
+        try:
+            with DB.get_instance().transaction():
+                conn.execute(f'UPDATE page_leases SET expires_at = :expires_at WHERE {LEASES_CONDITION}', params)
+                rows = conn.execute(f'SELECT page, holder FROM page_leases WHERE expires_at = :expires_at AND '
+                                    f'{LEASES_CONDITION}', params).fetchall()
+        except sqlite3.Error as e:
+            log.info(f'Error changing page leases: {e}')
+            return set()
+
+        return set(rows)
+
+    @instrumented
+    def expire(self, page: str, holder: str, seconds: float) -> bool:
+        """
+        Shortens a holder's lease on a page to end within a number of seconds, unless it is renewed before then.
+
+        :return: True if the holder held the lease, False otherwise.
+        :rtype: bool
+        """
+        return self.execute('UPDATE page_leases SET expires_at = MIN(expires_at, :expires_at) '
+                            'WHERE page = :page AND holder = :holder',
+                            {'page': page, 'holder': holder, 'expires_at': time.time() + seconds}) == 1
+
+    @instrumented
+    def release(self, page: str, holder: str) -> bool:
+        """
+        Ends a holder's lease on a page, so others can edit it straight away.
+
+        :return: True if the holder held the lease, False otherwise.
+        :rtype: bool
+        """
+        released = self.execute('DELETE FROM page_leases WHERE page = :page AND holder = :holder',
+                                {'page': page, 'holder': holder}) == 1
+
+        if released:
+            self.changed(page)
+
+        return released
+
+    @instrumented
+    def move(self, page: str, new_page: str, holder: str) -> bool:
+        """
+        Moves a holder's lease to a page's new title after the page is renamed, renewing it.
+
+        :return: True if the holder now holds the lease on the new title, False otherwise.
+        :rtype: bool
+        """
+        if page == new_page:
+            return self.acquire(new_page, holder)
+
+        now = time.time()
+
+        with DB.get_instance().transaction():
+            self.execute('DELETE FROM page_leases WHERE page = :page AND expires_at <= :now',
+                         {'page': new_page, 'now': now})
+
+            moved = self.execute('UPDATE OR IGNORE page_leases SET page = :new_page, expires_at = :expires_at '
+                                 'WHERE page = :page AND holder = :holder',
+                                 {'page': page, 'new_page': new_page, 'holder': holder,
+                                  'expires_at': now + self.ttl}) == 1
+
+        if moved:
+            self.changed(page, new_page)
+
+        return moved
+
+    @instrumented
+    def holder(self, page: str) -> Optional[str]:
+        """
+        Retrieves who holds the lease on a page.
+
+        :param page: The title of the page.
+        :type page: str
+
+        :return: The email address of the holder, or None if the page is free.
+        :rtype: Optional[str]
+        """
+        conn = DB.get_instance().get_connection()
+
+        try:
+            row = conn.execute('SELECT holder FROM page_leases WHERE page = :page AND expires_at > :now',
+                               {'page': page, 'now': time.time()}).fetchone()
+        except sqlite3.Error as e:
+            log.info(f'Error reading page leases: {e}')
+            return None
+
+        return row[0] if row else None
+
+    @instrumented
+    def holders(self, pages: Iterable[str]) -> Dict[str, str]:
+        """
+        Retrieves who holds the leases on many pages with a single query.
+
+        :param pages: The titles of the pages.
+        :type pages: Iterable[str]
+
+        :return: The email address of the holder of each page that is not free.
+        :rtype: Dict[str, str]
+        """
+        conn = DB.get_instance().get_connection()
+
+        try:
+            rows = conn.execute('SELECT page, holder FROM page_leases WHERE expires_at > :now AND '
+                                'page IN (SELECT value FROM json_each(:pages))',
+                                {'pages': json.dumps(list(pages)), 'now': time.time()}).fetchall()
+        except sqlite3.Error as e:
+            log.info(f'Error reading page leases: {e}')
+            return {}
+
+        return dict(rows)
+
+    def held_by_other(self, page: str, holder: str) -> bool:
+        """
+        Checks whether someone other than a user holds the lease on a page.
+
+        :return: True if someone else holds an unexpired lease, False otherwise.
+        :rtype: bool
+        """
+        current = self.holder(page)
+
+        return current is not None and current != holder
+
+    @instrumented
+    def reap(self) -> int:
+        """
+        Deletes every expired lease.
+
+        :return: The number of leases deleted.
+        :rtype: int
+        """
+        reaped = self.execute('DELETE FROM page_leases WHERE expires_at <= :now', {'now': time.time()})
+
+        if reaped:
+            log.info(f'Released {reaped} expired page leases.')
+
+        return reaped
+
+    def run(self):
+        while True:
+            time.sleep(self.reap_interval)
+
+            try:
+                self.reap()
+            except Exception as e:
+                log.error(f'Error releasing expired page leases: {e}')
+            finally:
+                DB.get_instance().release_connection()
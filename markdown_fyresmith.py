@@ -1,15 +1,73 @@
+import bisect
+import hashlib
+import html
+import logging
+import os
 import re
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from urllib.parse import quote
+from xml.etree import ElementTree as etree
 
+import jinja2
 import markdown
+from markdown.blockprocessors import HashHeaderProcessor, SetextHeaderProcessor
 from markdown.preprocessors import Preprocessor
+from markdown.treeprocessors import Treeprocessor
 from markdown.extensions import Extension
 from markdown.extensions.extra import ExtraExtension
 from markdown.extensions.wikilinks import WikiLinkExtension
 from markdown.extensions.sane_lists import SaneListExtension
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
+
+from cache import content_version
+
 load_dotenv()
 
+log = logging.getLogger("render")
+
+TEMPLATE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+SHELL_TEMPLATE = 'wiki-page.html'
+
+# Constructs that resolve across the whole document: footnotes, reference and abbreviation definitions, raw HTML
+# blocks and fenced code. Pages using them are never split into sections.
+UNSPLITTABLE_PATTERN = re.compile(r'\[\^|\]:|^ {0,3}<[A-Za-z/!?]|^\s*(?:`{3,}|~{3,})', re.MULTILINE)
+
+# Compiled templates are cached on disk, so each worker only parses the page shell once per deployment.
+# Shared with the Flask app's Jinja environment.
+template_bytecode_cache = jinja2.FileSystemBytecodeCache(os.getenv('JINJA_CACHE_FOLDER') or None)
+
+# Number of texts, such as pages and sections, whose title version each TitleMatcher keeps
+TEXT_VERSION_CACHE_SIZE = 4096
+
+# How edit times are shown to readers. They are stored as epoch seconds.
+DATE_FORMAT = '%b %d, %Y - %I:%M %p'
+
+
+def format_date(timestamp):
+    """
+    Formats a page's edit time for display.
+
+    :param timestamp: The edit time, in seconds since the epoch.
+    :type timestamp: Optional[Union[int, float]]
+
+    :return: The formatted local time, or an empty string if the time is not known.
+    :rtype: str
+    """
+    if not timestamp:
+        return ''
+
+    return datetime.fromtimestamp(timestamp).strftime(DATE_FORMAT)
+
+
+# Renders the page shell outside of a Flask request, such as for static exports
+shell_environment = jinja2.Environment(loader=jinja2.FileSystemLoader(TEMPLATE_FOLDER),
+                                       bytecode_cache=template_bytecode_cache,
+                                       autoescape=jinja2.select_autoescape())
+shell_environment.filters['format_date'] = format_date
+
 DEFAULT_MARKDOWN = """
 {
 # This Is An Infobox
@@ -112,41 +170,100 @@ Something in between.
 """
 
 
-class InfoBoxExtension(Extension):
+# The tag each heading level is advanced to, one level below the page title
+ADVANCED_HEADER_TAGS = {f'h{level}': f'h{min(level + 1, 6)}' for level in range(1, 7)}
+
+
+class WikiBlockExtension(Extension):
     def extendMarkdown(self, md):
-        md.preprocessors.register(InfoBoxProcessor(md), 'custom_brace', 30)
+        md.preprocessors.register(WikiBlockProcessor(md), 'wiki_blocks', 30)
+
 
+class WikiBlockProcessor(Preprocessor):
+    """
+    Recognises infobox, table and header syntax in a single pass over the document.
+
+    Outside of any block, a '{' line opens an infobox, a '[' line opens a table, and a line starting with '#' is a
+    header that is added to the table of contents. Blocks do not nest:
+
+    - Inside an infobox, '}' closes it. '# ', '## ' and '### ' lines are infobox titles, not page headers, and never
+      appear in the table of contents. 'Label | Value' lines are data rows. Any other line starting with '#' is a
+      page header. Anything else, including '{', '[' and ']', is passed through stripped.
+    - Inside a table, ']' closes it. Lines starting with '#' are page headers, '=' lines are header rows and lines
+      containing '|' are data rows. Anything else, including '{', '}' and '[', is passed through stripped.
+    - A '}' or ']' line outside of its block is ordinary text.
+    """
+
+    # Marks the boundary between cell values in a batched conversion. It is a raw HTML block, so it passes through
+    # Markdown untouched and keeps neighbouring values in separate blocks.
+    CELL_SEPARATOR = '<!--infobox-cell-->'
+
+    # Values that could leak state or markup into their neighbours: raw HTML tags and comments, footnotes, and
+    # reference or abbreviation definitions.
+    UNBATCHABLE_PATTERN = re.compile(r'<[A-Za-z/!?]|\[\^|\]:')
 
-class InfoBoxProcessor(Preprocessor):
     def __init__(self, md):
         super().__init__(md)
         self.inner_md = markdown.Markdown(extensions=[WikiLinkExtension(base_url='/page?page=', end_url=''), ExtraExtension(), SaneListExtension()])
 
     def run(self, lines):
+        # The inner engine lives as long as its outer engine, so clear state left over from the previous page.
+        self.inner_md.reset()
+
         new_lines = []
-        in_braces = False
+        rows = []
+        table_of_contents = []
+        block = None
 
         for line in lines:
-            if line.strip() == '{':
-                in_braces = True
+            stripped = line.strip()
+
+            if block == 'infobox':
+                if stripped == '}':
+                    block = None
+                    new_lines.append('</tbody></table>')
+                elif self.is_data_row(line):
+                    # Defer the row until every value on the page has been collected
+                    item, value = map(str.strip, stripped.split('|', 1))
+                    rows.append((len(new_lines), item, value))
+                    new_lines.append(None)
+                elif stripped.startswith('#') and not stripped.startswith(('# ', '## ', '### ')):
+                    new_lines.append(self.process_header(stripped, table_of_contents))
+                else:
+                    new_lines.append(self.process_inside_braces(line))
+            elif block == 'table':
+                if stripped == ']':
+                    block = None
+                    new_lines.append('</table></div>')
+                elif stripped.startswith('#'):
+                    new_lines.append(self.process_header(stripped, table_of_contents))
+                else:
+                    new_lines.append(self.process_table_line(line))
+            elif stripped == '{':
+                block = 'infobox'
                 new_lines.append('<table class="infobox"><tbody>')
-            elif line.strip() == '}':
-                in_braces = False
-                new_lines.append('</tbody></table>')
-            elif in_braces:
-                processed_line = self.process_inside_braces(line)
-                new_lines.append(processed_line)
+            elif stripped == '[':
+                block = 'table'
+                new_lines.append('<div class="table-main"><table>')
+            elif line.startswith('#'):
+                new_lines.append(self.process_header(line, table_of_contents))
             else:
-                processed_line = self.process_line(line, in_braces)
-                new_lines.append(processed_line)
+                new_lines.append(line)
+
+        values = self.render_cells([value for _, _, value in rows])
+
+        for (index, item, _), value in zip(rows, values):
+            new_lines[index] = self.process_data_row(item, value)
+
+        # Add the table_of_contents list to the markdown instance
+        setattr(self.md, 'table_of_contents', table_of_contents)
 
         return new_lines
 
-    def process_line(self, line, in_braces):
-        if in_braces:
-            return self.process_inside_braces(line)
-        else:
-            return f"{line}"
+    @staticmethod
+    def is_data_row(line):
+        line = line.strip()
+        return '|' in line and not line.startswith(('# ', '## ', '### '))
 
     def process_inside_braces(self, line):
         line = line.strip()
@@ -156,183 +273,537 @@ class InfoBoxProcessor(Preprocessor):
             return f'<tr><td class="infobox-subheader" colspan="2">{line[3:]}</td></tr>'
         elif line.startswith('### '):
             return f'<tr><th class="infobox-subtitle" colspan="2">{line[4:]}</th></tr>'
-        elif '|' in line:
-            item, value = map(str.strip, line.split('|', 1))
-            # Process value as Markdown using a separate instance
-            value = self.inner_md.convert(value).replace('<p>', '').replace('</p>', '')
-            return f'<tr><th scope="row" class="infobox-label">{item}</th><td class="infobox-data">{value}</td></tr>'
         else:
             # Handle other cases as needed
             return f"{line}"
 
+    @staticmethod
+    def process_data_row(item, value):
+        return f'<tr><th scope="row" class="infobox-label">{item}</th><td class="infobox-data">{value}</td></tr>'
 
-class TableOfContentsExtension(Extension):
-    def extendMarkdown(self, md):
-        md.preprocessors.register(TableOfContentsPreprocessor(md), 'table_of_contents', 30)
+    def render_cells(self, values):
+        """
+        Renders infobox cell values as Markdown, converting as many as possible in a single pass.
 
+        :param values: The raw Markdown of each cell value.
+        :type values: List[str]
 
-class TableOfContentsPreprocessor(Preprocessor):
-    def run(self, lines):
-        table_of_contents = []
-        new_lines = []
+        :return: The rendered HTML of each value, with paragraph tags removed.
+        :rtype: List[str]
+        """
+        values = list(values)
+        batched = len(values)
 
-        for line in lines:
-            if line.startswith('#'):
-                header_level = line.count('#')
-                header_text = line.strip('#').strip()
-                header_id = header_text.replace(' ', '')
+        # Definitions persist in the inner engine and change how every later value renders, so from the first one
+        # onwards values are converted one at a time, in order, exactly as before
+        for i, value in enumerate(values):
+            if self.UNBATCHABLE_PATTERN.search(value):
+                batched = i
+                break
 
-                # Add header to the table_of_contents list
-                table_of_contents.append((header_text, header_level, header_id))
+        rendered = self.convert_batch(values[:batched])
+        rendered += [self.inner_md.convert(value) for value in values[batched:]]
 
-                # Add an id attribute to the header tag
-                line = f'<h{header_level} id="{header_id}">{header_text}</h{header_level}>'
+        return [value.replace('<p>', '').replace('</p>', '') for value in rendered]
 
-            new_lines.append(line)
+    def convert_batch(self, values):
+        if len(values) < 2:
+            return [self.inner_md.convert(value) for value in values]
 
-        # Add the table_of_contents list to the markdown instance
-        setattr(self.md, 'table_of_contents', table_of_contents)
+        separator = f'\n\n{self.CELL_SEPARATOR}\n\n'
+        parts = self.inner_md.convert(separator.join(values)).split(f'\n{self.CELL_SEPARATOR}\n')
 
-        return new_lines
+        if len(parts) != len(values):
+            return [self.inner_md.convert(value) for value in values]
+
+        # Markdown strips the whitespace around a whole document, so do the same for each part
+        return [part.strip() for part in parts]
+
+    def process_table_line(self, line):
+        line = line.strip()
+        if line.startswith('='):
+            headers = [header.strip() for header in line.split('=')]
+            return self.process_table_header(headers)
+        elif '|' in line:
+            cells = [cell.strip() for cell in line.split('|')]
+            return self.process_table_row(cells)
+        else:
+            return line
+
+    def process_table_header(self, headers):
+        result = "<tr>"
+
+        for header in headers:
+            if header != '':
+                result += f'<th>{header}</th>'
+
+        result += "</tr>"
+
+        return result
+
+    def process_table_row(self, cells):
+        result = "<tr>"
+
+        for cell in cells:
+            if cell != '':
+                result += f'<td>{cell}</td>'
+
+        result += "</tr>"
+
+        return result
+
+    @staticmethod
+    def process_header(line, table_of_contents):
+        header_level = line.count('#')
+        header_text = line.strip('#').strip()
+        header_id = header_text.replace(' ', '')
+
+        # Add header to the table_of_contents list
+        table_of_contents.append((header_text, header_level, header_id))
+
+        # Add an id attribute to the header tag, advanced one level below the page title
+        header_tag = ADVANCED_HEADER_TAGS[f'h{min(header_level, 6)}']
+        return f'<{header_tag} id="{header_id}">{header_text}</{header_tag}>'
+
+
+def _is_word_char(char):
+    return char.isalnum() or char == '_'
+
+
+def _fold_case(text):
+    # Lowercase without changing the length of the text, so positions in the folded text match the original
+    folded = text.lower()
+
+    if len(folded) == len(text):
+        return folded
+
+    return ''.join(char.lower() if len(char.lower()) == 1 else char for char in text)
+
+
+class TitleMatcher:
+    """
+    Finds mentions of page titles in text, so they can be turned into links.
+
+    Titles are stored in a character trie, case-insensitively. Because a mention has to start and end on a word
+    boundary, the text is scanned once and the trie is only walked from word starts, taking the longest title that
+    also ends on a word boundary. This finds the same leftmost-longest matches as a full Aho-Corasick automaton, but
+    adding or removing a title only touches that title's own path, so the trie can be kept up to date as pages are
+    created, renamed and deleted instead of being rebuilt.
+
+    Usage:
+    matcher = TitleMatcher(['Example', 'Test Page'])
+    matches = matcher.find('See the test page.')
+    """
+
+    def __init__(self, titles=()):
+        """
+        Initializes a new instance of the TitleMatcher class.
+
+        :param titles: The page titles to match.
+        :type titles: Iterable[str]
+        """
+        # Each node is [children, title]; the title is set on nodes that end one
+        self._root = [{}, None]
+        self._lock = threading.Lock()
+        self._count = 0
+
+        # The version of each text already scanned by version_for, keyed by its content version. It is cleared
+        # whenever a title is added or removed, which also bumps the generation
+        self._text_versions = OrderedDict()
+        self._generation = 0
+
+        for title in titles:
+            self.add(title)
+
+    def __len__(self):
+        return self._count
+
+    def version_for(self, text: str) -> str:
+        """
+        Identifies the titles the text could link to, so its rendered output is only versioned on those titles.
+
+        Every title found at word boundaries counts, including ones a longer title would win over and ones in places
+        that are never linked, so adding or removing any title the text could link to changes the version, and
+        adding or removing any other title does not. Matchers holding the same titles give the same version, even in
+        different processes. A text's version is kept until the titles change.
+
+        :param text: The text, such as a page's or a section's markdown.
+        :type text: str
+
+        :return: The version of the titles the text mentions.
+        :rtype: str
+        """
+        key = content_version(text)
+
+        with self._lock:
+            version = self._text_versions.get(key)
+            generation = self._generation
+
+        if version is not None:
+            return version
+
+        digest = 0
+
+        for title in self._mentions(text):
+            digest ^= self._title_digest(title)
+
+        version = f'{digest:016x}'
+
+        with self._lock:
+            # A title changed while the text was being scanned, so its version may already be out of date
+            if generation == self._generation:
+                self._text_versions[key] = version
+
+                if len(self._text_versions) > TEXT_VERSION_CACHE_SIZE:
+                    self._text_versions.popitem(last=False)
+
+        return version
+
+    def _mentions(self, text):
+        # Every title starting and ending on a word boundary, unlike find, which only takes the leftmost and longest
+        folded = _fold_case(text)
+        length = len(text)
+        titles = set()
+        previous_is_word = None
+
+        for i in range(length):
+            is_word = _is_word_char(text[i])
+
+            if is_word == previous_is_word:
+                continue
+
+            previous_is_word = is_word
+            node = self._root
+            j = i
+
+            while j < length:
+                node = node[0].get(folded[j])
+
+                if node is None:
+                    break
+
+                j += 1
+
+                if node[1] is not None and (j == length or _is_word_char(text[j]) != _is_word_char(text[j - 1])):
+                    titles.add(node[1])
+
+        return titles
+
+    def _changed(self):
+        # Called with the lock held
+        self._text_versions.clear()
+        self._generation += 1
+
+    @staticmethod
+    def _title_digest(title):
+        return int.from_bytes(hashlib.sha1(title.encode('utf-8')).digest()[:8], 'big')
+
+    def __contains__(self, title):
+        node = self._find_node(_fold_case(title.strip()))
+        return node is not None and node[1] is not None
+
+    def add(self, title: str):
+        """
+        Adds a page title.
+
+        :param title: The title to add.
+        :type title: str
+
+        :return: None
+        """
+        title = title.strip()
+
+        if not title:
+            return
+
+        with self._lock:
+            node = self._root
+
+            for char in _fold_case(title):
+                node = node[0].setdefault(char, [{}, None])
+
+            if node[1] is None:
+                self._count += 1
+
+            node[1] = title
+            self._changed()
+
+    def discard(self, title: str):
+        """
+        Removes a page title, if it is present.
+
+        :param title: The title to remove.
+        :type title: str
+
+        :return: None
+        """
+        key = _fold_case(title.strip())
+
+        with self._lock:
+            path = [self._root]
+
+            for char in key:
+                child = path[-1][0].get(char)
+
+                if child is None:
+                    return
+
+                path.append(child)
+
+            if path[-1][1] is None:
+                return
+
+            path[-1][1] = None
+            self._count -= 1
+            self._changed()
+
+            # Prune the branch that now leads to no title
+            for depth in range(len(key), 0, -1):
+                node = path[depth]
+
+                if node[0] or node[1] is not None:
+                    break
+
+                del path[depth - 1][0][key[depth - 1]]
+
+    def find(self, text: str, excluded=(), exclude_title=None):
+        """
+        Finds non-overlapping title mentions in the text, preferring the leftmost and then the longest.
+
+        :param text: The text to search.
+        :type text: str
+        :param excluded: Sorted, non-overlapping (start, end) ranges of the text in which no mention may appear.
+        :type excluded: List[tuple]
+        :param exclude_title: A title that should never be matched, such as the page's own title.
+        :type exclude_title: Optional[str]
+
+        :return: A list of (start, end, title) tuples in text order.
+        :rtype: List[tuple]
+        """
+        folded = _fold_case(text)
+        length = len(text)
+        excluded_starts = [start for start, _ in excluded]
+        matches = []
+
+        i = 0
+        previous_is_word = False
+
+        while i < length:
+            is_word = _is_word_char(text[i])
+
+            if is_word == previous_is_word:
+                previous_is_word = is_word
+                i += 1
+                continue
+
+            best = None
+            node = self._root
+            j = i
+
+            while j < length:
+                node = node[0].get(folded[j])
+
+                if node is None:
+                    break
+
+                j += 1
+
+                if node[1] is not None and (j == length or _is_word_char(text[j]) != _is_word_char(text[j - 1])):
+                    best = (j, node[1])
+
+            if best is not None and best[1] != exclude_title:
+                end, title = best
+                position = bisect.bisect_right(excluded_starts, end - 1) - 1
+
+                if position < 0 or excluded[position][1] <= i:
+                    matches.append((i, end, title))
+                    previous_is_word = _is_word_char(text[end - 1])
+                    i = end
+                    continue
+
+            previous_is_word = is_word
+            i += 1
+
+        return matches
+
+    def _find_node(self, key):
+        node = self._root
+
+        for char in key:
+            node = node[0].get(char)
+
+            if node is None:
+                return None
+
+        return node
 
 
 class LinkifyExtension(markdown.Extension):
     def __init__(self, **kwargs):
         self.config = {
-            'words': [kwargs.get('words', [])],
+            'words': [kwargs.get('words', []), 'Page titles to link.'],
+            'matcher': [kwargs.get('matcher'), 'A shared TitleMatcher to link against instead of words.'],
         }
         super(LinkifyExtension, self).__init__(**kwargs)
 
     def extendMarkdown(self, md):
-        md.preprocessors.register(LinkifyPreprocessor(md, self.getConfigs()), 'linkify', 35)
+        # After the inline patterns, so existing links and inline code are already elements that can be skipped
+        md.treeprocessors.register(LinkifyTreeprocessor(md, self.getConfigs()), 'linkify', 15)
+
 
+class LinkifyTreeprocessor(Treeprocessor):
+    """
+    Links mentions of page titles once the document has been parsed, in the text of the element tree and in the raw
+    HTML blocks stashed by WikiBlockProcessor, such as infoboxes and tables.
+
+    Headers, infobox titles, links and code are left alone, so table of contents entries and ids stay plain text.
+    """
+
+    # Text that must never contain a link: bracketed or parenthesised spans (footnote references and anything else
+    # Markdown left unparsed), inline code, bare URLs and HTML entities.
+    EXCLUDED_PATTERN = re.compile(r'[\[\(][^\]\)]*[\]\)]|`[^`]*`|\w+://\S+|&#?\w+;')
+
+    # In raw HTML, also the elements skipped in the tree, the title cells of infoboxes and every tag
+    RAW_EXCLUDED_PATTERN = re.compile(
+        r'<(?P<tag>a|code|pre|h[1-6]|script|style)\b[^>]*>.*?</(?P=tag)\s*>|'
+        r'<(?P<cell>th|td) class="infobox-(?:above|subheader|subtitle)"[^>]*>.*?</(?P=cell)>|<[^>]*>|'
+        + EXCLUDED_PATTERN.pattern, re.DOTALL | re.IGNORECASE)
+
+    SKIPPED_TAGS = {'a', 'code', 'pre', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'script', 'style'}
 
-class LinkifyPreprocessor(markdown.preprocessors.Preprocessor):
     def __init__(self, md, config):
         super().__init__(md)
-        self.words = config.get('words', [])
+        self.matcher = config.get('matcher') or TitleMatcher(config.get('words', []))
 
-    def run(self, lines):
-        new_lines = []
+        # The title of the page being converted, which should not link to itself
+        self.exclude_title = None
 
-        for line in lines:
-            line = self.linkify_words(line)
-            new_lines.append(line)
+    @staticmethod
+    def page_url(title):
+        return f'/page?page={quote(title)}'
 
-        return new_lines
+    def run(self, root):
+        if not len(self.matcher):
+            return
 
-    def linkify_words(self, line):
-        # Regular expression pattern to match words within brackets '[]' or parentheses '()'
-        brackets_pattern = re.compile(r'[\[\(]([^\]\)]*)[\]\)]')
+        self.linkify_element(root)
 
-        # Exclude specific words within brackets or parentheses from being turned into links
-        line = re.sub(r'[\[\(]([^\]\)]*)[\]\)]', lambda x: x.group(), line)
+        blocks = self.md.htmlStash.rawHtmlBlocks
 
-        # Find all matches of words within brackets or parentheses
-        brackets_matches = brackets_pattern.finditer(line)
-        excluded_positions = set()
+        for i, block in enumerate(blocks):
+            if isinstance(block, str):
+                blocks[i] = self.linkify_html(block)
 
-        # Mark positions of words within brackets or parentheses
-        for match in brackets_matches:
-            excluded_positions.update(range(match.start(), match.end()))
+    def find(self, text, pattern):
+        excluded = [match.span() for match in pattern.finditer(text)]
 
-        def replace_words(match):
-            start, end = match.span()
-            return match.group() if any(pos in excluded_positions for pos in range(start,
-                                                                                   end)) else f'<a href="/page?page={match.group()}">{match.group()}</a>'
+        return self.matcher.find(text, excluded, self.exclude_title)
 
-        # Using regular expression with case-insensitive flag
-        line = re.sub(rf'\b(?:{"|".join(map(re.escape, self.words))})\b', replace_words, line, flags=re.IGNORECASE)
+    def linkify_text(self, text):
+        """
+        Splits plain text around the titles it mentions.
 
-        return line
+        :return: The text before the first mention, and a link element for each mention with the text after it as
+            its tail.
+        :rtype: tuple
+        """
+        if not text:
+            return text, []
 
+        links = []
+        position = 0
+        head = text
 
-class HeaderAdvancerExtension(markdown.postprocessors.Postprocessor):
-    def run(self, text):
-        lines = text.split('\n')
-        for i, line in enumerate(lines):
-            if line.startswith('<h'):
-                # Find the header tag and any additional attributes
-                tag_start = line.find('<h')
-                tag_end = line.find('>', tag_start)
-                header_tag = line[tag_start:tag_end + 1]
+        for start, end, title in self.find(text, self.EXCLUDED_PATTERN):
+            link = etree.Element('a', {'href': self.page_url(title)})
+            link.text = text[start:end]
 
-                # Extract the header level using regex
-                import re
-                match = re.match(r'<h(\d+)', header_tag)
-                if match:
-                    header_level = int(match.group(1))
+            if links:
+                links[-1].tail = text[position:start]
+            else:
+                head = text[:start]
 
-                    # Advance the header level by one
-                    new_header_level = header_level + 1
+            links.append(link)
+            position = end
 
-                    # Replace the old header tag with the new one
-                    new_header_tag = f'<h{new_header_level}'
-                    if tag_end > tag_start:
-                        new_header_tag += line[tag_end:tag_end + 1]
+        if links:
+            links[-1].tail = text[position:]
 
-                    lines[i] = line.replace(header_tag, new_header_tag)
+        return head, links
 
-        # Join the modified lines back into the HTML
-        modified_html = '\n'.join(lines)
-        return modified_html
+    def linkify_element(self, element):
+        if element.tag in self.SKIPPED_TAGS:
+            return
 
+        element.text, links = self.linkify_text(element.text)
 
-class TableExtension(Extension):
-    def extendMarkdown(self, md):
-        md.preprocessors.register(TableProcessor(md), 'custom_table', 30)
+        for index, link in enumerate(links):
+            element.insert(index, link)
 
+        for child in list(element):
+            if child in links:
+                continue
 
-class TableProcessor(Preprocessor):
-    def run(self, lines):
-        new_lines = []
-        in_table = False
-        for line in lines:
-            if line.strip() == '[':
-                in_table = True
-                new_lines.append('<div class="table-main"><table>')
-            elif line.strip() == ']':
-                in_table = False
-                new_lines.append('</table></div>')
-            elif in_table:
-                processed_line = self.process_line(line)
-                new_lines.append(processed_line)
-            else:
-                new_lines.append(line)
-        return new_lines
+            self.linkify_element(child)
 
-    def process_line(self, line):
-        line = line.strip()
-        if line.startswith('='):
-            headers = [header.strip() for header in line.split('=')]
-            return self.process_table_header(headers)
-        elif '|' in line:
-            cells = [cell.strip() for cell in line.split('|')]
-            return self.process_table_row(cells)
-        else:
-            return line
+            child.tail, links = self.linkify_text(child.tail)
+            index = list(element).index(child) + 1
 
-    def process_table_header(self, headers):
-        result = "<tr>"
+            for offset, link in enumerate(links):
+                element.insert(index + offset, link)
 
-        for header in headers:
-            if header != '':
-                result += f'<th>{header}</th>'
+    def linkify_html(self, html_block):
+        matches = self.find(html_block, self.RAW_EXCLUDED_PATTERN)
 
-        result += "</tr>"
+        if not matches:
+            return html_block
 
-        return result
+        parts = []
+        position = 0
 
-    def process_table_row(self, cells):
-        result = "<tr>"
+        for start, end, title in matches:
+            parts.append(html_block[position:start])
+            parts.append(f'<a href="{html.escape(self.page_url(title))}">{html_block[start:end]}</a>')
+            position = end
 
-        for cell in cells:
-            if cell != '':
-                result += f'<td>{cell}</td>'
+        parts.append(html_block[position:])
 
-        result += "</tr>"
+        return ''.join(parts)
+
+
+class HeaderAdvancerExtension(Extension):
+    """
+    Builds every heading one level down, so the page title is the only <h1>.
+
+    Headers recognised by WikiBlockProcessor are emitted at their advanced level already. This replaces Markdown's own
+    heading processors, which build the rest (setext headings, headings in blockquotes or lists), so every heading is
+    advanced once, as it is built, and raw HTML written by the page author is left untouched.
+    """
+
+    def extendMarkdown(self, md):
+        md.parser.blockprocessors.register(AdvancedHashHeaderProcessor(md.parser), 'hashheader', 70)
+        md.parser.blockprocessors.register(AdvancedSetextHeaderProcessor(md.parser), 'setextheader', 60)
+
+
+def advance_header(parent, previous):
+    # The processor appends the heading it builds to the parent, after anything parsed from the lines before it
+    if len(parent) and parent[-1] is not previous:
+        header = parent[-1]
+        header.tag = ADVANCED_HEADER_TAGS.get(header.tag, header.tag)
+
+
+class AdvancedHashHeaderProcessor(HashHeaderProcessor):
+    def run(self, parent, blocks):
+        previous = parent[-1] if len(parent) else None
+        super().run(parent, blocks)
+        advance_header(parent, previous)
 
-        return result
+
+class AdvancedSetextHeaderProcessor(SetextHeaderProcessor):
+    def run(self, parent, blocks):
+        previous = parent[-1] if len(parent) else None
+        super().run(parent, blocks)
+        advance_header(parent, previous)
 
 
 def format_html(html_string):
@@ -376,86 +847,210 @@ def format_html(html_string):
     return formatted_html
 
 
-def to_html(markdown_string, date, editor, title, page_list, role):
-    link_list = page_list
-    link_list.remove(title)
+# Each worker thread keeps its own engine, since markdown.Markdown instances are not thread-safe.
+_engines = threading.local()
+
 
+def create_engine() -> markdown.Markdown:
+    """
+    Builds a Markdown engine configured with every wiki extension.
+
+    :return: A new, fully configured Markdown engine.
+    :rtype: markdown.Markdown
+    """
     md = markdown.Markdown(
-        extensions=[InfoBoxExtension(), TableExtension(), TableOfContentsExtension(), WikiLinkExtension(base_url='/page?page=', end_url=''),
-                    ExtraExtension(), SaneListExtension()])
+        extensions=[WikiBlockExtension(), LinkifyExtension(), WikiLinkExtension(base_url='/page?page=', end_url=''),
+                    ExtraExtension(), SaneListExtension(), HeaderAdvancerExtension()])
+
+    return md
+
+
+def get_engine() -> markdown.Markdown:
+    """
+    Retrieves the calling thread's Markdown engine, creating it on first use.
+
+    The engine is reset before it is returned, so it keeps its compiled patterns and registries but none of the
+    state from its previous conversion.
+
+    :return: A reset Markdown engine owned by the calling thread.
+    :rtype: markdown.Markdown
+    """
+    md = getattr(_engines, 'md', None)
+
+    if md is None:
+        md = _engines.md = create_engine()
+
+    md.reset()
+
+    return md
+
+
+def render_body(markdown_string, title, matcher=None):
+    """
+    Renders a page's Markdown into its body HTML and table of contents, without the page chrome around them.
 
-    # md = markdown.Markdown(
-    #     extensions=[InfoBoxExtension(), TableExtension(), TableOfContentsExtension(), LinkifyExtension(words=link_list),
-    #                 ExtraExtension(), 'sane_lists'])
+    :param markdown_string: The page's Markdown.
+    :type markdown_string: str
+    :param title: The page's title, which is never auto-linked.
+    :type title: str
+    :param matcher: The titles to auto-link. If None, nothing is auto-linked.
+    :type matcher: Optional[TitleMatcher]
+
+    :return: The body HTML and a list of (header_text, header_level, header_id) table of contents entries.
+    :rtype: tuple
+    """
+    md = get_engine()
+
+    # Mentions of other pages are only linked when a matcher over the wiki's titles is supplied
+    linkify = md.treeprocessors['linkify']
+    linkify.matcher = matcher if matcher is not None else TitleMatcher()
+    linkify.exclude_title = title
 
-    md.postprocessors.register(HeaderAdvancerExtension(), "header_advancer", 0)
     html_output = md.convert(markdown_string)
     table_of_contents = getattr(md, 'table_of_contents', [])
 
-    header_id = title.replace(" ", "")
-
-    result = f"""
-    <div class="row">
-        <div class="col-md-8 wiki-main">
-            <div class="header-border">
-                <div class="row">
-                    <h1 class="page-header" id="{header_id}">{title}</h1>
-                    <div class="date-wrapper">
-                        <p class="date">Edited <span class="text-success">{date}</span> by <span class="text-primary">{editor}</span></p>
-                    </div>
-                </div>
-            </div>
-            <nav>
+    return html_output, table_of_contents
+
+
+def split_sections(markdown_string):
     """
+    Splits a page's Markdown into sections that render independently of each other.
 
-    if role == 'admin' or role == 'editor':
-        result += f"""
-            <a href="/" class="">Home</a>
-            <a href="" class="active">Page</a>
-            <a href="editor?page={title}" class="nav-right">Edit</a>
-            <a href="/delete-page?page={title}" class="delete">Delete</a>
-        """
-    else:
-        result += """
-                    <a href="/" class="">Home</a>
-                    <a href="" class="active">Page</a>
-                    <a href="" class="nav-right"></a>
-                """
-
-    result += f"""
-            </nav>
-            <div class="wiki-post">
-                {html_output}
-            </div>
-            </div>
-            <aside class ="order-first wiki-sidebar" >
-              <h5 class="">Contents</h5>
-              <hr class="no-margin pb-2">
-              <ol class="list-unstyled mb-0">
-        """
+    A section starts at each header that follows a blank line outside of an infobox or table, so a block that
+    contains headers always stays in one section. Pages matching UNSPLITTABLE_PATTERN are a single section.
+
+    :param markdown_string: The page's Markdown.
+    :type markdown_string: str
+
+    :return: A (markdown, ends_with_block) pair for each section, in order. Markdown puts a blank line after the
+        HTML of a header or a closed infobox or table, so ends_with_block is True when the section ends with one.
+    :rtype: List[tuple]
+    """
+    if UNSPLITTABLE_PATTERN.search(markdown_string):
+        return [(markdown_string, False)]
+
+    sections = []
+    lines = []
+    has_content = False
+    ends_with_block = False
+    previous_blank = True
+    block = None
+
+    # Follows the block state of WikiBlockProcessor, without rendering anything
+    for line in markdown_string.split('\n'):
+        stripped = line.strip()
+
+        if not stripped:
+            lines.append(line)
+            previous_blank = True
+            continue
+
+        if block is None:
+            if line.startswith('#') and previous_blank and has_content:
+                sections.append(('\n'.join(lines), ends_with_block))
+                lines = []
+
+            ends_with_block = line.startswith('#')
+
+            if stripped == '{':
+                block = 'infobox'
+            elif stripped == '[':
+                block = 'table'
+        else:
+            ends_with_block = stripped == ('}' if block == 'infobox' else ']')
+
+            if ends_with_block:
+                block = None
+
+        lines.append(line)
+        has_content = True
+        previous_blank = False
+
+    sections.append(('\n'.join(lines), ends_with_block))
 
-    for entry in table_of_contents:
-        header_text, header_level, header_id = entry
-        indentation = "toc-" + str(header_level - 1)  # Add indentation based on header level
+    return sections
 
-        result += f'<li class={indentation}><a href="#{header_id}">{header_text}</a></li>\n'
 
-    result += """
-        </ol>
-    </aside>
-    <aside class="wiki-sidebar list-truncate">
-        <h5 class="">Recently Edited Pages</h5>
-        <hr class="no-margin pb-2">
-        <ol class="list-unstyled mb-0">
+def render_each_section(markdown_string, title, matcher=None, section_cache=None):
     """
+    Renders a page's Markdown one section at a time, reusing the cached HTML of sections that have not changed.
+
+    :param markdown_string: The page's Markdown.
+    :type markdown_string: str
+    :param title: The page's title, which is never auto-linked.
+    :type title: str
+    :param matcher: The titles to auto-link. If None, nothing is auto-linked.
+    :type matcher: Optional[TitleMatcher]
+    :param section_cache: Caches the rendered sections. If None, every section is rendered.
+    :type section_cache: Optional[cache.RenderCache]
+
+    :return: A (version, html, table_of_contents, separator, cached) tuple for each section, in order. The
+        separator is the whitespace between the section's HTML and the next section's in the whole page.
+    :rtype: List[tuple]
+    """
+    sections = []
+
+    for section, ends_with_block in split_sections(markdown_string):
+        version = content_version(title, section, matcher.version_for(section) if matcher is not None else '')
+        rendered = section_cache.get((title, version)) if section_cache is not None else None
+        cached = rendered is not None
+
+        if not cached:
+            rendered = render_body(section, title, matcher)
+
+            if section_cache is not None:
+                section_cache.put((title, version), rendered)
 
-    for i in range(15 if len(page_list) > 15 else len(page_list)):
-        result += f'<li><a href="/page?page={page_list[i]}">{page_list[i]}</a></li>\n'
+        sections.append((version, rendered[0], rendered[1], '\n\n' if ends_with_block else '\n', cached))
 
-    result += """
-        </ol>
-    </aside>
-    </div>
+    return sections
+
+
+def render_sections(markdown_string, title, matcher=None, section_cache=None):
     """
+    Renders a page's Markdown one section at a time, reusing the cached HTML of sections that have not changed.
+
+    The result is identical to rendering the whole page with render_body.
+
+    :param markdown_string: The page's Markdown.
+    :type markdown_string: str
+    :param title: The page's title, which is never auto-linked.
+    :type title: str
+    :param matcher: The titles to auto-link. If None, nothing is auto-linked.
+    :type matcher: Optional[TitleMatcher]
+    :param section_cache: Caches the rendered sections. If None, every section is rendered.
+    :type section_cache: Optional[cache.RenderCache]
+
+    :return: The body HTML, its table of contents entries, and the number of sections that were reused and rendered.
+    :rtype: tuple
+    """
+    sections = render_each_section(markdown_string, title, matcher, section_cache)
+
+    html_output = ''.join(html + separator for _, html, _, separator, _ in sections[:-1]) + sections[-1][1]
+    table_of_contents = [entry for section in sections for entry in section[2]]
+    hits = sum(1 for section in sections if section[4])
+    misses = len(sections) - hits
+
+    log.debug(f'Rendered page "{title}": {hits} sections reused, {misses} rendered.')
+
+    return html_output, table_of_contents, hits, misses
+
+
+def render_shell(body, table_of_contents, date, editor, title, recent_pages, role):
+    """
+    Renders the page chrome (header, nav and sidebars) around an already rendered body.
+
+    :return: The complete page HTML.
+    :rtype: str
+    """
+    return shell_environment.get_template(SHELL_TEMPLATE).render(
+        body=body, table_of_contents=table_of_contents, date=date, editor=editor, page=title,
+        recent_pages=recent_pages, role=role)
+
+
+def to_html(markdown_string, date, editor, title, page_list, role, matcher=None):
+    link_list = [page for page in page_list if page != title]
+
+    html_output, table_of_contents = render_body(markdown_string, title, matcher)
 
-    return result
+    return render_shell(html_output, table_of_contents, date, editor, title, link_list[:15], role)
@@ -0,0 +1,308 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from http.cookies import SimpleCookie
+from typing import Callable, Dict, Optional, Set
+from urllib.parse import parse_qs
+
+from dotenv import load_dotenv
+
+from db import DB, AccessAsync
+from leases import LeaseManager
+
+load_dotenv()
+
+log = logging.getLogger("presence")
+
+# How often lock changes made by other processes are pushed, in seconds. Leases held by open editors are renewed every
+# third of EDIT_LEASE_TTL_SECONDS instead
+PRESENCE_INTERVAL_SECONDS = float(os.getenv('PRESENCE_INTERVAL_SECONDS') or 2)
+
+# How often an idle connection is sent a comment, so proxies do not close it, in seconds
+PRESENCE_KEEPALIVE_SECONDS = float(os.getenv('PRESENCE_KEEPALIVE_SECONDS') or 25)
+
+# How long an editor's lease outlives their connection, so reloading the editor, such as after saving, keeps the page
+PRESENCE_GRACE_SECONDS = float(os.getenv('PRESENCE_GRACE_SECONDS') or 5)
+
+PRESENCE_PATH = '/presence'
+
+# Sent first on every connection: how long the browser waits before reconnecting, in milliseconds
+RETRY_EVENT = b'retry: 2000\n\n'
+KEEPALIVE_EVENT = b': keepalive\n\n'
+
+STREAM_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+
+def format_event(event: str, data: dict) -> bytes:
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'.encode('utf-8')
+
+
+class Subscription:
+    """
+    One open presence connection: a user viewing or editing a page, and how to push events to their connection.
+    """
+
+    def __init__(self, page: str, email: str, editing: bool, push: Callable[[bytes], None]):
+        """
+        Initializes a new instance of the Subscription class.
+
+        :param page: The title of the page.
+        :type page: str
+        :param email: The email address of the user.
+        :type email: str
+        :param editing: Whether the user has the page open in the editor, so the connection keeps their lease.
+        :type editing: bool
+        :param push: Queues an event to be sent on the connection. It is called from other threads.
+        :type push: Callable[[bytes], None]
+        """
+        self.page = page
+        self.email = email
+        self.editing = editing
+        self.push = push
+
+    def notify(self, holder: Optional[str]):
+        """
+        Sends the page's lock status. Other users' email addresses are never sent, only whether the page is locked
+        and whether it is locked to this user.
+
+        :param holder: The email address of the user holding the page's lease, or None if it is free.
+        :type holder: Optional[str]
+
+        :return: None
+        """
+        try:
+            self.push(format_event('lock', {'locked': holder is not None, 'mine': holder == self.email}))
+        except RuntimeError:
+            # The connection's event loop has already closed
+            pass
+
+
+class PresenceHub(threading.Thread):
+    """
+    Tracks the open presence connections of this process and pushes lock changes to them.
+
+    An editor's open connection is what keeps their lease on a page: the thread renews the leases of every open
+    editor with one statement, and a closed connection lets its lease run out after PRESENCE_GRACE_SECONDS. Leases
+    acquired, released or moved through this process's lease manager, such as by the editor routes, are pushed
+    straight away, and the thread reads the leases of every watched page with one query each
+    PRESENCE_INTERVAL_SECONDS to push the changes made by other processes and leases that ran out. The database work is
+    the same however many connections are open, and an idle connection costs nothing but its queue.
+
+    Connections are only served on an ASGI server, by presence_asgi. On a WSGI server each one would hold a worker
+    for as long as it is open, so editors poll /active-editor instead.
+
+    Usage:
+    presence_hub = PresenceHub(page_leases)
+    presence_hub.start()
+    """
+
+    def __init__(self, leases: LeaseManager, interval: float = PRESENCE_INTERVAL_SECONDS):
+        """
+        Initializes a new instance of the PresenceHub class.
+
+        :param leases: The lease manager that grants pages to editors.
+        :type leases: LeaseManager
+        :param interval: How often the leases of watched pages are read, in seconds.
+        :type interval: float
+        """
+        super().__init__(name='presence_hub', daemon=True)
+
+        self.leases = leases
+        self.interval = interval
+        self.lock = threading.Lock()
+
+        # The open connections of each page, and the holder last sent to them
+        self.subscriptions: Dict[str, Set[Subscription]] = {}
+        self.holders: Dict[str, Optional[str]] = {}
+        self.renewed_at = 0.0
+
+        leases.watch(self.lease_changed)
+
+    def connections(self) -> int:
+        with self.lock:
+            return sum(len(subscriptions) for subscriptions in self.subscriptions.values())
+
+    def publish(self, page: str, holder: Optional[str], subscription: Optional[Subscription] = None):
+        """
+        Records a page's holder and sends it to the page's connections if it changed, or otherwise only to a new
+        connection that has not been sent it yet.
+
+        :return: None
+        """
+        with self.lock:
+            subscriptions = self.subscriptions.get(page, set())
+
+            if page in self.subscriptions and self.holders.get(page, ...) != holder:
+                self.holders[page] = holder
+                recipients = list(subscriptions)
+            else:
+                recipients = [subscription] if subscription in subscriptions else []
+
+        for recipient in recipients:
+            recipient.notify(holder)
+
+    def lease_changed(self, page: str):
+        """
+        Pushes a page's holder to its connections after this process changed its lease, if any are open.
+
+        :return: None
+        """
+        with self.lock:
+            watched = page in self.subscriptions
+
+        if watched:
+            self.publish(page, self.leases.holder(page))
+
+    def subscribe(self, page: str, email: str, editing: bool, push: Callable[[bytes], None]) -> Subscription:
+        """
+        Opens a presence connection, taking the page's lease for an editor if it is free.
+
+        :return: The subscription, to be passed to unsubscribe once the connection closes.
+        :rtype: Subscription
+        """
+        subscription = Subscription(page, email, editing, push)
+
+        if editing:
+            self.leases.acquire(page, email)
+
+        with self.lock:
+            self.subscriptions.setdefault(page, set()).add(subscription)
+
+        self.publish(page, self.leases.holder(page), subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """
+        Closes a presence connection. An editor's lease runs out after PRESENCE_GRACE_SECONDS unless they reconnect.
+
+        :return: None
+        """
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.page, set())
+            subscriptions.discard(subscription)
+
+            if not subscriptions:
+                self.subscriptions.pop(subscription.page, None)
+                self.holders.pop(subscription.page, None)
+
+            still_editing = any(other.editing and other.email == subscription.email for other in subscriptions)
+
+        if subscription.editing and not still_editing:
+            self.leases.expire(subscription.page, subscription.email, PRESENCE_GRACE_SECONDS)
+
+    def refresh(self):
+        """
+        Renews the leases of open editors once a third of the lease TTL has passed, and pushes every lock change
+        since the last refresh.
+
+        :return: None
+        """
+        with self.lock:
+            pages = list(self.subscriptions)
+            editors = {(subscription.page, subscription.email) for subscriptions in self.subscriptions.values()
+                       for subscription in subscriptions if subscription.editing}
+
+        if editors and time.monotonic() - self.renewed_at >= self.leases.ttl / 3:
+            self.renewed_at = time.monotonic()
+
+            # A lease that could not be renewed ran out, such as while the process was stalled, and is taken again
+            # unless someone else has it
+            for page, email in editors - self.leases.renew_many(editors):
+                self.leases.acquire(page, email)
+
+        if pages:
+            holders = self.leases.holders(pages)
+
+            for page in pages:
+                self.publish(page, holders.get(page))
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+
+            try:
+                self.refresh()
+            except Exception as e:
+                log.error(f'Error refreshing page presence: {e}')
+            finally:
+                DB.get_instance().release_connection()
+
+
+def presence_asgi(app, hub: PresenceHub, authenticate: Callable[[str], Optional[dict]]):
+    """
+    Wraps an ASGI app so that presence connections are served on the event loop, where an idle connection is a
+    waiting coroutine rather than a thread. Every other request is passed on to the app.
+
+    Usage:
+    asgi_app = presence_asgi(WsgiToAsgi(app), presence_hub, decode_token)
+
+    :param app: The ASGI app serving every other request.
+    :param hub: The presence hub of this process.
+    :type hub: PresenceHub
+    :param authenticate: Returns the user of a token cookie, or None if it is missing or invalid.
+    :type authenticate: Callable[[str], Optional[dict]]
+
+    :return: The ASGI app.
+    """
+    async def respond(send, status: int, headers: Dict[str, str]):
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(key.lower().encode('latin-1'), value.encode('latin-1'))
+                                for key, value in headers.items()]})
+
+    async def wait_for_disconnect(receive, events: asyncio.Queue):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+        events.put_nowait(None)
+
+    async def presence_app(scope, receive, send):
+        if scope['type'] != 'http' or scope['path'] != PRESENCE_PATH:
+            return await app(scope, receive, send)
+
+        cookies = SimpleCookie()
+
+        for key, value in scope['headers']:
+            if key == b'cookie':
+                cookies.load(value.decode('latin-1'))
+
+        user = authenticate(cookies['token'].value) if 'token' in cookies else None
+
+        if user is None:
+            await respond(send, 302, {'Location': '/sign-in'})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        query = parse_qs(scope['query_string'].decode('latin-1'))
+        page = query.get('page', [''])[0]
+        editing = query.get('edit', [''])[0] == '1' and user['role'] in ('admin', 'editor')
+
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+
+        subscription = await AccessAsync.run(hub.subscribe, page, user['email'], editing,
+                                             lambda event: loop.call_soon_threadsafe(events.put_nowait, event))
+        disconnect = asyncio.ensure_future(wait_for_disconnect(receive, events))
+
+        try:
+            await respond(send, 200, {'Content-Type': 'text/event-stream', **STREAM_HEADERS})
+            await send({'type': 'http.response.body', 'body': RETRY_EVENT, 'more_body': True})
+
+            while True:
+                try:
+                    event = await asyncio.wait_for(events.get(), PRESENCE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    event = KEEPALIVE_EVENT
+
+                if event is None:
+                    break
+
+                await send({'type': 'http.response.body', 'body': event, 'more_body': True})
+        finally:
+            disconnect.cancel()
+            await AccessAsync.run(hub.unsubscribe, subscription)
+
+    return presence_app
@@ -0,0 +1,118 @@
+import json
+import logging
+import queue
+import threading
+
+import markdown_fyresmith
+from cache import content_version
+from db import DB, Access
+
+log = logging.getLogger("app")
+
+
+def body_version(title: str, markdown: str, matcher: markdown_fyresmith.TitleMatcher) -> str:
+    """
+    Computes the version of a page's rendered body.
+
+    The body depends on the page's own title (which is never auto-linked), its markdown and the titles it could
+    auto-link, so a change to any of them makes a stored render stale. Creating, renaming or deleting a page that it
+    does not mention leaves the stored render current.
+
+    :param title: The page's title.
+    :type title: str
+    :param markdown: The page's markdown.
+    :type markdown: str
+    :param matcher: The titles that are auto-linked.
+    :type matcher: markdown_fyresmith.TitleMatcher
+
+    :return: The version of the rendered body.
+    :rtype: str
+    """
+    return content_version(title, markdown, matcher.version_for(markdown))
+
+
+class RenderWorker(threading.Thread):
+    """
+    Background thread that renders page bodies after writes and stores them in the pages table.
+
+    Usage:
+    render_worker = RenderWorker(get_title_matcher, section_cache)
+    render_worker.start()
+    render_worker.submit('Page Title')
+    """
+
+    def __init__(self, get_matcher, section_cache=None):
+        """
+        Initializes a new instance of the RenderWorker class.
+
+        :param get_matcher: Returns the titles to auto-link when a page is rendered.
+        :type get_matcher: Callable[[], markdown_fyresmith.TitleMatcher]
+        :param section_cache: Caches rendered sections, so only the sections changed by a write are rendered again.
+        :type section_cache: Optional[cache.RenderCache]
+        """
+        super().__init__(name='render_worker', daemon=True)
+
+        self.get_matcher = get_matcher
+        self.section_cache = section_cache
+        self.queue = queue.Queue()
+
+    def submit(self, title: str, version=None, rendered=None):
+        """
+        Queues a page to be rendered and stored.
+
+        :param title: The title of the page.
+        :type title: str
+        :param version: The version of an already rendered body, if one is supplied.
+        :type version: Optional[str]
+        :param rendered: An already rendered (body, table_of_contents) pair to store instead of rendering again.
+        :type rendered: Optional[tuple]
+
+        :return: None
+        """
+        self.queue.put((title, version, rendered))
+
+    def run(self):
+        while True:
+            title, version, rendered = self.queue.get()
+
+            try:
+                self.render(title, version, rendered)
+            except Exception as e:
+                log.error(f'Error pre-rendering page "{title}": {e}')
+            finally:
+                DB.get_instance().release_connection()
+                self.queue.task_done()
+
+    def render(self, title: str, version=None, rendered=None):
+        """
+        Renders a page and stores its body, table of contents and version.
+
+        :param title: The title of the page.
+        :type title: str
+        :param version: The version of an already rendered body, if one is supplied.
+        :type version: Optional[str]
+        :param rendered: An already rendered (body, table_of_contents) pair to store if it is still current.
+        :type rendered: Optional[tuple]
+
+        :return: None
+        """
+        access = Access('pages')
+
+        select = access.select(['markdown'], where={'title': title})
+
+        if not select:
+            return
+
+        matcher = self.get_matcher()
+        current_version = body_version(title, select[0][0], matcher)
+
+        # The page may have been saved again since this render was queued
+        if rendered is None or version != current_version:
+            rendered = markdown_fyresmith.render_sections(select[0][0], title, matcher, self.section_cache)[:2]
+
+        body, table_of_contents = rendered
+
+        access.update(['rendered_html', 'rendered_toc', 'content_hash'],
+                      [body, json.dumps(table_of_contents), current_version], where={'title': title})
+
+        log.info(f'Pre-rendered page: {title}')
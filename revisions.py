@@ -0,0 +1,315 @@
+import argparse
+import difflib
+import json
+import logging
+import os
+import time
+import zlib
+from typing import List, Optional
+
+from dotenv import load_dotenv
+
+from db import DB, Access, create_tables
+
+load_dotenv()
+
+log = logging.getLogger("revisions")
+
+# Every this many revisions of a page is stored in full, so rebuilding a revision never applies more deltas than this
+SNAPSHOT_INTERVAL = int(os.getenv('REVISION_SNAPSHOT_INTERVAL') or 20)
+
+SNAPSHOT = 'snapshot'
+DELTA = 'delta'
+
+# Reads the revisions needed to rebuild revision :number: the closest snapshot at or before it, and every delta after
+CHAIN_QUERY = (
+    'SELECT number, data FROM page_revisions WHERE page_id = :page_id AND number <= :number AND number >= '
+    '(SELECT MAX(number) FROM page_revisions WHERE page_id = :page_id AND number <= :number AND kind = \'snapshot\') '
+    'ORDER BY number')
+
+
+def encode_snapshot(markdown: str) -> bytes:
+    return zlib.compress(markdown.encode('utf-8'), 9)
+
+
+def encode_delta(previous: str, markdown: str) -> bytes:
+    """
+    Encodes the changes from one revision's markdown to the next.
+
+    The delta is a list of operations that rebuild the new markdown line by line, each either a [start, end] range
+    of lines copied from the previous markdown or a string of new lines, stored as compressed JSON.
+
+    :param previous: The markdown of the previous revision.
+    :type previous: str
+    :param markdown: The markdown of the new revision.
+    :type markdown: str
+
+    :return: The compressed delta.
+    :rtype: bytes
+    """
+    old_lines = previous.splitlines(keepends=True)
+    new_lines = markdown.splitlines(keepends=True)
+    operations = []
+
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            operations.append([i1, i2])
+        elif j1 != j2:
+            operations.append(''.join(new_lines[j1:j2]))
+
+    return zlib.compress(json.dumps(operations, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), 9)
+
+
+def apply_delta(previous: str, delta: bytes) -> str:
+    old_lines = previous.splitlines(keepends=True)
+    parts = []
+
+    for operation in json.loads(zlib.decompress(delta)):
+        if isinstance(operation, list):
+            parts.extend(old_lines[operation[0]:operation[1]])
+        else:
+            parts.append(operation)
+
+    return ''.join(parts)
+
+
+def get_page_id(title: str) -> Optional[int]:
+    select = Access('pages').select(['page_id'], where={'title': title})
+
+    return select[0][0] if select else None
+
+
+def rebuild_revision(page_id: int, number: int) -> Optional[str]:
+    """
+    Rebuilds the markdown of a revision from its closest snapshot and the deltas after it.
+
+    :param page_id: The ID of the page.
+    :type page_id: int
+    :param number: The number of the revision, starting at 0 for the page's first revision.
+    :type number: int
+
+    :return: The markdown of the revision, or None if the page has no such revision.
+    :rtype: Optional[str]
+    """
+    conn = DB.get_instance().get_connection()
+    rows = conn.execute(CHAIN_QUERY, {'page_id': page_id, 'number': number}).fetchall()
+
+    if not rows or rows[-1][0] != number:
+        return None
+
+    markdown = zlib.decompress(rows[0][1]).decode('utf-8')
+
+    for _, data in rows[1:]:
+        markdown = apply_delta(markdown, data)
+
+    return markdown
+
+
+def encode_revision(page_id: int, markdown: str) -> tuple:
+    """
+    Encodes a page's markdown as the revision after its latest one.
+
+    Revisions are stored as deltas from the revision before them, except every SNAPSHOT_INTERVAL revisions and
+    whenever a delta would be larger than the full markdown, which are stored in full.
+
+    :param page_id: The ID of the page.
+    :type page_id: int
+    :param markdown: The page's new markdown.
+    :type markdown: str
+
+    :return: The number of the latest revision it follows, or None if the page has none, and the new revision's
+             (number, kind, data), or None if the markdown is unchanged since the latest revision.
+    :rtype: tuple
+    """
+    latest = Access('page_revisions').select(['number'], where={'page_id': page_id}, order_by='number DESC', limit=1)
+    data = encode_snapshot(markdown)
+
+    if not latest:
+        return None, (0, SNAPSHOT, data)
+
+    base = latest[0][0]
+    previous = rebuild_revision(page_id, base)
+
+    if previous == markdown:
+        return base, None
+
+    number = base + 1
+
+    if number % SNAPSHOT_INTERVAL != 0:
+        delta = encode_delta(previous, markdown)
+
+        if len(delta) < len(data):
+            return base, (number, DELTA, delta)
+
+    return base, (number, SNAPSHOT, data)
+
+
+def prepare_revision(title: str, markdown: str) -> Optional[tuple]:
+    """
+    Encodes a page's new markdown before the caller's transaction starts, so the diff is not worked out while the
+    write lock is held and every other writer waits. Pass the result to record_revision.
+
+    :param title: The title of the page.
+    :type title: str
+    :param markdown: The page's new markdown.
+    :type markdown: str
+
+    :return: The prepared revision, or None if the page does not exist.
+    :rtype: Optional[tuple]
+    """
+    page_id = get_page_id(title)
+
+    if page_id is None:
+        return None
+
+    return (page_id, *encode_revision(page_id, markdown))
+
+
+def record_revision(title: str, markdown: str, editor: str, prepared: Optional[tuple] = None) -> Optional[int]:
+    """
+    Stores a page's markdown as its newest revision, unless it is unchanged since the last one.
+
+    :param title: The title of the page.
+    :type title: str
+    :param markdown: The page's new markdown.
+    :type markdown: str
+    :param editor: The name of the user who made the revision.
+    :type editor: str
+    :param prepared: The revision encoded by prepare_revision before the transaction. It is encoded again under the
+                     write lock if another revision of the page has been stored since.
+    :type prepared: Optional[tuple]
+
+    :return: The number of the new revision, or None if nothing was stored.
+    :rtype: Optional[int]
+    """
+    with Access.transaction():
+        page_id = get_page_id(title)
+
+        if page_id is None:
+            return None
+
+        access = Access('page_revisions')
+        latest = access.select(['number'], where={'page_id': page_id}, order_by='number DESC', limit=1)
+
+        if prepared is not None and prepared[:2] == (page_id, latest[0][0] if latest else None):
+            revision = prepared[2]
+        else:
+            revision = encode_revision(page_id, markdown)[1]
+
+        if revision is None:
+            return None
+
+        number, kind, data = revision
+
+        access.insert(['page_id', 'number', 'created_at', 'editor', 'kind', 'data'],
+                      [page_id, number, int(time.time()), editor, kind, data])
+
+    return number
+
+
+def get_revision(title: str, number: int) -> Optional[str]:
+    """
+    Retrieves the markdown of one of a page's revisions.
+
+    :param title: The title of the page.
+    :type title: str
+    :param number: The number of the revision, as listed by get_history.
+    :type number: int
+
+    :return: The markdown of the revision, or None if the page or revision does not exist.
+    :rtype: Optional[str]
+    """
+    page_id = get_page_id(title)
+
+    if page_id is None:
+        return None
+
+    return rebuild_revision(page_id, number)
+
+
+def get_history(title: str) -> List[dict]:
+    """
+    Lists a page's revisions, newest first.
+
+    :param title: The title of the page.
+    :type title: str
+
+    :return: The number, creation time in epoch seconds, editor, storage kind and stored size of each revision.
+    :rtype: List[dict]
+    """
+    page_id = get_page_id(title)
+
+    if page_id is None:
+        return []
+
+    select = Access('page_revisions').select(['number', 'created_at', 'editor', 'kind', 'length(data)'],
+                                             where={'page_id': page_id}, order_by='number DESC')
+
+    return [{'number': number, 'created_at': created_at, 'editor': editor, 'kind': kind, 'size': size}
+            for number, created_at, editor, kind, size in select]
+
+
+def record_missing_revisions():
+    """
+    Stores the current markdown of every page that has no revisions yet, such as pages written before revisions
+    were kept, so their history starts from their current state.
+
+    It runs under the write lock, so workers starting together do not both store a page's first revision. Run it
+    in the same transaction as create_tables, which every worker also runs on start.
+
+    :return: None
+    """
+    with Access.transaction():
+        rows = Access('pages').iterate(['page_id', 'markdown', 'updated_at', 'editor'],
+                                       condition='page_id NOT IN (SELECT page_id FROM page_revisions)')
+
+        Access('page_revisions').bulk_insert(
+            ['page_id', 'number', 'created_at', 'editor', 'kind', 'data'],
+            ([page_id, 0, updated_at or 0, editor, SNAPSHOT, encode_snapshot(markdown)]
+             for page_id, markdown, updated_at, editor in rows))
+
+
+def storage_report() -> dict:
+    """
+    Compares the space used by the stored revisions with the space full copies of every revision would use.
+
+    :return: The number of revisions, their total size as full markdown and the size actually stored, in bytes.
+    :rtype: dict
+    """
+    report = {'revisions': 0, 'full_bytes': 0, 'stored_bytes': 0}
+    markdown = ''
+
+    # Each page's revisions start with a snapshot, so reading them in order rebuilds each one from the one before
+    for kind, data in Access('page_revisions').iterate(['kind', 'data'], order_by='page_id, number'):
+        if kind == SNAPSHOT:
+            markdown = zlib.decompress(data).decode('utf-8')
+        else:
+            markdown = apply_delta(markdown, data)
+
+        report['revisions'] += 1
+        report['full_bytes'] += len(markdown.encode('utf-8'))
+        report['stored_bytes'] += len(data)
+
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reports on the stored page revisions.')
+    parser.add_argument('command', choices=['report'], help='report: compare the stored size with full copies.')
+    parser.parse_args()
+
+    with Access.transaction():
+        create_tables()
+        record_missing_revisions()
+
+    report = storage_report()
+    ratio = report['stored_bytes'] / report['full_bytes'] if report['full_bytes'] else 0
+
+    print(f'{report["revisions"]} revisions: {report["full_bytes"]} bytes as full copies, '
+          f'{report["stored_bytes"]} bytes stored ({ratio:.1%}).')
+
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
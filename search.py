@@ -0,0 +1,135 @@
+import argparse
+import logging
+import re
+import sqlite3
+from typing import List, Tuple
+
+from markupsafe import Markup, escape
+
+from db import DB, create_tables
+
+log = logging.getLogger("search")
+
+# Number of results shown on each page of search results
+RESULTS_PER_PAGE = 20
+
+# Number of words around the matches shown in each result
+SNIPPET_WORDS = 24
+
+# Marks the matched words in snippets, replaced with <mark> tags once the rest of the snippet is escaped
+MATCH_START = '\x02'
+MATCH_END = '\x03'
+
+# Queries matching more pages than this are listed newest first rather than ranked, since ranking scores every match
+RANKED_MATCH_LIMIT = 5000
+
+WORD_PATTERN = re.compile(r'\w+')
+
+MATCH_COUNT_QUERY = 'SELECT COUNT(*) FROM (SELECT rowid FROM pages_fts WHERE pages_fts MATCH :query LIMIT :limit)'
+
+SEARCH_QUERY = (
+    f'SELECT title, snippet(pages_fts, 1, char(2), char(3), \'…\', {SNIPPET_WORDS}) FROM pages_fts '
+    'WHERE pages_fts MATCH :query ORDER BY {order} LIMIT :limit OFFSET :offset')
+
+
+def match_expression(text: str) -> str:
+    """
+    Converts what a user typed into an FTS5 query that matches pages containing every word, so that quotes,
+    operators and other syntax in the search box are searched for rather than interpreted.
+
+    :param text: The search text.
+    :type text: str
+
+    :return: The FTS5 query, or '' if the text has no words.
+    :rtype: str
+    """
+    words = WORD_PATTERN.findall(text or '')
+
+    if not words:
+        return ''
+
+    return ' '.join(f'"{word}"' for word in words)
+
+
+def highlight(snippet: str) -> Markup:
+    """
+    Escapes a snippet and wraps its matched words in <mark> tags.
+
+    :param snippet: The snippet, with the matched words between MATCH_START and MATCH_END.
+    :type snippet: str
+
+    :return: The snippet as safe HTML.
+    :rtype: Markup
+    """
+    return Markup(str(escape(snippet)).replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>'))
+
+
+def search_pages(text: str, page: int = 1, per_page: int = RESULTS_PER_PAGE) -> Tuple[List[tuple], bool]:
+    """
+    Searches page titles and markdown, best matches first. Matches in titles rank above matches in the markdown.
+
+    Ranking scores every matching page, so queries matching more than RANKED_MATCH_LIMIT pages are listed newest
+    first instead. Their words appear in so many pages that they would barely affect the ranking anyway.
+
+    :param text: The search text.
+    :type text: str
+    :param page: The page of results to retrieve, starting at 1.
+    :type page: int
+    :param per_page: The number of results on each page.
+    :type per_page: int
+
+    :return: The title and highlighted snippet of each result, and whether there are more results after them.
+    :rtype: Tuple[List[tuple], bool]
+    """
+    query = match_expression(text)
+
+    if not query:
+        return [], False
+
+    conn = DB.get_instance().get_connection()
+
+    try:
+        matches = conn.execute(MATCH_COUNT_QUERY, {'query': query, 'limit': RANKED_MATCH_LIMIT + 1}).fetchone()[0]
+        order = 'rank' if matches <= RANKED_MATCH_LIMIT else 'rowid DESC'
+
+        # One extra row tells whether there is a next page, without counting every match
+        rows = conn.execute(SEARCH_QUERY.format(order=order),
+                            {'query': query, 'limit': per_page + 1, 'offset': (max(page, 1) - 1) * per_page}).fetchall()
+    except sqlite3.Error as e:
+        log.info(f'Error searching pages: {e}')
+        return [], False
+
+    return [(title, highlight(snippet)) for title, snippet in rows[:per_page]], len(rows) > per_page
+
+
+def rebuild_index():
+    """
+    Rebuilds the full-text search index from every row in the pages table.
+
+    The triggers on the pages table keep the index up to date, so this is only needed for rows written while the
+    triggers did not exist, such as in a database restored from an older backup.
+
+    :return: None
+    """
+    create_tables()
+
+    conn = DB.get_instance().get_connection()
+    conn.execute('INSERT INTO pages_fts (pages_fts) VALUES (\'rebuild\')')
+    conn.commit()
+
+    count = conn.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+    log.info(f'Rebuilt the full-text search index for {count} pages.')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintains the full-text search index.')
+    parser.add_argument('command', choices=['rebuild'], help='rebuild: index every existing page again.')
+    parser.parse_args()
+
+    rebuild_index()
+
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
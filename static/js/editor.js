@@ -196,6 +196,112 @@ function debounce(func, delay) {
     };
 }
 
+// The last preview rendered by the server, so only the lines changed since then are sent
+let previewLines = null;
+let previewVersion = null;
+let previewSections = {};
+let previewInFlight = false;
+let previewPending = false;
+
+function togglePreview() {
+    let preview = document.getElementById('preview');
+
+    preview.hidden = !preview.hidden;
+
+    updatePreview();
+}
+
+function updatePreview() {
+    let preview = document.getElementById('preview');
+    let page = document.getElementById('page');
+    let lines = document.getElementById('editor').value.split('\n');
+
+    if (preview.hidden) {
+        return;
+    }
+
+    // Each request builds on the last response, so wait for it before sending the next change
+    if (previewInFlight) {
+        previewPending = true;
+        return;
+    }
+
+    let start = 0;
+    let end = 0;
+    let changedLines = lines;
+
+    if (previewLines !== null) {
+        // Find the range of lines that changed since the last preview
+        let previousEnd = previewLines.length;
+        let newEnd = lines.length;
+
+        while (start < previousEnd && start < newEnd && previewLines[start] === lines[start]) {
+            start++;
+        }
+
+        while (previousEnd > start && newEnd > start && previewLines[previousEnd - 1] === lines[newEnd - 1]) {
+            previousEnd--;
+            newEnd--;
+        }
+
+        if (start === previousEnd && start === newEnd) {
+            return;
+        }
+
+        end = previousEnd;
+        changedLines = lines.slice(start, newEnd);
+    }
+
+    previewInFlight = true;
+
+    fetch('/preview', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ page: page.value, base: previewVersion, start: start, end: end, lines: changedLines }),
+    })
+        .then(response => {
+            if (!response.ok) {
+                throw new Error(`HTTP error! Status: ${response.status}`);
+            }
+
+            return response.json();
+        })
+        .then(data => {
+            previewInFlight = false;
+
+            if (data.status === 'reset') {
+                previewLines = null;
+                previewVersion = null;
+                updatePreview();
+                return;
+            }
+
+            // Sections sent without HTML are unchanged since the last preview
+            let sections = {};
+            let html = '';
+
+            data.sections.forEach(([id, sectionHtml, separator]) => {
+                sections[id] = sectionHtml !== null ? sectionHtml : previewSections[id];
+                html += sections[id] + separator;
+            });
+
+            previewSections = sections;
+            previewLines = lines;
+            previewVersion = data.version;
+            preview.innerHTML = html;
+
+            if (previewPending) {
+                previewPending = false;
+                updatePreview();
+            }
+        })
+        .catch(error => {
+            previewInFlight = false;
+            previewPending = false;
+            console.error('Error updating preview:', error);
+        });
+}
+
 // document.addEventListener('keydown', function(event) {
 //     if ((event.metaKey || event.ctrlKey) && event.key === 'b') {
 //         event.preventDefault(); // Prevent the default browser behavior (e.g., bookmark)
@@ -282,6 +388,7 @@ function updateHighlightedLines(textarea) {
 }
 
 monitorTextarea('editor');
+document.getElementById('editor').addEventListener('input', debounce(updatePreview, 500));
 window.onload = showMessage('Editor Loaded', 'success');
 // document.getElementById('page_title').addEventListener('input', debounce(updatePageName, 500));
 // document.getElementById('page_category').addEventListener('input', debounce(updateCategoryName, 500));
\ No newline at end of file
@@ -0,0 +1,83 @@
+"""
+Pins infobox rendering to the output of the renderer from before cell values were converted in one batch, and checks
+that every heading is advanced one level below the page title exactly once.
+
+Run from the repository root:
+python -m pytest tests
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import markdown_fyresmith
+
+FIXTURE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Values covering what the inner engine renders, including the ones that stop batching: raw HTML, footnotes, and
+# reference and abbreviation definitions, which change how every later value renders
+CELL_VALUES = [
+    'Plain value',
+    '*Emphasized* and **bold**',
+    'A [link](https://example.com) and [[Wiki Link]]',
+    '`inline code` with <angle brackets>',
+    'Line one  \nline two',
+    '- A list item',
+    'Text with a footnote[^1]',
+    '[^1]: The footnote.',
+    '<span class="custom">Raw HTML</span>',
+    'Uses [a reference][ref]',
+    '[ref]: https://example.com/ref',
+    'HTML is an abbreviation',
+    '*[HTML]: Hyper Text Markup Language',
+    'HTML again, after the definition',
+]
+
+
+def convert_one_at_a_time(values):
+    """
+    Converts cell values the way the renderer did before batching: one at a time, in order, in a freshly reset inner
+    engine.
+    """
+    inner_md = markdown_fyresmith.get_engine().preprocessors['wiki_blocks'].inner_md
+    inner_md.reset()
+
+    return [inner_md.convert(value).replace('<p>', '').replace('</p>', '') for value in values]
+
+
+def render_cells(values):
+    processor = markdown_fyresmith.get_engine().preprocessors['wiki_blocks']
+    processor.inner_md.reset()
+
+    return processor.render_cells(values)
+
+
+def test_default_markdown_infobox_matches_previous_renderer():
+    with open(os.path.join(FIXTURE_FOLDER, 'default_infobox.html'), encoding='utf-8') as file:
+        expected = file.read()
+
+    html = markdown_fyresmith.to_html(markdown_fyresmith.DEFAULT_MARKDOWN, 0, 'Editor', 'Example', ['Example'],
+                                      'viewer')
+
+    assert expected in html
+
+
+def test_batched_cells_match_one_at_a_time():
+    assert render_cells(CELL_VALUES) == convert_one_at_a_time(CELL_VALUES)
+
+
+def test_batched_cells_match_one_at_a_time_in_any_order():
+    for start in range(len(CELL_VALUES)):
+        values = CELL_VALUES[start:] + CELL_VALUES[:start]
+
+        assert render_cells(values) == convert_one_at_a_time(values), values
+
+
+def test_headings_are_advanced_once():
+    html = markdown_fyresmith.get_engine().convert('# Wiki Header\n\nSetext Header\n=============\n\n'
+                                                   '> ## Quoted Header\n\n<h1>Raw Header</h1>')
+
+    assert '<h2 id="WikiHeader">Wiki Header</h2>' in html
+    assert '<h2>Setext Header</h2>' in html
+    assert '<h3>Quoted Header</h3>' in html
+    assert '<h1>Raw Header</h1>' in html